@@ -18,6 +18,15 @@
 # for more details.
 
 import sys
+
+# the imports are timed from here with: python TagLab.py --startup-report (see ImportTiming)
+if "--startup-report" in sys.argv:
+    from source.ImportTiming import ImportTimer
+    import_timer = ImportTimer()
+    import_timer.install()
+else:
+    import_timer = None
+
 import os
 import time
 import datetime
@@ -33,18 +42,10 @@ from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QFileDialog, QCo
     QLabel, QToolButton, QPushButton, QSlider, \
     QMessageBox, QGroupBox, QHBoxLayout, QVBoxLayout, QTextEdit, QLineEdit, QGraphicsView, QAction, QGraphicsItem
 
-# PYTORCH
-try:
-    import torch
-    from torch.nn.functional import upsample
-except Exception as e:
-    print("Incompatible version between pytorch, cuda and python.\n" +
-          "Knowing working version combinations are\n: Cuda 10.0, pytorch 1.0.0, python 3.6.8" + str(e))
-   # exit()
-
 # CUSTOM
+# NOTE: the heavy modules (torch, the networks in models, GDAL/rasterio of RasterOps, matplotlib) are imported
+# by the methods which use them, the first time they are needed (see python TagLab.py --startup-report)
 import source.Mask as Mask
-import source.RasterOps as rasterops
 from source.QtImageViewerPlus import QtImageViewerPlus
 from source.QtMapViewer import QtMapViewer
 from source.QtMapSettingsWidget import QtMapSettingsWidget
@@ -53,24 +54,16 @@ from source.QtInfoWidget import QtInfoWidget
 from source.QtHelpWidget import QtHelpWidget
 from source.QtProgressBarCustom import QtProgressBarCustom
 from source.QtCrackWidget import QtCrackWidget
-from source.QtHistogramWidget import QtHistogramWidget
 from source.QtClassifierWidget import QtClassifierWidget
 from source.QtNewDatasetWidget import QtNewDatasetWidget
-from source.QtTrainingResultsWidget import QtTrainingResultsWidget
 from source.QtTYNWidget import QtTYNWidget
 from source.QtComparePanel import QtComparePanel
 from source.QtProjectWidget import QtProjectWidget
-from source.Project import Project, loadProject
+from source.Project import Project, loadProject, BINARY_PROJECT_EXTENSION
 from source.Image import Image
-from source.MapClassifier import MapClassifier
-from source.NewDataset import NewDataset
 
 from source import utils
 
-# training modules
-from models.coral_dataset import CoralsDataset
-import models.training as training
-
 
 # LOGGING
 import logging
@@ -603,17 +596,28 @@ class TagLab(QWidget):
 
     def activateAutosave(self):
 
-        pass
-
-        # self.timer = QTimer(self)
-        # self.timer.timeout.connect(self.autosave)
-        # #self.timer.start(1800000)  # save every 3 minute
-        # self.timer.start(600000)  # save every 3 minute
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.autosave)
+        self.timer.start(600000)  # save every 10 minutes
 
     @pyqtSlot()
     def autosave(self):
+
+        # the project has never been saved (e.g. after resetAll())
+        if self.project.filename is None:
+            return
+
+        error = self.project.waitSave()
+        if error is not None:
+            logfile.info("[PROJECT] The autosave of the project failed: " + str(error))
+
+        # only the modifications since the last autosave are serialized (here, in the GUI thread),
+        # the container is written in background
         filename, file_extension = os.path.splitext(self.project.filename)
-        self.project.save(filename + "_autosave.json")
+        try:
+            self.project.saveBinary(filename + "_autosave" + BINARY_PROJECT_EXTENSION, background=True)
+        except Exception as e:
+            logfile.info("[PROJECT] The autosave of the project failed: " + str(e))
 
     # call by pressing right button
     def openContextMenu(self, position):
@@ -888,6 +892,10 @@ class TagLab(QWidget):
         autoMatchLabels.setStatusTip("Match labels between two maps automatically")
         autoMatchLabels.triggered.connect(self.autoCorrespondences)
         
+        autoMatchAllLabels = QAction("Compute automatic matches (all the surveys)", self)
+        autoMatchAllLabels.setStatusTip("Match labels between all the consecutive maps automatically")
+        autoMatchAllLabels.triggered.connect(self.autoCorrespondencesAllSurveys)
+
         manualMatchLabels = QAction("Add manual matches", self)
         manualMatchLabels.setStatusTip("Add manual matches")
         manualMatchLabels.triggered.connect(self.matchTool)
@@ -900,6 +908,7 @@ class TagLab(QWidget):
         self.comparemenu.setStyleSheet(styleMenu)
         self.comparemenu.addAction(splitScreenAction)
         self.comparemenu.addAction(autoMatchLabels)
+        self.comparemenu.addAction(autoMatchAllLabels)
         self.comparemenu.addAction(manualMatchLabels)
         self.comparemenu.addAction(exportMatchLabels)
 
@@ -1029,6 +1038,53 @@ class TagLab(QWidget):
                 self.setTool("MATCH")
 
 
+    @pyqtSlot()
+    def autoCorrespondencesAllSurveys(self):
+        """
+        Compute the matches between all the consecutive maps (ordered by acquisition date), replacing the existing ones.
+        """
+
+        if len(self.project.images) < 2:
+            return
+
+        reply = QMessageBox.question(self, self.TAGLAB_VERSION,
+                                     "The matches between all the consecutive maps will be computed, replacing the existing ones. Continue?",
+                                     QMessageBox.Yes | QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.setupProgressBar()
+        self.progress_bar.setMessage("Compute the matches of all the maps..")
+
+        try:
+            report = self.project.computeAllCorrespondences(workers=os.cpu_count(), progress=self.matchProgress)
+        except Exception as e:
+            self.deleteProgressBar()
+            QApplication.restoreOverrideCursor()
+            logfile.info("[MATCHING] The matching of all the maps failed: " + str(e))
+            msgBox = QMessageBox()
+            msgBox.setWindowTitle(self.TAGLAB_VERSION)
+            msgBox.setText("Error computing the matches: " + str(e))
+            msgBox.exec()
+            return
+
+        self.deleteProgressBar()
+        QApplication.restoreOverrideCursor()
+
+        for key, seconds, count in report:
+            logfile.info("[MATCHING] Matches {:s}: {:d} in {:.1f} s".format(key, count, seconds))
+
+        self.infoWidget.setInfoMessage("The matches of {:d} pairs of maps have been computed.".format(len(report)))
+
+        if self.split_screen_flag is True:
+            self.compare_panel.setTable(self.project, self.comboboxSourceImage.currentIndex(), self.comboboxTargetImage.currentIndex())
+
+    def matchProgress(self, pairs, total):
+
+        self.progress_bar.setProgress(100.0 * pairs / max(total, 1))
+        QApplication.processEvents()
+
     @pyqtSlot()
     def exportMatches(self):
 
@@ -1489,7 +1545,7 @@ class TagLab(QWidget):
             else:
                 correspondences.updateAreas(use_surface_area=False)
 
-            self.compare_panel.data_table.update()
+            self.compare_panel.updateData()
 
 
     @pyqtSlot()
@@ -1653,6 +1709,15 @@ class TagLab(QWidget):
 
     def resetAll(self):
 
+        # the autosave restarts when the new project is saved or loaded
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+
+        error = self.project.waitSave()
+        if error is not None:
+            logfile.info("[PROJECT] The autosave of the project failed: " + str(error))
+
         self.viewerplus.clear()
         self.viewerplus2.clear()
         self.mapviewer.clear()
@@ -1840,6 +1905,15 @@ class TagLab(QWidget):
 
     def updatePanelInfo(self, blob):
 
+        # the values are read from the summary table of the annotations (if the blob belongs to them)
+        row = self.activeviewer.annotations.summaryOf(blob) if self.activeviewer else None
+        if row is not None:
+            centroid = (row["centroid x"], row["centroid y"])
+            area, perimeter, surface_area = row["area"], row["perimeter"], row["surface area"]
+        else:
+            centroid = blob.centroid
+            area, perimeter, surface_area = blob.area, blob.perimeter, blob.surface_area
+
         self.lblIdValue.setText(str(blob.id))
         self.lblIdValue.setTextInteractionFlags(Qt.TextSelectableByMouse)
         self.lblClass.setText(blob.class_name)
@@ -1856,21 +1930,21 @@ class TagLab(QWidget):
             txt_surface_area = "Surf. area (cm<sup>2</sup>):"
             factor = float(self.activeviewer.image.map_px_to_mm_factor)
 
-        cx = blob.centroid[0]
-        cy = blob.centroid[1]
+        cx = centroid[0]
+        cy = centroid[1]
         txt = "({:6.2f},{:6.2f})".format(cx, cy)
         self.lblCentroidValue.setText(txt)
         self.lblCentroidValue.setTextInteractionFlags(Qt.TextSelectableByMouse)
 
         # perimeter
-        scaled_perimeter = blob.perimeter * factor / 10.0
+        scaled_perimeter = perimeter * factor / 10.0
         self.lblPerimeter.setText(txt_perimeter)
         txt = "{:6.2f}".format(scaled_perimeter)
         self.lblPerimeterValue.setText(txt)
         self.lblPerimeterValue.setTextInteractionFlags(Qt.TextSelectableByMouse)
 
         # area
-        scaled_area = blob.area * factor * factor / 100.0
+        scaled_area = area * factor * factor / 100.0
         self.lblArea.setText(txt_area)
         txt = "{:6.2f}".format(scaled_area)
         self.lblAreaValue.setText(txt)
@@ -1880,7 +1954,7 @@ class TagLab(QWidget):
         self.lblSurfaceArea.setText(txt_surface_area)
         if self.activeviewer:
             if self.activeviewer.image.hasDEM():
-                scaled_area = blob.surface_area * factor * factor / 100.0
+                scaled_area = surface_area * factor * factor / 100.0
                 txt = "{:6.2f}".format(scaled_area)
                 self.lblSurfaceAreaValue.setText(txt)
                 self.lblSurfaceAreaValue.setTextInteractionFlags(Qt.TextSelectableByMouse)
@@ -2559,7 +2633,7 @@ class TagLab(QWidget):
     @pyqtSlot()
     def openProject(self):
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json) ;; BINARY ANNOTATION PROJECT (*.tlb)"
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
 
         if filename:
@@ -2584,7 +2658,7 @@ class TagLab(QWidget):
     @pyqtSlot()
     def saveAsProject(self):
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json) ;; BINARY ANNOTATION PROJECT (*.tlb)"
         filename, _ = QFileDialog.getSaveFileName(self, "Save the project", self.taglab_dir, filters)
 
         if filename:
@@ -2600,7 +2674,7 @@ class TagLab(QWidget):
         Opens a previously saved project and append the annotated images to the current ones.
         """
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json) ;; BINARY ANNOTATION PROJECT (*.tlb)"
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
         if filename:
             self.disableSplitScreen()
@@ -2770,6 +2844,8 @@ class TagLab(QWidget):
 
         if self.activeviewer is not None:
 
+            from source.QtHistogramWidget import QtHistogramWidget
+
             histo_widget = QtHistogramWidget(self.activeviewer.annotations, self.labels_dictionary,
                                              self.activeviewer.image.pixelSize(),
                                              self.activeviewer.image.acquisition_date, self)
@@ -2789,13 +2865,17 @@ class TagLab(QWidget):
                 box.exec()
                 return
 
-        filters = "SHP (*.shp)"
+        filters = "SHP (*.shp) ;; GeoPackage (*.gpkg)"
         output_filename, _ = QFileDialog.getSaveFileName(self, "Save Shapefile as", self.taglab_dir, filters)
 
         if output_filename:
+            import source.RasterOps as rasterops
             blobs = self.activeviewer.annotations.seg_blobs
             gf = self.activeviewer.image.georef_filename
-            rasterops.write_shapefile(blobs, gf, output_filename)
+            if output_filename.lower().endswith(".gpkg"):
+                rasterops.write_geopackage(blobs, gf, output_filename)
+            else:
+                rasterops.write_shapefile(blobs, gf, output_filename)
 
     @pyqtSlot()
     def exportGeoRefLabelMap(self):
@@ -2819,12 +2899,16 @@ class TagLab(QWidget):
         output_filename, _ = QFileDialog.getSaveFileName(self, "Output GeoTiff", "", filters)
 
         if output_filename:
+            import source.RasterOps as rasterops
             size = QSize(self.activeviewer.image.width, self.activeviewer.image.height)
-            label_map_img = self.activeviewer.annotations.create_label_map(size, self.labels_dictionary)
-            label_map_np = utils.qimageToNumpyArray(label_map_img)
+            annotations = self.activeviewer.annotations
+            palette, class_index = annotations.labelMapPalette(self.labels_dictionary)
+            label_strips = annotations.labelMapStrips(size, self.labels_dictionary)
             georef_filename = self.activeviewer.image.georef_filename
             outfilename = os.path.splitext(output_filename)[0]
-            rasterops.saveGeorefLabelMap(label_map_np, georef_filename, outfilename)
+            # the overviews are useful only for big maps
+            build_overviews = max(size.width(), size.height()) > 8192
+            rasterops.saveTiledGeorefLabelMap(label_strips, palette, georef_filename, outfilename, build_overviews)
 
             msgBox = QMessageBox(self)
             msgBox.setWindowTitle(self.TAGLAB_VERSION)
@@ -2908,13 +2992,15 @@ class TagLab(QWidget):
             self.progress_bar.setMessage("Export new dataset (setup)..")
             QApplication.processEvents()
 
+            from source.NewDataset import NewDataset
+            import models.training as training
+
             new_dataset = NewDataset(self.activeviewer.img_map, self.activeviewer.annotations.seg_blobs, tile_size=1026, step=513)
 
             target_classes = training.createTargetClasses(self.activeviewer.annotations)
             target_classes = list(target_classes.keys())
 
-            new_dataset.createLabelImage(self.labels_dictionary)
-            new_dataset.convert_colors_to_labels(target_classes, self.labels_dictionary)
+            new_dataset.createLabels(target_classes, self.labels_dictionary)
             new_dataset.computeFrequencies(target_classes)
             target_scale_factor = self.newDatasetWidget.getTargetScale()
             new_dataset.workingAreaCropAndRescale(self.activeviewer.image.pixelSize(), target_scale_factor,self.activeviewer.image.working_area)
@@ -2936,7 +3022,7 @@ class TagLab(QWidget):
             QApplication.processEvents()
 
             if flag_oversampling is True:
-                class_to_sample, radii = new_dataset.computeRadii()
+                class_to_sample, radii = new_dataset.computeRadii(target_classes)
                 new_dataset.cut_tiles(regular=False, oversampling=True, classes_to_sample=class_to_sample, radii=radii)
             else:
                 new_dataset.cut_tiles(regular=True, oversampling=False, classes_to_sample=None, radii=None)
@@ -2952,7 +3038,12 @@ class TagLab(QWidget):
 
             basename = self.newDatasetWidget.getDatasetFolder()
             tilename = os.path.splitext(self.activeviewer.image.name)[0]
-            new_dataset.export_tiles(basename=basename, tilename=tilename, labels_info=self.labels_dictionary)
+            if self.newDatasetWidget.getTilesFormat() == "Packed shards":
+                new_dataset.export_shards(basename=basename, tilename=tilename, labels_info=self.labels_dictionary)
+            else:
+                self.progress_bar.showPerc()
+                new_dataset.export_tiles(basename=basename, tilename=tilename, labels_info=self.labels_dictionary,
+                                         progress=self.exportTilesProgress)
 
             self.deleteProgressBar()
             self.deleteNewDatasetWidget()
@@ -2960,9 +3051,19 @@ class TagLab(QWidget):
             self.disableWorkingArea()
             QApplication.restoreOverrideCursor()
 
+    def exportTilesProgress(self, split_name, done, total):
+
+        self.progress_bar.setMessage("Export new dataset (" + split_name + " tiles).. ")
+        self.progress_bar.setProgress(100.0 * done / max(total, 1))
+        QApplication.processEvents()
+
     @pyqtSlot()
     def trainNewNetwork(self):
 
+        import models.training as training
+        from models.coral_dataset import CoralsDataset
+        from source.QtTrainingResultsWidget import QtTrainingResultsWidget
+
         dataset_folder = self.trainYourNetworkWidget.getDatasetFolder()
 
         # check dataset
@@ -2980,8 +3081,7 @@ class TagLab(QWidget):
         QApplication.processEvents()
 
         # CLASSES TO RECOGNIZE (label name - label code)
-        labels_folder = os.path.join(dataset_folder, "training")
-        labels_folder = os.path.join(labels_folder, "labels")
+        images_dir_train, labels_folder = training.datasetFolders(dataset_folder, "training")
         target_classes = CoralsDataset.importClassesFromDataset(labels_folder, self.labels_dictionary)
         num_classes = len(target_classes)
 
@@ -2996,13 +3096,8 @@ class TagLab(QWidget):
         network_filename = os.path.join(os.path.join(self.taglab_dir, "models"), network_name)
 
         # training folders
-        train_folder = os.path.join(dataset_folder, "training")
-        images_dir_train = os.path.join(train_folder, "images")
-        labels_dir_train = os.path.join(train_folder, "labels")
-
-        val_folder = os.path.join(dataset_folder, "validation")
-        images_dir_val = os.path.join(val_folder, "images")
-        labels_dir_val = os.path.join(val_folder, "labels")
+        images_dir_train, labels_dir_train = training.datasetFolders(dataset_folder, "training")
+        images_dir_val, labels_dir_val = training.datasetFolders(dataset_folder, "validation")
 
         dataset_train_info, train_loss_values, val_loss_values = training.trainingNetwork(images_dir_train, labels_dir_train,
                         images_dir_val, labels_dir_val,
@@ -3016,9 +3111,7 @@ class TagLab(QWidget):
 
         ##### TEST
 
-        test_folder = os.path.join(dataset_folder, "test")
-        images_dir_test = os.path.join(test_folder, "images")
-        labels_dir_test = os.path.join(test_folder, "labels")
+        images_dir_test, labels_dir_test = training.datasetFolders(dataset_folder, "test")
 
         output_folder = os.path.join(dataset_folder, "predictions")
         if os.path.exists(output_folder):
@@ -3101,12 +3194,26 @@ class TagLab(QWidget):
             box.exec()
             return
 
+        reply = QMessageBox.question(self, self.TAGLAB_VERSION, "Do you want to export one clipped raster for each colony?",
+                                     QMessageBox.Yes | QMessageBox.No)
+
+        import source.RasterOps as rasterops
+
+        blobs = self.activeviewer.annotations.seg_blobs
+        gf = self.activeviewer.image.georef_filename
+
+        if reply == QMessageBox.Yes:
+            output_folder = QFileDialog.getExistingDirectory(self, "Choose the folder where to save the rasters", self.taglab_dir)
+            if output_folder:
+                QApplication.setOverrideCursor(Qt.WaitCursor)
+                rasterops.saveClippedTiffPerBlob(input_tiff, blobs, gf, output_folder)
+                QApplication.restoreOverrideCursor()
+            return
+
         filters = " TIFF (*.tif)"
         output_filename, _ = QFileDialog.getSaveFileName(self, "Save raster as", self.taglab_dir, filters)
 
         if output_filename:
-            blobs = self.activeviewer.annotations.seg_blobs
-            gf = self.activeviewer.image.georef_filename
             rasterops.saveClippedTiff(input_tiff, blobs, gf, output_filename)
 
     @pyqtSlot()
@@ -3130,9 +3237,12 @@ class TagLab(QWidget):
             box.exec()
             return
 
+        import source.RasterOps as rasterops
+
         georef_filename = self.activeviewer.image.georef_filename
         blobs = self.activeviewer.annotations.seg_blobs
         rasterops.calculateAreaUsingSlope(input_tiff, blobs)
+        self.activeviewer.annotations.markDirty()
 
         QApplication.restoreOverrideCursor()
 
@@ -3147,14 +3257,22 @@ class TagLab(QWidget):
         QApplication.setOverrideCursor(Qt.WaitCursor)
         self.resetAll()
 
+        self.setupProgressBar()
+        self.progress_bar.setMessage("Loading project..")
+        QApplication.processEvents()
+
         try:
-            self.project = loadProject(self.taglab_dir, filename, self.labels_dictionary)
+            self.project = loadProject(self.taglab_dir, filename, self.labels_dictionary,
+                                       progress=self.loadProgress, workers=os.cpu_count())
         except Exception as e:
+            self.deleteProgressBar()
             msgBox = QMessageBox()
             msgBox.setText("The json project contains an error:\n {0}\n\nPlease contact us.".format(str(e)))
             msgBox.exec()
             return
 
+        self.deleteProgressBar()
+
         QApplication.restoreOverrideCursor()
         self.setProjectTitle(self.project.filename)
 
@@ -3177,6 +3295,11 @@ class TagLab(QWidget):
         logfile.info(message)
 
 
+    def loadProgress(self, bytes_read, size):
+
+        self.progress_bar.setProgress(100.0 * bytes_read / max(size, 1))
+        QApplication.processEvents()
+
     def append(self, filename):
         """
         Append the annotated images of a previously saved project to the current one.
@@ -3222,8 +3345,6 @@ class TagLab(QWidget):
     #REFACTOR networks should be moved to a new class
     def resetNetworks(self):
 
-        torch.cuda.empty_cache()
-
         if self.deepextreme_net is not None:
             del self.deepextreme_net
             self.deepextreme_net = None
@@ -3232,6 +3353,10 @@ class TagLab(QWidget):
             del self.classifier
             self.classifier = None
 
+        # the GPU memory is used only if a network has loaded torch
+        if "torch" in sys.modules:
+            sys.modules["torch"].cuda.empty_cache()
+
     @pyqtSlot()
     def selectClassifier(self):
         """
@@ -3292,6 +3417,7 @@ class TagLab(QWidget):
 
         QApplication.processEvents()
 
+        from source.MapClassifier import MapClassifier
         self.classifier = MapClassifier(classifier_selected, self.labels_dictionary)
         self.classifier.updateProgress.connect(self.progress_bar.setProgress)
 
@@ -3428,6 +3554,7 @@ class TagLab(QWidget):
             message = "[AUTOCLASS] Automatic classification STARTS.. (classifier: )" + classifier_selected['Classifier Name']
             logfile.info(message)
 
+            from source.MapClassifier import MapClassifier
             self.classifier = MapClassifier(classifier_selected, self.labels_dictionary)
             self.classifier.updateProgress.connect(self.progress_bar.setProgress)
 
@@ -3547,6 +3674,9 @@ if __name__ == '__main__':
     font = QFont('Roboto')
     app.setFont(font)
 
+    if import_timer is not None:
+        import_timer.mark("application created")
+
     # Create the inspection tool
     tool = TagLab()
 
@@ -3560,4 +3690,10 @@ if __name__ == '__main__':
 
     # Show the viewer and run the application.
     mw.show()
+
+    if import_timer is not None:
+        import_timer.mark("main window shown")
+        import_timer.uninstall()
+        import_timer.report()
+
     sys.exit(app.exec_())
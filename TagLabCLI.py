@@ -0,0 +1,476 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE COMMAND LINE INTERFACE OF TAGLAB (batch processing without the main window).
+#
+# Examples:
+#   python TagLabCLI.py classify project.json --image "Map 1" --classifier Pocillopora
+#   python TagLabCLI.py import-labels project.json --image "Map 1" --labelmap labels.png
+#   python TagLabCLI.py export-dataset project.json --image "Map 1" --output dataset --scale 1.0
+#   python TagLabCLI.py train dataset --name my_network --epochs 50
+#   python TagLabCLI.py test dataset --network models/my_network.net
+#   python TagLabCLI.py export-shapefile project.json --image "Map 1" --output map1.shp
+#   python TagLabCLI.py export-labelmap project.json --image "Map 1" --output map1.png
+#   python TagLabCLI.py match project.json --all --workers 8
+#
+# The paths are relative to the current directory. The commands run in the TagLab directory (the networks,
+# config.json and the temporary files are found there). The projects are saved in place unless --output is given.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+# the images are processed with Qt, without any window
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QGuiApplication
+
+TAGLAB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ConsoleProgress(object):
+    """
+    It prints the progress of the long operations (it replaces the progress bar of the main window).
+    """
+
+    def __init__(self):
+        self.message = ""
+        self.last = -1
+
+    def setMessage(self, message):
+        if message != self.message:
+            self.message = message
+            self.last = -1
+            print(message)
+
+    def setProgress(self, value):
+        value = int(value)
+        if value // 10 != self.last // 10:
+            self.last = value
+            print("{:s} {:d}%".format(self.message, value))
+
+    def hidePerc(self):
+        pass
+
+    def showPerc(self):
+        pass
+
+
+def readConfiguration():
+    """
+    It returns the available classifiers and the labels dictionary of config.json.
+    """
+
+    f = open(os.path.join(TAGLAB_DIR, "config.json"), "r")
+    config = json.load(f)
+    f.close()
+    return config["Available Classifiers"], config["Labels"]
+
+
+def openProject(filename, labels_dictionary):
+
+    from source.Project import loadProject
+
+    print("Loading " + filename + "..")
+    project = loadProject(TAGLAB_DIR, filename, labels_dictionary, workers=os.cpu_count())
+    project.importLabelsFromConfiguration(labels_dictionary)
+    return project
+
+
+def saveProject(project, output):
+
+    filename = project.filename if output is None else output
+    print("Saving " + filename + "..")
+    project.save(filename)
+
+
+def findImage(project, name):
+    """
+    It returns the image of the project with the given id or name (the first one if name is None).
+    """
+
+    if name is None:
+        if len(project.images) == 0:
+            raise Exception("The project does not contain any map.")
+        return project.images[0]
+
+    for image in project.images:
+        if image.id == name or image.name == name:
+            return image
+
+    raise Exception("The map " + name + " does not exist in the project.")
+
+
+def loadMap(image):
+
+    channel = image.getRGBChannel()
+    if channel is None:
+        raise Exception("The map " + image.name + " has no RGB channel.")
+    img_map = channel.loadData()
+    if img_map.isNull():
+        raise Exception("The file " + channel.filename + " cannot be read.")
+    return img_map
+
+
+def classify(args):
+
+    from source.MapClassifier import MapClassifier
+
+    classifiers, labels_dictionary = readConfiguration()
+    classifier_info = None
+    for classifier in classifiers:
+        if classifier["Classifier Name"] == args.classifier:
+            classifier_info = classifier
+    if classifier_info is None:
+        raise Exception("The classifier " + args.classifier + " is not available (see config.json).")
+
+    project = openProject(args.project, labels_dictionary)
+    image = findImage(project, args.image)
+    img_map = loadMap(image)
+
+    progress = ConsoleProgress()
+    progress.setMessage("Classification of " + image.name + ":")
+
+    classifier = MapClassifier(classifier_info, labels_dictionary)
+    classifier.updateProgress.connect(progress.setProgress)
+    classifier.setup(img_map, image.pixelSize(), classifier_info["Scale"], working_area=[], padding=256)
+    classifier.run(768, 512, 128)
+
+    filename = os.path.join("temp", "labelmap.png")
+    blobs = image.annotations.import_label_map(filename, labels_dictionary, img_map.width(), img_map.height())
+    for blob in blobs:
+        project.addBlob(image, blob)
+    print("{:d} regions created.".format(len(blobs)))
+
+    saveProject(project, args.output)
+
+
+def importLabels(args):
+
+    classifiers, labels_dictionary = readConfiguration()
+    project = openProject(args.project, labels_dictionary)
+    image = findImage(project, args.image)
+
+    # -1, -1 means that the label map imported must not be rescaled
+    blobs = image.annotations.import_label_map(args.labelmap, labels_dictionary, -1, -1)
+    for blob in blobs:
+        project.addBlob(image, blob)
+    print("{:d} regions imported.".format(len(blobs)))
+
+    saveProject(project, args.output)
+
+
+def exportDataset(args):
+
+    from source.NewDataset import NewDataset
+    import models.training as training
+
+    classifiers, labels_dictionary = readConfiguration()
+    project = openProject(args.project, labels_dictionary)
+    image = findImage(project, args.image)
+    img_map = loadMap(image)
+
+    progress = ConsoleProgress()
+    progress.setMessage("Export new dataset (setup)..")
+
+    new_dataset = NewDataset(img_map, image.annotations.seg_blobs, tile_size=1026, step=513)
+
+    target_classes = list(training.createTargetClasses(image.annotations).keys())
+    new_dataset.createLabels(target_classes, labels_dictionary)
+    new_dataset.computeFrequencies(target_classes)
+    new_dataset.workingAreaCropAndRescale(image.pixelSize(), args.scale, image.working_area)
+
+    progress.setMessage("Export new dataset (create train/val/test areas)..")
+    new_dataset.setupAreas(args.split.upper(), target_classes)
+
+    progress.setMessage("Export new dataset (cut tiles)..")
+    if args.oversampling:
+        class_to_sample, radii = new_dataset.computeRadii(target_classes)
+        new_dataset.cut_tiles(regular=False, oversampling=True, classes_to_sample=class_to_sample, radii=radii)
+    else:
+        new_dataset.cut_tiles(regular=True, oversampling=False, classes_to_sample=None, radii=None)
+
+    tilename = os.path.splitext(image.name)[0]
+    if args.format == "shards":
+        new_dataset.export_shards(basename=args.output, tilename=tilename, labels_info=labels_dictionary)
+    else:
+        def tilesProgress(split_name, done, total):
+            progress.setMessage("Export new dataset (" + split_name + " tiles)..")
+            progress.setProgress(100.0 * done / max(total, 1))
+
+        new_dataset.export_tiles(basename=args.output, tilename=tilename, labels_info=labels_dictionary,
+                                 progress=tilesProgress)
+
+
+def testDataset(dataset_folder, labels_dictionary, target_classes, dataset_train_info, network_filename, workers=0):
+    """
+    It tests the network on the test tiles of the dataset and returns the metrics (the predictions are
+    saved in the 'predictions' folder of the dataset).
+    """
+
+    import models.training as training
+
+    images_dir_test, labels_dir_test = training.datasetFolders(dataset_folder, "test")
+
+    output_folder = os.path.join(dataset_folder, "predictions")
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder, ignore_errors=True)
+    os.mkdir(output_folder)
+
+    print("Test network..")
+    return training.testNetwork(images_dir_test, labels_dir_test, dictionary=labels_dictionary,
+                                target_classes=target_classes, dataset_train=dataset_train_info,
+                                network_filename=network_filename, output_folder=output_folder,
+                                num_workers=workers)
+
+
+def datasetClasses(dataset_folder, labels_dictionary):
+
+    import models.training as training
+    from models.coral_dataset import CoralsDataset
+
+    if training.checkDataset(dataset_folder) == 1:
+        raise Exception("There is a mismatch between the files of the dataset " + dataset_folder + ".")
+
+    images_dir_train, labels_dir_train = training.datasetFolders(dataset_folder, "training")
+    return CoralsDataset.importClassesFromDataset(labels_dir_train, labels_dictionary)
+
+
+def train(args):
+
+    import models.training as training
+
+    classifiers, labels_dictionary = readConfiguration()
+    target_classes = datasetClasses(args.dataset, labels_dictionary)
+
+    network_filename = os.path.join(TAGLAB_DIR, "models", args.name + ".net")
+    classifier_name = args.name if args.classifier_name is None else args.classifier_name
+
+    images_dir_train, labels_dir_train = training.datasetFolders(args.dataset, "training")
+    images_dir_val, labels_dir_val = training.datasetFolders(args.dataset, "validation")
+
+    dataset_train_info, train_loss_values, val_loss_values = training.trainingNetwork(images_dir_train, labels_dir_train,
+                    images_dir_val, labels_dir_val,
+                    labels_dictionary, target_classes, len(target_classes),
+                    save_network_as=network_filename, classifier_name=classifier_name,
+                    epochs=args.epochs, batch_sz=args.batch_size, batch_mult=4, validation_frequency=2,
+                    loss_to_use="FOCAL_TVERSKY", epochs_switch=0, epochs_transition=0,
+                    learning_rate=args.lr, L2_penalty=args.weight_decay, tversky_alpha=0.6, tversky_gamma=0.75,
+                    optimiz="ADAM", flag_shuffle=True, flag_training_accuracy=False,
+                    progress=ConsoleProgress(), num_workers=args.workers)
+
+    metrics = testDataset(args.dataset, labels_dictionary, target_classes, dataset_train_info, network_filename, args.workers)
+    print(metrics)
+
+    # the description of the classifier, to add to the available classifiers of config.json
+    new_classifier = dict()
+    new_classifier["Classifier Name"] = classifier_name
+    new_classifier["Average Norm."] = list(dataset_train_info.dataset_average)
+    new_classifier["Num. Classes"] = dataset_train_info.num_classes
+    new_classifier["Classes"] = list(dataset_train_info.dict_target)
+    new_classifier["Scale"] = args.scale
+    new_classifier["Weights"] = os.path.join("models", args.name + ".net")
+
+    f = open(network_filename.replace(".net", "-classifier.json"), "w")
+    f.write(json.dumps(new_classifier, indent=1))
+    f.close()
+
+
+def test(args):
+
+    from models.coral_dataset import CoralsDataset
+    import models.training as training
+
+    classifiers, labels_dictionary = readConfiguration()
+    target_classes = datasetClasses(args.dataset, labels_dictionary)
+
+    # the normalization and the classes of the network are the ones of its training dataset
+    images_dir_train, labels_dir_train = training.datasetFolders(args.dataset, "training")
+    dataset_train_info = CoralsDataset(images_dir_train, labels_dir_train, labels_dictionary, target_classes)
+    dataset_train_info.computeAverage()
+    dataset_train_info.computeWeights()
+
+    metrics = testDataset(args.dataset, labels_dictionary, target_classes, dataset_train_info, args.network)
+    print(metrics)
+
+
+def exportShapefile(args):
+
+    import source.RasterOps as rasterops
+
+    classifiers, labels_dictionary = readConfiguration()
+    project = openProject(args.project, labels_dictionary)
+    image = findImage(project, args.image)
+
+    if image.georef_filename == "":
+        raise Exception("Georeference information are not available for the map " + image.name + ".")
+
+    blobs = image.annotations.seg_blobs
+    if args.output.lower().endswith(".gpkg"):
+        rasterops.write_geopackage(blobs, image.georef_filename, args.output)
+    else:
+        rasterops.write_shapefile(blobs, image.georef_filename, args.output)
+
+
+def exportLabelMap(args):
+
+    classifiers, labels_dictionary = readConfiguration()
+    project = openProject(args.project, labels_dictionary)
+    image = findImage(project, args.image)
+
+    size = QSize(image.width, image.height)
+    annotations = image.annotations
+
+    if args.output.lower().endswith(".tif") or args.output.lower().endswith(".tiff"):
+
+        import source.RasterOps as rasterops
+
+        if image.georef_filename == "":
+            raise Exception("Georeference information are not available for the map " + image.name + ".")
+
+        palette, class_index = annotations.labelMapPalette(labels_dictionary)
+        label_strips = annotations.labelMapStrips(size, labels_dictionary)
+        # the overviews are useful only for big maps
+        build_overviews = max(size.width(), size.height()) > 8192
+        rasterops.saveTiledGeorefLabelMap(label_strips, palette, image.georef_filename,
+                                          os.path.splitext(args.output)[0], build_overviews)
+    else:
+        annotations.export_image_data_for_Scripps(size, args.output, labels_dictionary)
+
+
+def match(args):
+
+    classifiers, labels_dictionary = readConfiguration()
+    project = openProject(args.project, labels_dictionary)
+
+    if args.all:
+        def matchProgress(pairs, total):
+            print("Matched {:d}/{:d} pairs".format(pairs, total))
+
+        report = project.computeAllCorrespondences(workers=args.workers, progress=matchProgress)
+    else:
+        source = project.images.index(findImage(project, args.source))
+        target = project.images.index(findImage(project, args.target))
+        start = time.perf_counter()
+        project.computeCorrespondences(source, target)
+        corr = project.getImagePairCorrespondences(source, target)
+        report = [(corr.source.id + "-" + corr.target.id, time.perf_counter() - start, len(corr.data.index))]
+
+    for key, seconds, count in report:
+        print("Matches {:s}: {:d} in {:.1f} s".format(key, count, seconds))
+
+    saveProject(project, args.output)
+
+
+def parseArguments(argv):
+
+    parser = argparse.ArgumentParser(prog="TagLabCLI", description="TagLab batch processing (without the main window).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def projectCommand(name, function, help, output=True):
+        command = subparsers.add_parser(name, help=help)
+        command.add_argument("project", help="the project file (json or binary)")
+        command.add_argument("--image", default=None, help="id or name of the map (default: the first one)")
+        if output:
+            command.add_argument("--output", default=None, help="save the project in another file")
+        command.set_defaults(function=function, paths=["project", "output"])
+        return command
+
+    command = projectCommand("classify", classify, "classify a map with one of the available classifiers")
+    command.add_argument("--classifier", required=True, help="name of the classifier (see config.json)")
+
+    command = projectCommand("import-labels", importLabels, "import a label map in a map")
+    command.add_argument("--labelmap", required=True, help="the label map (png or jpg)")
+    command.set_defaults(paths=["project", "output", "labelmap"])
+
+    command = projectCommand("export-dataset", exportDataset, "export the training dataset of a map", output=False)
+    command.add_argument("--output", required=True, help="the dataset folder")
+    command.add_argument("--scale", type=float, default=1.0, help="target scale (pixel size in mm)")
+    command.add_argument("--split", default="Uniform (vertical)",
+                         choices=["Uniform (vertical)", "Uniform (horizontal)", "Random", "Biologically-inspired"])
+    command.add_argument("--oversampling", action="store_true")
+    command.add_argument("--format", default="png", choices=["png", "shards"])
+
+    command = subparsers.add_parser("train", help="train a new network on an exported dataset (and test it)")
+    command.add_argument("dataset", help="the dataset folder")
+    command.add_argument("--name", required=True, help="name of the network file (saved in the models folder)")
+    command.add_argument("--classifier-name", default=None)
+    command.add_argument("--epochs", type=int, default=50)
+    command.add_argument("--lr", type=float, default=0.00005)
+    command.add_argument("--weight-decay", type=float, default=0.0005)
+    command.add_argument("--batch-size", type=int, default=4)
+    command.add_argument("--scale", type=float, default=1.0, help="pixel size (in mm) of the dataset")
+    command.add_argument("--workers", type=int, default=0, help="number of data loading processes")
+    command.set_defaults(function=train, paths=["dataset"])
+
+    command = subparsers.add_parser("test", help="test a network on the test tiles of a dataset")
+    command.add_argument("dataset", help="the dataset folder")
+    command.add_argument("--network", required=True, help="the network file (.net)")
+    command.set_defaults(function=test, paths=["dataset", "network"])
+
+    command = projectCommand("export-shapefile", exportShapefile, "export the regions of a georeferenced map", output=False)
+    command.add_argument("--output", required=True, help="the shapefile (.shp) or geopackage (.gpkg)")
+
+    command = projectCommand("export-labelmap", exportLabelMap, "export the label map of a map", output=False)
+    command.add_argument("--output", required=True, help="the label map (.png, or a georeferenced .tif)")
+
+    command = projectCommand("match", match, "compute the correspondences between the maps")
+    command.add_argument("--all", action="store_true", help="match all the consecutive maps")
+    command.add_argument("--source", default=None, help="id or name of the source map")
+    command.add_argument("--target", default=None, help="id or name of the target map")
+    command.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "match" and not args.all and (args.source is None or args.target is None):
+        parser.error("match requires --all, or --source and --target")
+
+    # the paths are given relative to the current directory
+    for name in args.paths:
+        value = getattr(args, name, None)
+        if value is not None:
+            setattr(args, name, os.path.abspath(value))
+
+    return args
+
+
+def main(argv):
+
+    args = parseArguments(argv)
+
+    # the images need a Qt application, no window is created
+    app = QGuiApplication([sys.argv[0]])
+
+    os.chdir(TAGLAB_DIR)
+
+    try:
+        args.function(args)
+    except Exception as e:
+        print("Error: " + str(e), file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,101 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS A BENCHMARK OF THE EDITING OF A LARGE CORRESPONDENCE TABLE.
+#
+# Usage: python benchmark_correspondences.py [number of correspondences] [number of edits]
+
+import sys
+import time
+import random
+
+from source.Blob import Blob
+from source.Image import Image
+from source.Correspondences import Correspondences
+
+
+def makeBlobs(n):
+
+    blobs = []
+    for i in range(n):
+        blob = Blob(None, 0, 0, 0)
+        blob.id = i + 1
+        blob.class_name = "Pocillopora"
+        blob.bbox = [(i // 100) * 20, (i % 100) * 20, 10, 10]
+        blob.centroid = [blob.bbox[1] + 5.0, blob.bbox[0] + 5.0]
+        blob.area = 100.0
+        blob.perimeter = 40.0
+        blob.contour = [[blob.bbox[1], blob.bbox[0]], [blob.bbox[1] + 10, blob.bbox[0]],
+                        [blob.bbox[1] + 10, blob.bbox[0] + 10], [blob.bbox[1], blob.bbox[0] + 10]]
+        blobs.append(blob)
+
+    return blobs
+
+
+def measure(name, function):
+
+    start = time.perf_counter()
+    function()
+    print("{:<40s} {:8.3f} s".format(name, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    EDITS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    random.seed(0)
+
+    source = Image(id="source")
+    target = Image(id="target")
+    source.annotations.addBlobs(makeBlobs(N))
+    target.annotations.addBlobs(makeBlobs(N))
+
+    correspondences = Correspondences(source, target)
+    table = [[i + 1, i + 1, 1.0, 1.0, "Pocillopora", "same", "none"] for i in range(N)]
+
+    print("{:d} correspondences, {:d} edits".format(N, EDITS))
+
+    measure("fillTable", lambda: correspondences.fillTable(table))
+
+    def edit():
+        for i in range(EDITS):
+            sources = random.sample(source.annotations.seg_blobs, 2)
+            correspondences.set(sources, [target.annotations.seg_blobs[random.randrange(N)]])
+
+    measure("set (fuse of two blobs)", edit)
+
+    def delete():
+        for i in range(EDITS):
+            correspondences.deleteCluster([random.randrange(len(correspondences.data.index))])
+
+    measure("deleteCluster", delete)
+
+    def match():
+        correspondences.correspondences = [list(row) for row in table]
+        for i in range(0, N, 10):
+            correspondences.correspondences.append([i + 1, (i + 2) % N + 1, 1.0, 1.0, "Pocillopora", "same", "none"])
+        correspondences.dead = []
+        correspondences.born = []
+        correspondences.assignSplit()
+        correspondences.assignFuse()
+        correspondences.assignDead(source.annotations.seg_blobs)
+        correspondences.assignBorn(target.annotations.seg_blobs)
+
+    measure("assignSplit/Fuse/Dead/Born", match)
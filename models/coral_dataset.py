@@ -8,6 +8,7 @@ import torch
 from torch.utils.data import Dataset
 from torchvision import transforms
 import glob
+from models.dataset_shard import isShard, ShardReader
 from albumentations import (CLAHE, HueSaturationValue, RGBShift, RandomBrightnessContrast, Compose)
 
 
@@ -30,8 +31,8 @@ class CoralsDataset(Dataset):
 
     def __init__(self, input_images_dir, input_labels_dir, dictionary, target_class):
         """
-        :param input_images_dir: folder containing the images
-        :param input_labels_dir: folder containing the labels
+        :param input_images_dir: folder containing the images (or the folder of a packed shard)
+        :param input_labels_dir: folder containing the labels (ignored for a packed shard)
         :param dictionary: class-color dictionary
         :param target_classes: a dictionary containing the class under investigation
         """
@@ -39,7 +40,15 @@ class CoralsDataset(Dataset):
         # IMAGES AND LABELS HAVE SAME NAMES BUT DIFFERENT DIRECTORIES
         self.images_dir = input_images_dir
         self.labels_dir = input_labels_dir
-        self.images_names = [os.path.basename(x) for x in glob.glob(os.path.join(input_images_dir, '*.png'))]
+
+        # PACKED SHARD (see models/dataset_shard.py)
+        self.shard = None
+        if isShard(input_images_dir):
+            self.shard = ShardReader(input_images_dir)
+            self.images_names = list(self.shard.names)
+        else:
+            self.images_names = [os.path.basename(x) for x in glob.glob(os.path.join(input_images_dir, '*.png'))]
+
         self.dict_colors = dictionary
         self.dict_target = target_class
         self.num_classes = len(target_class)
@@ -75,6 +84,12 @@ class CoralsDataset(Dataset):
         self.weights = None
         self.dataset_average = np.zeros(3, dtype=float)
 
+        # DECODED TILES CACHE (memory-mapped, see createCache())
+        self.cache_images_filename = None
+        self.cache_labels_filename = None
+        self.cache_images = None
+        self.cache_labels = None
+
 
     def augmentationSettings(self, range_T, range_R, range_scale, crop_size, augmentation_flip=True):
         """
@@ -147,6 +162,135 @@ class CoralsDataset(Dataset):
 
         return image_tensor
 
+    def createCache(self, cache_folder):
+        """
+        Decode all the tiles once and store them in two memory-mapped files: the images as uint8 RGB and
+        the labels already converted to class indices. The following epochs read the tiles from the cache,
+        skipping the PNG decoding and the color-to-label conversion. The memory-mapped files are shared by
+        the DataLoader workers. The cache must be created after the target classes are finalized
+        (i.e. after computeWeights()). If the tiles do not have the same size the cache is not created.
+
+        :param cache_folder: folder where the cache files are stored
+        :return: True if the cache has been created, False otherwise
+        """
+
+        N = len(self.images_names)
+        if N == 0:
+            return False
+
+        # the tiles of a shard are already decoded and memory-mapped
+        if self.shard is not None:
+            return False
+
+        img = PILimage.open(os.path.join(self.images_dir, self.images_names[0]))
+        w, h = img.size
+        for image_name in self.images_names:
+            img = PILimage.open(os.path.join(self.images_dir, image_name))
+            if img.size != (w, h):
+                print("Tiles of different sizes, the cache is not created.")
+                return False
+
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+        images_filename = os.path.join(cache_folder, "images.npy")
+        labels_filename = os.path.join(cache_folder, "labels.npy")
+        cache_images = np.lib.format.open_memmap(images_filename, mode='w+', dtype=np.uint8, shape=(N, h, w, 3))
+        cache_labels = np.lib.format.open_memmap(labels_filename, mode='w+', dtype=np.uint8, shape=(N, h, w))
+
+        print(" ")
+        for i, image_name in enumerate(self.images_names):
+
+            img = PILimage.open(os.path.join(self.images_dir, image_name))
+            cache_images[i] = np.array(img.convert("RGB"))
+
+            # the labels are stored as (class index + 1), 0 is left for the pixels
+            # outside the tile after the geometric augmentation (see labelCodesToLongTensor)
+            imglbl = PILimage.open(os.path.join(self.labels_dir, image_name))
+            labels = self.colorsToLabels(np.array(imglbl.convert("RGB")))
+            cache_labels[i] = (labels + 1).astype(np.uint8)
+
+            sys.stdout.write("\rCreating cache... %.2f" % ((i * 100.0) / float(N)))
+
+        cache_images.flush()
+        cache_labels.flush()
+        del cache_images
+        del cache_labels
+
+        self.cache_images_filename = images_filename
+        self.cache_labels_filename = labels_filename
+        self.cache_images = None
+        self.cache_labels = None
+
+        return True
+
+    def __getstate__(self):
+
+        # the memory-mapped files are re-opened by each worker
+        state = self.__dict__.copy()
+        state['cache_images'] = None
+        state['cache_labels'] = None
+        return state
+
+    def shardCodes(self):
+        """
+        It returns the look-up table converting the class indices stored in the shard to
+        the label codes (class index + 1). The classes not in the target classes become background.
+        """
+
+        lut = np.zeros(256, dtype=np.uint8)
+        lut[:] = self.dict_target['Background'] + 1
+        for i, class_name in enumerate(self.shard.classes):
+            if class_name in self.dict_target:
+                lut[i] = self.dict_target[class_name] + 1
+
+        return lut
+
+    def loadSample(self, idx):
+        """
+        It returns the idx-th image and its label as PIL images. The label is a color image if the tile
+        is read from the disk, or an image of label codes if it is read from the cache or from a shard.
+        """
+
+        if self.shard is not None:
+
+            img = PILimage.fromarray(self.shard.image(idx))
+            imglbl = PILimage.fromarray(self.shardCodes()[self.shard.label(idx)])
+
+            return img, imglbl, True
+
+        if self.cache_images_filename is not None:
+
+            if self.cache_images is None:
+                self.cache_images = np.load(self.cache_images_filename, mmap_mode='r')
+                self.cache_labels = np.load(self.cache_labels_filename, mmap_mode='r')
+
+            img = PILimage.fromarray(np.array(self.cache_images[idx]))
+            imglbl = PILimage.fromarray(np.array(self.cache_labels[idx]))
+
+            return img, imglbl, True
+
+        img_filename = os.path.join(self.images_dir, self.images_names[idx])
+        label_filename = os.path.join(self.labels_dir, self.images_names[idx])
+        img = PILimage.open(img_filename)
+        imglbl = PILimage.open(label_filename)
+
+        return img, imglbl, False
+
+    def loadLabels(self, idx):
+        """
+        It returns the class labels of the idx-th tile as a numpy array.
+        """
+
+        img, imglbl, from_cache = self.loadSample(idx)
+
+        if from_cache:
+            lut = np.arange(-1, 255, dtype='int64')
+            lut[0] = self.dict_target['Background']
+            return lut[np.array(imglbl)]
+
+        return self.colorsToLabels(np.array(imglbl))
+
     def __len__(self):
         return len(self.images_names)
 
@@ -155,10 +299,7 @@ class CoralsDataset(Dataset):
         # sample name
         sample_name = self.images_names[idx]
 
-        img_filename = os.path.join(self.images_dir, self.images_names[idx])
-        label_filename = os.path.join(self.labels_dir, self.images_names[idx])
-        img = PILimage.open(img_filename)
-        imglbl = PILimage.open(label_filename)
+        img, imglbl, from_cache = self.loadSample(idx)
 
         # APPLY DATA AUGMENTATION
         if self.flagDataAugmentation:
@@ -223,11 +364,17 @@ class CoralsDataset(Dataset):
             # normalize directly the Pytorch tensor
             img_tensor = self.normalizeInputImage(img_tensor)
 
-            # PIL image -> Pytorch tensor
-            imglbl_tensor = transforms.functional.to_tensor(imglbl_augmented)
+            # PIL image -> Pytorch tensor (the label codes are converted back to colors)
+            if from_cache:
+                imglbl_tensor = transforms.functional.to_tensor(self.labelCodesToColors(imglbl_augmented))
+            else:
+                imglbl_tensor = transforms.functional.to_tensor(imglbl_augmented)
 
             # create labels: from PIL image to Pytorch tensor
-            labels_tensor = self.imageLabelToLongTensor(imglbl_augmented)
+            if from_cache:
+                labels_tensor = self.labelCodesToLongTensor(imglbl_augmented)
+            else:
+                labels_tensor = self.imageLabelToLongTensor(imglbl_augmented)
 
         else:
 
@@ -236,11 +383,17 @@ class CoralsDataset(Dataset):
             # normalize directly the Pytorch tensor
             img_tensor = self.normalizeInputImage(img_tensor)
 
-            # PIL image -> Pytorch tensor
-            imglbl_tensor = transforms.functional.to_tensor(imglbl)
+            # PIL image -> Pytorch tensor (the label codes are converted back to colors)
+            if from_cache:
+                imglbl_tensor = transforms.functional.to_tensor(self.labelCodesToColors(imglbl))
+            else:
+                imglbl_tensor = transforms.functional.to_tensor(imglbl)
 
             # create labels: from PIL image to Pytorch tensor
-            labels_tensor = self.imageLabelToLongTensor(imglbl)
+            if from_cache:
+                labels_tensor = self.labelCodesToLongTensor(imglbl)
+            else:
+                labels_tensor = self.imageLabelToLongTensor(imglbl)
 
         # image labels saves the label as image for check purposes
         sample = {'image': img_tensor, 'image_label': imglbl_tensor, 'labels': labels_tensor, 'name': sample_name}
@@ -255,6 +408,10 @@ class CoralsDataset(Dataset):
         dict_classes = {}
 
         CROP_SIZE = 513
+
+        if isShard(labels_folder):
+            return CoralsDataset.importClassesFromShard(labels_folder, labels_dictionary, CROP_SIZE)
+
         labels_names = [os.path.basename(x) for x in glob.glob(os.path.join(labels_folder, '*.png'))]
 
         existing_color_codes = set([0])
@@ -288,6 +445,35 @@ class CoralsDataset(Dataset):
 
         return dict_classes
 
+    @staticmethod
+    def importClassesFromShard(shard_folder, labels_dictionary, crop_size):
+        """
+        Same as importClassesFromDataset() for a packed shard.
+        """
+
+        shard = ShardReader(shard_folder)
+
+        existing_indices = set()
+        for i in range(len(shard)):
+            data = shard.label(i)
+            w = data.shape[1]
+            h = data.shape[0]
+            ox = int((w - crop_size) / 2)
+            oy = int((h - crop_size) / 2)
+            data_crop = data[oy:oy + crop_size, ox:ox + crop_size]
+            existing_indices.update(list(np.unique(data_crop)))
+
+        dict_classes = {}
+        dict_classes["Background"] = 0
+        class_code = 1
+        for index in sorted(existing_indices):
+            key = shard.classes[index]
+            if key in labels_dictionary and dict_classes.get(key) is None:
+                dict_classes[key] = class_code
+                class_code += 1
+
+        return dict_classes
+
     def computeWeights(self):
         """
         Compute the weights of the target classes as the inverse of their frequencies.
@@ -299,16 +485,13 @@ class CoralsDataset(Dataset):
         print(" ")
         for i, image_name in enumerate(self.images_names):
 
-            label_filename = os.path.join(self.labels_dir, image_name)
-            imglbl = PILimage.open(label_filename)
-            data = np.array(imglbl)
+            data = self.loadLabels(i)
             w = data.shape[1]
             h = data.shape[0]
             ox = int((w - self.CROP_SIZE) / 2)
             oy = int((h - self.CROP_SIZE) / 2)
-            data_crop = data[oy:oy + self.CROP_SIZE, ox:ox + self.CROP_SIZE]
+            labels = data[oy:oy + self.CROP_SIZE, ox:ox + self.CROP_SIZE]
 
-            labels = self.colorsToLabels(data_crop)
             existing_labels, counts = np.unique(labels, return_counts=True)
 
             for j in range(len(existing_labels)):
@@ -352,8 +535,7 @@ class CoralsDataset(Dataset):
         print(" ")
         for i, image_name in enumerate(self.images_names):
 
-            img_filename = os.path.join(self.images_dir, image_name)
-            img = PILimage.open(img_filename)
+            img, imglbl, from_cache = self.loadSample(i)
             data = np.array(img, dtype=np.float)
             w = data.shape[1]
             h = data.shape[0]
@@ -412,6 +594,41 @@ class CoralsDataset(Dataset):
         return labels_t
 
 
+    def labelCodesToLongTensor(self, image_codes):
+        """
+        It converts an image of label codes (class index + 1, see createCache) to a Pytorch Long Tensor
+        containing the class labels. The code 0 (pixels outside the tile) becomes the background.
+
+        :param image_codes: input image is a PIL image
+        :return: Pytorch Long Tensor
+        """
+
+        lut = np.arange(-1, 255, dtype='int64')
+        lut[0] = self.dict_target['Background']
+
+        labelsint = lut[np.array(image_codes)]
+        labels_t = torch.from_numpy(labelsint)
+
+        return labels_t
+
+    def labelCodesToColors(self, image_codes):
+        """
+        It converts an image of label codes (class index + 1, see createCache) to the RGB image label,
+        using the colors of the target classes. The code 0 (pixels outside the tile) becomes the background.
+
+        :param image_codes: input image is a PIL image
+        :return: PIL image
+        """
+
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        palette[0] = self.dict_colors['Background']
+        for key in self.dict_target.keys():
+            palette[self.dict_target[key] + 1] = self.dict_colors[key]
+        palette[self.dict_target['Background'] + 1] = self.dict_colors['Background']
+
+        return PILimage.fromarray(palette[np.array(image_codes)])
+
+
     def show(self, i):
         """
         It shows the i-th sample of the dataset.
@@ -0,0 +1,174 @@
+import os
+import json
+import numpy as np
+
+# PACKED DATASET SHARD
+#
+# A split of the dataset (training, validation or test) is stored as a folder containing:
+#
+#   index.json  : the description of the shard (tiles names, tile size, classes)
+#   images.npy  : the RGB tiles, uint8 array of shape (N, tile_size, tile_size, 3)
+#   labels.npy  : the labels of the tiles, uint8 array of shape (N, tile_size, tile_size)
+#
+# The values stored in the labels are indices in the list of classes of the index file.
+# Both the arrays are memory-mapped, so each tile can be read with random access.
+
+SHARD_INDEX = "index.json"
+SHARD_IMAGES = "images.npy"
+SHARD_LABELS = "labels.npy"
+SHARD_FORMAT = "TagLab tiles shard"
+SHARD_VERSION = 1
+
+
+def isShard(folder):
+    """
+    It returns True if the given folder contains a packed dataset shard.
+    """
+
+    return os.path.exists(os.path.join(folder, SHARD_INDEX))
+
+
+def colorsToIndices(rgb, colors):
+    """
+    Convert an RGB array (H x W x 3) to the indices of the given list of colors.
+    The colors that are not in the list are converted to 0.
+    """
+
+    rgb = rgb.astype(np.int32)
+    codes = rgb[:, :, 0] + (rgb[:, :, 1] << 8) + (rgb[:, :, 2] << 16)
+
+    color_codes = np.array([c[0] + (c[1] << 8) + (c[2] << 16) for c in colors], dtype=np.int32)
+    order = np.argsort(color_codes, kind='stable')
+    sorted_codes = color_codes[order]
+
+    pos = np.searchsorted(sorted_codes, codes)
+    pos[pos >= len(sorted_codes)] = 0
+    found = sorted_codes[pos] == codes
+
+    indices = np.zeros(codes.shape, dtype=np.uint8)
+    indices[found] = order[pos[found]]
+
+    return indices
+
+
+class ShardWriter(object):
+    """
+    It writes the tiles of a split of the dataset into a packed shard.
+    """
+
+    def __init__(self, folder, count, tile_size, classes, colors):
+        """
+        :param folder: output folder of the shard
+        :param count: number of tiles
+        :param tile_size: size of the (square) tiles
+        :param classes: list of the class names, the label values are indices in this list
+        :param colors: list of the colors of the classes
+        """
+
+        if len(classes) > 256:
+            raise Exception("A shard can store at most 256 classes.")
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.folder = folder
+        self.count = count
+        self.tile_size = tile_size
+        self.classes = list(classes)
+        self.colors = [list(map(int, c)) for c in colors]
+        self.names = [""] * count
+
+        # numpy does not allow to memory-map an empty array
+        n = max(count, 1)
+        self.images = np.lib.format.open_memmap(os.path.join(folder, SHARD_IMAGES), mode='w+',
+                                                dtype=np.uint8, shape=(n, tile_size, tile_size, 3))
+        self.labels = np.lib.format.open_memmap(os.path.join(folder, SHARD_LABELS), mode='w+',
+                                                dtype=np.uint8, shape=(n, tile_size, tile_size))
+
+    def write(self, i, name, image, labels):
+        """
+        Store the i-th tile: image is an RGB uint8 array, labels contains the class indices.
+        """
+
+        self.names[i] = name
+        self.images[i] = image
+        self.labels[i] = labels
+
+    def close(self):
+
+        self.images.flush()
+        self.labels.flush()
+        self.images = None
+        self.labels = None
+
+        index = {
+            "format": SHARD_FORMAT,
+            "version": SHARD_VERSION,
+            "count": self.count,
+            "tile size": self.tile_size,
+            "names": self.names,
+            "classes": self.classes,
+            "colors": self.colors
+        }
+
+        f = open(os.path.join(self.folder, SHARD_INDEX), "w")
+        json.dump(index, f)
+        f.close()
+
+
+class ShardReader(object):
+    """
+    It reads the tiles of a packed shard. The arrays are memory-mapped the first time a tile is read,
+    so the reader can be safely passed to the DataLoader workers.
+    """
+
+    def __init__(self, folder):
+
+        f = open(os.path.join(folder, SHARD_INDEX), "r")
+        index = json.load(f)
+        f.close()
+
+        if index.get("format") != SHARD_FORMAT:
+            raise Exception("The folder " + folder + " does not contain a valid dataset shard.")
+
+        self.folder = folder
+        self.count = index["count"]
+        self.tile_size = index["tile size"]
+        self.names = index["names"]
+        self.classes = index["classes"]
+        self.colors = index["colors"]
+
+        self.images = None
+        self.labels = None
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['labels'] = None
+        return state
+
+    def open(self):
+
+        if self.images is None:
+            self.images = np.load(os.path.join(self.folder, SHARD_IMAGES), mmap_mode='r')
+            self.labels = np.load(os.path.join(self.folder, SHARD_LABELS), mmap_mode='r')
+
+    def image(self, i):
+        """
+        It returns the i-th RGB tile.
+        """
+
+        self.open()
+        return np.array(self.images[i])
+
+    def label(self, i):
+        """
+        It returns the class indices of the i-th tile.
+        """
+
+        self.open()
+        return np.array(self.labels[i])
@@ -10,6 +10,7 @@ from models.deeplab import DeepLab
 from sklearn.metrics import jaccard_score
 from sklearn.metrics import confusion_matrix
 from models.coral_dataset import CoralsDataset
+from models.dataset_shard import isShard
 import models.losses as losses
 from PyQt5.QtWidgets import QApplication
 
@@ -20,6 +21,14 @@ torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
 
+def seedWorker(worker_id):
+    """
+    Seed NumPy in each DataLoader worker, otherwise all the workers apply the same random augmentations.
+    """
+
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
 def checkDataset(dataset_folder):
     """
     Check if the training, validation and test folders exist and contain the corresponding images and labels.
@@ -29,7 +38,9 @@ def checkDataset(dataset_folder):
     if os.path.exists(dataset_folder) and os.listdir(dataset_folder) == ['test', 'training', 'validation']:
        for sub in os.listdir(dataset_folder):
            subfolder = os.path.join(dataset_folder, sub)
-           if os.listdir(subfolder) == ['images', 'labels'] and len(set(os.listdir(os.path.join(subfolder, os.listdir(subfolder)[0]))) - set(os.listdir(os.path.join(subfolder, os.listdir(subfolder)[1]))))==0:
+           if isShard(subfolder):
+               flag = 0 # packed shard
+           elif os.listdir(subfolder) == ['images', 'labels'] and len(set(os.listdir(os.path.join(subfolder, os.listdir(subfolder)[0]))) - set(os.listdir(os.path.join(subfolder, os.listdir(subfolder)[1]))))==0:
                flag = 0 # Your training dataset is valid
            else:
                return 1 # A subfolder is missing or a files mismatch in subfolder
@@ -38,6 +49,18 @@ def checkDataset(dataset_folder):
 
     return flag
 
+def datasetFolders(dataset_folder, split):
+    """
+    It returns the images and the labels folders of a split (training, validation or test) of the dataset.
+    In the case of a packed shard both the folders are the shard folder.
+    """
+
+    split_folder = os.path.join(dataset_folder, split)
+    if isShard(split_folder):
+        return split_folder, split_folder
+
+    return os.path.join(split_folder, "images"), os.path.join(split_folder, "labels")
+
 def createTargetClasses(annotations):
     """
     Create the label name - label code correspondences for the classifier.
@@ -226,7 +249,12 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
                     dictionary, target_classes, output_classes, save_network_as, classifier_name,
                     epochs, batch_sz, batch_mult, learning_rate, L2_penalty, validation_frequency, loss_to_use,
                     epochs_switch, epochs_transition, tversky_alpha, tversky_gamma, optimiz,
-                    flag_shuffle, flag_training_accuracy, progress):
+                    flag_shuffle, flag_training_accuracy, progress, num_workers=0, cache_folder=None):
+    """
+    Train the network on the given dataset.
+    :param num_workers: number of DataLoader worker processes (0 means the data is loaded in the main process)
+    :param cache_folder: if a folder is given the decoded tiles are cached into it (see CoralsDataset.createCache)
+    """
 
     ##### DATA #####
 
@@ -253,13 +281,17 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
     #AUGUMENTATION IS NOT APPLIED ON THE VALIDATION SET
     datasetVal.disableAugumentation()
 
+    if cache_folder is not None:
+        datasetTrain.createCache(os.path.join(cache_folder, "training"))
+        datasetVal.createCache(os.path.join(cache_folder, "validation"))
+
     # setup the data loader
-    dataloaderTrain = DataLoader(datasetTrain, batch_size=batch_sz, shuffle=flag_shuffle, num_workers=0, drop_last=True,
-                                 pin_memory=True)
+    dataloaderTrain = DataLoader(datasetTrain, batch_size=batch_sz, shuffle=flag_shuffle, num_workers=num_workers,
+                                 drop_last=True, pin_memory=True, worker_init_fn=seedWorker)
 
     validation_batch_size = 4
-    dataloaderVal = DataLoader(datasetVal, batch_size=validation_batch_size, shuffle=False, num_workers=0, drop_last=True,
-                                 pin_memory=True)
+    dataloaderVal = DataLoader(datasetVal, batch_size=validation_batch_size, shuffle=False, num_workers=num_workers,
+                               drop_last=True, pin_memory=True, worker_init_fn=seedWorker)
 
     training_images_number = len(datasetTrain.images_names)
     validation_images_number = len(datasetVal.images_names)
@@ -423,10 +455,12 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
 
 
 def testNetwork(images_folder, labels_folder, dictionary, target_classes, dataset_train,
-                network_filename, output_folder):
+                network_filename, output_folder, num_workers=0, cache_folder=None):
     """
     Load a network and test it on the test dataset.
     :param network_filename: Full name of the network to load (PATH+name)
+    :param num_workers: number of DataLoader worker processes (0 means the data is loaded in the main process)
+    :param cache_folder: if a folder is given the decoded tiles are cached into it (see CoralsDataset.createCache)
     """
 
     # TEST DATASET
@@ -440,9 +474,12 @@ def testNetwork(images_folder, labels_folder, dictionary, target_classes, datase
 
     output_classes = dataset_train.num_classes
 
+    if cache_folder is not None:
+        datasetTest.createCache(os.path.join(cache_folder, "test"))
+
     batchSize = 4
-    dataloaderTest = DataLoader(datasetTest, batch_size=batchSize, shuffle=False, num_workers=0, drop_last=True,
-                            pin_memory=True)
+    dataloaderTest = DataLoader(datasetTest, batch_size=batchSize, shuffle=False, num_workers=num_workers,
+                                drop_last=True, pin_memory=True, worker_init_fn=seedWorker)
 
     # DEEPLAB V3+
     net = DeepLab(backbone='resnet', output_stride=16, num_classes=output_classes)
@@ -38,6 +38,7 @@ from scipy import ndimage as ndi
 from skimage.morphology import watershed, flood, binary_dilation, binary_erosion
 from skimage.filters import gaussian
 from source.Blob import Blob
+from source.BlobStore import BlobStore
 import source.Mask as Mask
 
 #refactor: remove groups
@@ -76,7 +77,7 @@ class Group(object):
 
         # update instance name for each blob
         for blob in self.blobs:
-            blob.instace_name = "coral-group-" + str(id)
+            blob.instance_name = "coral-group-" + str(id)
 
 
 #refactor: change name to annotationS
@@ -85,13 +86,27 @@ class Annotation(QObject):
         Annotation object contains all the annotations as a list of blobs.
     """
     blobUpdated = pyqtSignal(Blob)
+    blobsLoaded = pyqtSignal()
 
     def __init__(self):
         super(QObject, self).__init__()
 
         #refactor: rename this to blobs.
-        # list of all blobs
-        self.seg_blobs = []
+        # list of all blobs (see the seg_blobs property), their data is stored in the columnar store
+        self._seg_blobs = []
+        self.store = BlobStore()
+
+        # reference to the blobs stored in a binary project, they are loaded the first time they are used
+        self.loader = None
+
+        # incremented at each modification, a saved chunk is re-used only if it has been saved with the
+        # current version (see Project.saveBinary())
+        self.version = 0
+        self.saved_chunks = {}
+
+        # tables computed from the blobs (see summary()), valid until the annotations are modified
+        self.tables = {}
+        self.tables_version = -1
 
         # list of all groups
         self.groups = []
@@ -103,6 +118,52 @@ class Annotation(QObject):
 
 #        self.undo = Undo()                       #not saved
 
+    @property
+    def seg_blobs(self):
+        if self.loader is not None:
+            loader = self.loader
+            self.loader = None
+            self._seg_blobs = loader.load()
+            self.store.extend(self._seg_blobs)
+            self.blobsLoaded.emit()
+        return self._seg_blobs
+
+    @seg_blobs.setter
+    def seg_blobs(self, blobs):
+        self.loader = None
+        self.store.clear()
+        self._seg_blobs = blobs
+        self.store.extend(blobs)
+
+    def setLoader(self, loader):
+        """
+        The blobs will be loaded (by loader.load()) the first time they are used.
+        """
+        self.loader = loader
+        self.store.clear()
+        self._seg_blobs = []
+
+    def isLoaded(self):
+        return self.loader is None
+
+    def markDirty(self):
+        self.version += 1
+
+    def setSaved(self, container, chunk_name, count, version):
+        """
+        The blobs (at the given version) are stored in the given chunk of the container.
+        """
+        self.saved_chunks[container] = (chunk_name, count, version)
+
+    def savedChunk(self, container):
+        """
+        It returns (chunk_name, count) if the current blobs are stored in the container, None otherwise.
+        """
+        saved = self.saved_chunks.get(container)
+        if saved is None or saved[2] != self.version:
+            return None
+        return saved[0], saved[1]
+
     #refactor: remove this
     def addGroup(self, blobs):
 
@@ -116,10 +177,36 @@ class Annotation(QObject):
         if blob.id in used:
             blob.id = self.getFreeId()
         self.seg_blobs.append(blob)
+        self.store.attach(blob)
+        self.markDirty()
+
+    def addBlobs(self, blobs):
+        """
+        Add a list of blobs, the ids already used are replaced by free ones (as in addBlob()).
+        """
+        used = set([blob.id for blob in self.seg_blobs])
+        duplicated = []
+        added = []
+        for blob in blobs:
+            if blob.id in used:
+                duplicated.append(blob)
+            else:
+                used.add(blob.id)
+                added.append(blob)
+
+        self.seg_blobs.extend(added)
+        self.store.extend(added)
+
+        for blob in duplicated:
+            self.addBlob(blob)
+
+        self.markDirty()
 
     def removeBlob(self, blob):
         index = self.seg_blobs.index(blob)
         del self.seg_blobs[index]
+        self.store.detach(blob)
+        self.markDirty()
 
     #just
     def updateBlob(self, old_blob, new_blob):
@@ -135,6 +222,18 @@ class Annotation(QObject):
                 return blob
         return None
 
+    def blobsById(self, ids):
+        """
+        It returns a dictionary id -> blob with the blobs of the given ids (the ids not found are missing).
+        """
+
+        if len(self.seg_blobs) == 0 or len(ids) == 0:
+            return {}
+
+        store = self.store
+        rows = np.flatnonzero(np.isin(store.ids[:store.count], list(ids)))
+        return {store.blobs[row].id: store.blobs[row] for row in rows if store.blobs[row] is not None}
+
     def save(self):
         return self.seg_blobs
         #data = []
@@ -177,7 +276,7 @@ class Annotation(QObject):
         # the blobs no more belong to this group
         for blob in group.blobs:
             blob.group = None
-            blob.instace_name = "coral" + str(blob.id)
+            blob.instance_name = "coral" + str(blob.id)
 
         # remove from the list of the groups
         index = self.groups.index(group)
@@ -474,22 +573,71 @@ class Annotation(QObject):
                         largest.bbox[2] - largest.bbox[0]])
         return (largest.image, box, True)
 
+    def cachedTable(self, name, compute):
+
+        if self.tables_version != self.version:
+            self.tables = {}
+            self.tables_version = self.version
+
+        table = self.tables.get(name)
+        if table is None:
+            table = compute()
+            self.tables[name] = table
+        return table
+
+    def summary(self):
+        """
+        It returns a table (DataFrame) with the id, class, area, perimeter, centroid and surface area of the
+        blobs, indexed by their row in the store. The table is cached until the annotations are modified.
+        """
+
+        def compute():
+            blobs = self.seg_blobs
+            store = self.store
+            rows = np.array([blob._row for blob in blobs], dtype=np.int64)
+            classes = np.array(store.classes, dtype=object)
+            return pd.DataFrame({
+                "id": store.ids[rows],
+                "class": classes[store.class_indices[rows]],
+                "area": store.areas[rows],
+                "perimeter": store.perimeters[rows],
+                "centroid x": store.centroids[rows, 0],
+                "centroid y": store.centroids[rows, 1],
+                "surface area": [blob.surface_area for blob in blobs]
+            }, index=rows)
+
+        return self.cachedTable("summary", compute)
+
+    def summaryOf(self, blob):
+        """
+        It returns the row of the summary table of the given blob (None if the blob does not belong to the annotations).
+        """
+
+        if blob._store is not self.store:
+            return None
+        return self.summary().loc[blob._row]
+
+    def classStatistics(self):
+        """
+        It returns, for each class, the number of blobs and the total, mean and maximum area (in pixels).
+        """
+
+        return self.cachedTable("classes", lambda: self.summary().groupby("class")["area"].agg(["count", "sum", "mean", "max"]))
+
     def statistics(self):
         """
         Print some statistics about the current annotations.
         """
 
-        number_of_seg = len(self.seg_blobs)
-        dimensions = np.zeros(number_of_seg)
-        for i, blob in enumerate(self.seg_blobs):
-
-            dimensions[i] = blob.size()
+        areas = self.summary()["area"].values
 
         print("-------------------------")
-        print("Total seg. blobs : %d" % number_of_seg)
-        print("Minimum size     : %d" % np.min(dimensions))
-        print("Maximum size     : %d" % np.max(dimensions))
-        print("Size deviation   : %f" % np.std(dimensions))
+        print("Total seg. blobs : %d" % len(areas))
+        if len(areas) > 0:
+            print("Minimum size     : %d" % np.min(areas))
+            print("Maximum size     : %d" % np.max(areas))
+            print("Size deviation   : %f" % np.std(areas))
+        print(self.classStatistics())
         print("-------------------------")
 
     def clickedBlob(self, x, y):
@@ -499,9 +647,21 @@ class Annotation(QObject):
 
         blobs_clicked = []
 
-        for blob in self.seg_blobs:
+        # (the store is filled when the blobs are loaded)
+        if len(self.seg_blobs) == 0:
+            return None
+
+        # only the blobs whose bounding box (top, left, width, height) contains the point are tested
+        store = self.store
+        bboxes = store.bboxes[:store.count]
+        inside = (bboxes[:, 0] <= y) & (y <= bboxes[:, 0] + bboxes[:, 3]) & \
+                 (bboxes[:, 1] <= x) & (x <= bboxes[:, 1] + bboxes[:, 2])
 
-            point = np.array([[x, y]])
+        point = np.array([[x, y]])
+        for row in np.flatnonzero(inside):
+            blob = store.blobs[row]
+            if blob is None:
+                continue
             out = measure.points_in_poly(point, blob.contour)
             if out[0] == True:
                 blobs_clicked.append(blob)
@@ -519,51 +679,115 @@ class Annotation(QObject):
     ###########################################################################
     ### IMPORT / EXPORT
 
-    def create_label_map(self, size, labels_info):
+    def labelMapPalette(self, labels_info):
         """
-        Create a label map as a QImage and returns it.
+        It returns the palette of the label map (256 x 3, uint8) and the palette index of each class.
+        The index 0 is the background (and the borders), the index 1 is the "Empty" class.
+        """
+
+        if len(labels_info) > 254:
+            raise Exception("Too many classes for a label map.")
+
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        palette[1] = [255, 255, 255]
+        class_index = {"Empty": 1}
+
+        for key in labels_info.keys():
+            if key != "Empty":
+                index = len(class_index) + 1
+                class_index[key] = index
+                palette[index] = labels_info[key]
+
+        return palette, class_index
+
+    def labelMapStrips(self, size, labels_info, strip_height=1024):
+        """
+        It rasterizes the visible blobs as a map of palette indices (see labelMapPalette()), one horizontal strip
+        at a time, and it yields (top, strip) for each strip. The blobs are rasterized in order together with
+        their (progressive) id; a pixel of a blob touching a blob of the same class drawn after it is a border
+        pixel (drawn as background), the borders are found with a single pass on each strip.
         """
 
-        # create a black canvas of the same size of your map
         w = size.width()
         h = size.height()
 
-        imagebox = [0, 0, h, w]
-        image = np.zeros([h, w, 3], np.uint8)
+        palette, class_index = self.labelMapPalette(labels_info)
 
-        for i, blob in enumerate(self.seg_blobs):
-            if not blob.qpath_gitem.isVisible():
-                continue
+        blobs = [blob for blob in self.seg_blobs if blob.qpath_gitem is None or blob.qpath_gitem.isVisible()]
+        values = [class_index[blob.class_name] for blob in blobs]
+        tops = np.array([blob.bbox[0] for blob in blobs], dtype=np.int64)
+        bottoms = tops + np.array([blob.bbox[3] for blob in blobs], dtype=np.int64)
 
-            if blob.class_name == "Empty":
-                rgb = [255, 255, 255]
-            else:
-                class_color = labels_info[blob.class_name]
-                rgb = class_color
+        for y0 in range(0, h, strip_height):
+
+            y1 = min(y0 + strip_height, h)
+
+            # one row more on each side to find the borders along the strip edges
+            r0 = max(y0 - 1, 0)
+            r1 = min(y1 + 1, h)
+
+            ids = np.zeros((r1 - r0, w), dtype=np.int32)
+            labels = np.zeros((r1 - r0, w), dtype=np.uint8)
 
-            mask = blob.getMask().astype(bool)  #bool is required for bitmask indexing
-            box = blob.bbox
-            (box[2], box[3]) = (box[3] + box[0], box[2] + box[1])
-            #box is now startx,starty,endx,endy
+            for k in np.nonzero((tops < r1) & (bottoms > r0))[0]:
 
-            #range is the interection of box and imagebox
-            range = [max(box[0], imagebox[0]), max(box[1], imagebox[1]), min(box[2], imagebox[2]), min(box[3], imagebox[3])]
-            subimage = image[range[0] - imagebox[0]:range[2] - imagebox[0], range[1] - imagebox[1]:range[3] - imagebox[1]]
-            submask = mask[range[0] - box[0]:range[2] - box[0], range[1] - box[1]:range[3] - box[1]]
+                blob = blobs[k]
+                top = max(int(blob.bbox[0]), r0)
+                bottom = min(int(blob.bbox[0] + blob.bbox[3]), r1)
+                left = max(int(blob.bbox[1]), 0)
+                right = min(int(blob.bbox[1] + blob.bbox[2]), w)
+                if bottom <= top or right <= left:
+                    continue
 
-            #use the binary mask to assign a color
-            subimage[submask] = rgb
+                mask = np.zeros((bottom - top, right - left), dtype=np.uint8)
+                origin = np.array([left, top])
+                fillPoly(mask, pts=[blob.contour.round().astype(np.int32) - origin], color=(1))
+                for inner_contour in blob.inner_contours:
+                    fillPoly(mask, pts=[inner_contour.round().astype(np.int32) - origin], color=(0))
 
-            #create 1px border: dilate then subtract the mask.
-            border = binary_dilation(submask) & ~submask
+                mask = mask.astype(bool)
+                ids[top - r0:bottom - r0, left:right][mask] = k + 1
+                labels[top - r0:bottom - r0, left:right][mask] = values[k]
 
-            #select only the border over blobs of the same color and draw the border
-            samecolor = np.all(subimage == rgb, axis=-1)
-            subimage[border & samecolor] = [0, 0, 0]
+            # a pixel is a border if a 4-neighbor has the same class and it has been drawn later
+            border = np.zeros(labels.shape, dtype=bool)
+            same = labels[1:, :] == labels[:-1, :]
+            border[1:, :] |= same & (ids[:-1, :] > ids[1:, :])
+            border[:-1, :] |= same & (ids[1:, :] > ids[:-1, :])
+            same = labels[:, 1:] == labels[:, :-1]
+            border[:, 1:] |= same & (ids[:, :-1] > ids[:, 1:])
+            border[:, :-1] |= same & (ids[:, 1:] > ids[:, :-1])
+            labels[border] = 0
 
-        labelimg = utils.rgbToQImage(image)
+            yield y0, labels[y0 - r0:y1 - r0]
+
+    def create_label_map(self, size, labels_info):
+        """
+        Create a label map as a QImage and returns it.
+        """
+
+        palette, class_index = self.labelMapPalette(labels_info)
+
+        label_map = np.zeros((size.height(), size.width()), dtype=np.uint8)
+        for top, strip in self.labelMapStrips(size, labels_info):
+            label_map[top:top + strip.shape[0]] = strip
+
+        # the colors are assigned only at the end
+        labelimg = utils.rgbToQImage(palette[label_map])
         return labelimg
 
+    def export_label_map(self, size, labels_info, filename):
+        """
+        Save the label map as a paletted PNG, writing one strip at a time (the RGB label map is never created).
+        """
+
+        palette, class_index = self.labelMapPalette(labels_info)
+
+        writer = utils.PalettePNGWriter(filename, size.width(), size.height(), palette)
+        for top, strip in self.labelMapStrips(size, labels_info):
+            writer.writeRows(strip)
+        writer.close()
+
     def import_label_map(self, filename, labels_info, w_target, h_target, create_holes=False):
         """
         It imports a label map and create the corresponding blobs.
@@ -615,45 +839,20 @@ class Annotation(QObject):
         # create a list of properties
         properties = ['Blob id','Class name', 'Centroid x', 'Centroid y', 'Coral area', 'Coral perimeter', 'Coral note']
 
-        # create a list of instances
-        name_list = []
-        visible_blobs = []
-        for blob in self.seg_blobs:
-
-            if blob.qpath_gitem.isVisible():
-                index = blob.blob_name
-                name_list.append(index)
-                visible_blobs.append(blob)
-
-        number_of_seg = len(name_list)
-        class_name = []
-        blob_id = np.zeros(number_of_seg)
-        centroid_x = np.zeros(number_of_seg)
-        centroid_y = np.zeros(number_of_seg)
-        coral_area = np.zeros(number_of_seg)
-        coral_perimeter = np.zeros(number_of_seg)
-        coral_maximum_diameter = np.zeros(number_of_seg)
-        coral_note = []
-
-        for i, blob in enumerate(visible_blobs):
-
-            blob_id[i] = blob.id
-            class_name.append(blob.class_name)
-            centroid_x[i] = round(blob.centroid[0], 1)
-            centroid_y[i] = round(blob.centroid[1], 1)
-            coral_area[i] = round(blob.area * (scale_factor) * (scale_factor)/ 100,2)
-            coral_perimeter[i] = round(blob.perimeter*scale_factor / 10,1)
-            coral_note.append(blob.note)
-
+        # only the visible blobs are exported
+        table = self.summary()
+        visible = [self.store.blobs[row].qpath_gitem is None or self.store.blobs[row].qpath_gitem.isVisible()
+                   for row in table.index]
+        table = table[np.array(visible, dtype=bool)]
 
         # create a dictionary
         dic = {
-            'Blob id' : blob_id,
-            'Class name': class_name,
-            'Centroid x': centroid_x,
-            'Centroid y': centroid_y,
-            'Coral area': coral_area,
-            'Coral perimeter': coral_perimeter}
+            'Blob id' : table["id"].values.astype(float),
+            'Class name': table["class"].values,
+            'Centroid x': table["centroid x"].values.round(1),
+            'Centroid y': table["centroid y"].values.round(1),
+            'Coral area': (table["area"].values * scale_factor * scale_factor / 100).round(2),
+            'Coral perimeter': (table["perimeter"].values * scale_factor / 10).round(1)}
 
         # create dataframe
         df = pd.DataFrame(dic, columns=properties)
@@ -661,5 +860,4 @@ class Annotation(QObject):
 
 
     def export_image_data_for_Scripps(self, size, filename, labels_info):
-        label_map = self.create_label_map(size, labels_info)
-        label_map.save(filename, 'png')
+        self.export_label_map(size, labels_info, filename)
@@ -0,0 +1,105 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE MATCHING OF ALL THE CONSECUTIVE SURVEYS OF A PROJECT (see Project.computeAllCorrespondences()).
+#
+# The pairs (0, 1), (1, 2), ... of the images ordered by acquisition date are split in chains of consecutive
+# pairs, one for each worker process. A worker matches the pairs of its chain in order: each survey is
+# unpacked, scaled and indexed once, and its R-tree and masks are used for both the pairs it belongs to.
+# Only the surveys at the boundary of two chains are prepared twice.
+
+import time
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from source import PackedBlobs
+from source import BlobMatching
+from source.Correspondences import Correspondences
+
+
+def matchChain(first, surveys):
+    """
+    It matches the consecutive surveys, given as (packed blobs, pixel size), the first one being the image
+    of index first. It returns, for each pair, (source index, target index, correspondences, seconds).
+    It is executed by the worker processes.
+    """
+
+    results = []
+    previous = None
+    start = time.perf_counter()
+    for i, (arrays, pixel_size) in enumerate(surveys):
+
+        blobs = BlobMatching.scaleBlobs(PackedBlobs.unpackBlobs(arrays), pixel_size)
+        survey = BlobMatching.Survey(blobs)
+
+        if previous is not None:
+            corr = Correspondences(None, None)
+            corr.matchSurveys(previous, survey)
+            lines = corr.correspondences + corr.dead + corr.born
+            results.append((first + i - 1, first + i, lines, time.perf_counter() - start))
+            start = time.perf_counter()
+
+        previous = survey
+
+    return results
+
+
+def chains(count, workers):
+    """
+    It splits the pairs of count consecutive images in (at most) workers chains, as (first, last) image indices.
+    """
+
+    pairs = count - 1
+    if pairs <= 0:
+        return []
+
+    n = max(1, min(workers, pairs))
+    size = int(math.ceil(pairs / float(n)))
+    return [(first, min(first + size, count - 1)) for first in range(0, pairs, size)]
+
+
+def matchAllSurveys(images, workers=None, progress=None):
+    """
+    It matches all the consecutive images (already ordered by acquisition date) and returns, for each pair,
+    (source index, target index, correspondences, seconds). The progress is reported by progress(pairs done, pairs).
+    """
+
+    if workers is None:
+        workers = 1
+
+    surveys = [(PackedBlobs.packBlobs(image.annotations.seg_blobs), image.pixelSize()) for image in images]
+    tasks = [(first, surveys[first:last + 1]) for first, last in chains(len(images), workers)]
+    total = max(0, len(images) - 1)
+
+    results = []
+    if workers <= 1 or len(tasks) <= 1:
+        for first, chain in tasks:
+            results.extend(matchChain(first, chain))
+            if progress is not None:
+                progress(len(results), total)
+    else:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as pool:
+            futures = [pool.submit(matchChain, first, chain) for first, chain in tasks]
+            for future in as_completed(futures):
+                results.extend(future.result())
+                if progress is not None:
+                    progress(len(results), total)
+
+    results.sort(key=lambda result: result[0])
+    return results
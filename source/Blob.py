@@ -43,9 +43,22 @@ class Blob(object):
     Blob data. A blob is a group of pixels.
     It can be tagged with the class and other information.
     It is stored as an outer contour (the border) plus a list of inner contours (holes).
+    When the blob belongs to an Annotation its id, class, bbox, centroid, area, perimeter and contour are
+    stored in the BlobStore of the annotation (see source/BlobStore.py).
     """
 
+    __slots__ = ["_store", "_row", "_id", "_class_name", "_bbox", "_centroid", "_area", "_perimeter", "_contour",
+                 "version", "surface_area", "inner_contours", "qpath", "qpath_gitem", "id_item",
+                 "instance_name", "blob_name", "deep_extreme_points", "class_color", "genet", "note",
+                 "qimg_mask", "pxmap_mask", "pxmap_mask_gitem", "group"]
+
     def __init__(self, region, offset_x, offset_y, id):
+
+        # row of the BlobStore (None if the blob does not belong to an annotation)
+        self._store = None
+        self._row = -1
+        self._contour = None
+
         self.version = 0
         self.id = int(id)
 
@@ -60,6 +73,7 @@ class Blob(object):
         self.inner_contours = []
         self.qpath = None
         self.qpath_gitem = None
+        self.id_item = None
 
         self.instance_name = "noname"
         self.blob_name = "noname"
@@ -134,6 +148,97 @@ class Blob(object):
         # membership group (if any)
         self.group = None
 
+    # attributes stored in the BlobStore
+
+    @property
+    def id(self):
+        if self._store is None:
+            return self._id
+        return int(self._store.ids[self._row])
+
+    @id.setter
+    def id(self, value):
+        if self._store is None:
+            self._id = value
+        else:
+            self._store.ids[self._row] = value
+
+    @property
+    def class_name(self):
+        if self._store is None:
+            return self._class_name
+        return self._store.classes[self._store.class_indices[self._row]]
+
+    @class_name.setter
+    def class_name(self, value):
+        if self._store is None:
+            self._class_name = value
+        else:
+            self._store.class_indices[self._row] = self._store.classIndex(value)
+
+    @property
+    def bbox(self):
+        if self._store is None:
+            return self._bbox
+        return self._store.bboxes[self._row]
+
+    @bbox.setter
+    def bbox(self, value):
+        if self._store is None:
+            self._bbox = value
+        else:
+            self._store.bboxes[self._row] = value
+
+    @property
+    def centroid(self):
+        if self._store is None:
+            return self._centroid
+        return self._store.centroids[self._row]
+
+    @centroid.setter
+    def centroid(self, value):
+        if self._store is None:
+            self._centroid = value
+        else:
+            self._store.centroids[self._row] = value
+
+    @property
+    def area(self):
+        if self._store is None:
+            return self._area
+        return float(self._store.areas[self._row])
+
+    @area.setter
+    def area(self, value):
+        if self._store is None:
+            self._area = value
+        else:
+            self._store.areas[self._row] = value
+
+    @property
+    def perimeter(self):
+        if self._store is None:
+            return self._perimeter
+        return float(self._store.perimeters[self._row])
+
+    @perimeter.setter
+    def perimeter(self, value):
+        if self._store is None:
+            self._perimeter = value
+        else:
+            self._store.perimeters[self._row] = value
+
+    @property
+    def contour(self):
+        # a contour replaced after the blob has been attached is kept here until the store is compacted
+        if self._contour is not None:
+            return self._contour
+        return self._store.contour(self._row)
+
+    @contour.setter
+    def contour(self, value):
+        self._contour = value
+
 
     def copy(self):
         blob = Blob(None, 0, 0, 0)
@@ -141,8 +246,8 @@ class Blob(object):
         blob.area = self.area
         blob.surface_area = self.surface_area
         blob.perimeter = self.perimeter
-        blob.centroid = self.centroid
-        blob.bbox = self.bbox
+        blob.centroid = self.centroid.copy()
+        blob.bbox = self.bbox.copy()
 
         blob.contour = self.contour.copy()
         for inner in self.inner_contours:
@@ -168,28 +273,12 @@ class Blob(object):
         return blob
 
     def __deepcopy__(self, memo):
-        #avoid recursion!
-        deepcopy_method = self.__deepcopy__
-        self.__deepcopy__ = None
-        #save and later restore qobjects
-        path = self.qpath
-        pathitem = self.qpath_gitem
-        #no deep copy for qobjects
-        self.qpath = None
-        self.qpath_gitem = None
-
-        blob = copy.deepcopy(self)
-        blob.contour = self.contour.copy()
-        blob.inner_contours.clear()
-        for inner in self.inner_contours:
-            blob.inner_contours.append(inner.copy())
-
-        blob.qpath = None
-        blob.qpath_gitem = None
-        self.qpath = path
-        self.qpath_gitem = pathitem
-        #restore deepcopy (also to the newly created Blob!
-        blob.__deepcopy__ = self.__deepcopy__ = deepcopy_method
+        # the copy does not belong to any annotation, and the Qt objects are not copied
+        blob = Blob(None, 0, 0, 0)
+        for name in ["id", "class_name", "bbox", "centroid", "area", "perimeter", "contour", "version",
+                     "surface_area", "inner_contours", "instance_name", "blob_name", "deep_extreme_points",
+                     "class_color", "genet", "note", "group"]:
+            setattr(blob, name, copy.deepcopy(getattr(self, name), memo))
         return blob
 
     def setId(self, id):
@@ -0,0 +1,269 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE SEARCH OF THE OVERLAPPING BLOBS OF TWO SURVEYS (see Correspondences.autoMatch()).
+#
+# The candidate pairs are found with a static R-tree over the bounding boxes of the target blobs, queried
+# for all the source blobs at once. Then only the blobs of the candidate pairs are rasterized, each one once.
+
+import math
+import numpy as np
+from collections import OrderedDict
+
+from source.Mask import intersectMask
+
+
+def toBoxes(bboxes):
+    """
+    It converts the bboxes [top, left, width, height] to boxes [top, left, bottom, right].
+    """
+
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    return np.column_stack([bboxes[:, 0], bboxes[:, 1], bboxes[:, 0] + bboxes[:, 3], bboxes[:, 1] + bboxes[:, 2]])
+
+
+def overlaps(a, b):
+    """
+    It returns True where the boxes of a and b intersect with a positive area.
+    """
+
+    return (a[:, 0] < b[:, 2]) & (b[:, 0] < a[:, 2]) & (a[:, 1] < b[:, 3]) & (b[:, 1] < a[:, 3])
+
+
+def strOrder(boxes, node_size):
+    """
+    Sort-Tile-Recursive order of the boxes: vertical slabs sorted by x, each slab sorted by y.
+    """
+
+    n = len(boxes)
+    cx = (boxes[:, 1] + boxes[:, 3]) / 2.0
+    cy = (boxes[:, 0] + boxes[:, 2]) / 2.0
+
+    nodes = int(math.ceil(n / float(node_size)))
+    slab_size = int(math.ceil(math.sqrt(nodes))) * node_size
+
+    order = np.argsort(cx, kind="stable")
+    slab = np.arange(n) // slab_size
+    return order[np.lexsort((cy[order], slab))]
+
+
+class BBoxRTree(object):
+    """
+    Static R-tree of bounding boxes [top, left, width, height], packed with the Sort-Tile-Recursive method.
+    Each level is stored as arrays: the boxes of the nodes and the range of their children in the level below.
+    """
+
+    def __init__(self, bboxes, node_size=16):
+
+        boxes = toBoxes(bboxes)
+
+        self.node_size = node_size
+        self.levels = []
+
+        order = strOrder(boxes, node_size)
+        self.items = order
+        level_boxes = boxes[order]
+        self.levels.append((level_boxes, None, None))
+
+        while len(level_boxes) > node_size:
+
+            starts = np.arange(0, len(level_boxes), node_size)
+            ends = np.append(starts[1:], len(level_boxes))
+            parents = np.column_stack([np.minimum.reduceat(level_boxes[:, 0], starts),
+                                       np.minimum.reduceat(level_boxes[:, 1], starts),
+                                       np.maximum.reduceat(level_boxes[:, 2], starts),
+                                       np.maximum.reduceat(level_boxes[:, 3], starts)])
+
+            order = strOrder(parents, node_size)
+            level_boxes = parents[order]
+            self.levels.append((level_boxes, starts[order], ends[order]))
+
+    def queryPairs(self, bboxes):
+        """
+        It returns the pairs (query index, item index) of the intersecting boxes, for all the given bboxes.
+        The tree is visited by all the queries at the same time, one level at a time.
+        """
+
+        queries = toBoxes(bboxes)
+        root = self.levels[-1][0]
+        if len(queries) == 0 or len(root) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        qi = np.repeat(np.arange(len(queries)), len(root))
+        ei = np.tile(np.arange(len(root)), len(queries))
+
+        for boxes, starts, ends in reversed(self.levels):
+
+            keep = overlaps(queries[qi], boxes[ei])
+            qi = qi[keep]
+            ei = ei[keep]
+
+            if starts is None:
+                break
+
+            # replace each node with its children
+            counts = ends[ei] - starts[ei]
+            first = np.repeat(starts[ei] - (np.cumsum(counts) - counts), counts)
+            ei = first + np.arange(counts.sum())
+            qi = np.repeat(qi, counts)
+
+        return qi, self.items[ei]
+
+
+class MaskCache(object):
+    """
+    The masks of the blobs and their number of pixels, each blob is rasterized the first time it is used.
+    The least recently used masks are dropped when they take more than max_bytes.
+    """
+
+    def __init__(self, blobs, max_bytes=1 << 28):
+
+        self.blobs = blobs
+        self.masks = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def get(self, i):
+
+        entry = self.masks.get(i)
+        if entry is not None:
+            self.masks.move_to_end(i)
+            return entry
+
+        mask = self.blobs[i].getMask()
+        entry = (mask, np.count_nonzero(mask))
+        self.masks[i] = entry
+        self.bytes += mask.nbytes
+
+        while self.bytes > self.max_bytes and len(self.masks) > 1:
+            j, (old_mask, size) = self.masks.popitem(last=False)
+            self.bytes -= old_mask.nbytes
+
+        return entry
+
+    def release(self, i):
+        """
+        Drop the mask of the i-th blob (it is no longer needed).
+        """
+
+        entry = self.masks.pop(i, None)
+        if entry is not None:
+            self.bytes -= entry[0].nbytes
+
+
+def scaleBlobs(blobs, conversion):
+    """
+    It returns copies of the blobs in millimeters (the areas in square centimeters), given the pixel size.
+    """
+
+    scaled = []
+    for blob in blobs:
+        blob_c = blob.copy()
+        blob_c.bbox = (blob_c.bbox * conversion).round().astype(int)
+        blob_c.contour = blob_c.contour * conversion
+        blob_c.area = blob_c.area * conversion * conversion / 100
+        scaled.append(blob_c)
+
+    return scaled
+
+
+class Survey(object):
+    """
+    The blobs of a survey with their R-tree and their masks. A survey between two pairs of images (see
+    BatchMatching) is matched with both of them, so the tree and the masks (the ones still cached) are
+    computed only once.
+    """
+
+    def __init__(self, blobs):
+
+        self.blobs = blobs
+        self.class_names = np.array([blob.class_name for blob in blobs], dtype=object)
+        self.bboxes = [blob.bbox for blob in blobs]
+        self.masks = MaskCache(blobs)
+        self.tree = None
+
+    def rtree(self):
+        if self.tree is None:
+            self.tree = BBoxRTree(self.bboxes)
+        return self.tree
+
+
+def matchBlobs(blobs1, blobs2, threshold, min_overlap=0.6):
+    """
+    It returns the correspondences between two lists of blobs (see matchSurveys()).
+    """
+
+    return matchSurveys(Survey(blobs1), Survey(blobs2), threshold, min_overlap)
+
+
+def matchSurveys(survey1, survey2, threshold, min_overlap=0.6):
+    """
+    It returns the correspondences [id1, id2, area1, area2, class, action, 'none'] between the blobs of the
+    same class (except 'Empty') whose intersection is at least min_overlap of the smaller one. The action is
+    'grow', 'shrink' or 'same', according to the ratio of their number of pixels and the threshold.
+    The pairs are visited by source blob, so the mask of a source blob is dropped after its last pair.
+    """
+
+    blobs1 = survey1.blobs
+    blobs2 = survey2.blobs
+    if len(blobs1) == 0 or len(blobs2) == 0:
+        return []
+
+    i1, i2 = survey2.rtree().queryPairs(survey1.bboxes)
+
+    names1 = survey1.class_names[i1]
+    same = (names1 == survey2.class_names[i2]) & (names1 != 'Empty')
+    i1 = i1[same]
+    i2 = i2[same]
+    order = np.lexsort((i2, i1))
+
+    masks1 = survey1.masks
+    masks2 = survey2.masks
+
+    correspondences = []
+    previous = None
+    for a, b in zip(i1[order].tolist(), i2[order].tolist()):
+
+        if a != previous:
+            if previous is not None:
+                masks1.release(previous)
+            previous = a
+
+        blob1 = blobs1[a]
+        blob2 = blobs2[b]
+        mask1, size1 = masks1.get(a)
+        mask2, size2 = masks2.get(b)
+
+        mask, bbox = intersectMask(mask1, blob1.bbox, mask2, blob2.bbox)
+        if np.count_nonzero(mask) < min_overlap * min(size1, size2):
+            continue
+
+        if size2 > size1 * threshold:
+            action = 'grow'
+        elif size2 < size1 / threshold:
+            action = 'shrink'
+        else:
+            action = 'same'
+
+        correspondences.append([blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, action, 'none'])
+
+    if previous is not None:
+        masks1.release(previous)
+
+    return correspondences
@@ -0,0 +1,205 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE COLUMNAR STORAGE OF THE BLOBS OF AN ANNOTATION.
+#
+# Each blob of the annotation is attached to a row of the store: its id, class, bbox, centroid, area,
+# perimeter and contour are stored in the arrays of the store (the contours are concatenated in a single
+# buffer, the contour of the i-th row is points[offsets[i]:offsets[i+1]]), and the corresponding attributes
+# of the Blob read and write these arrays. A blob removed from the annotation is detached, i.e. it takes
+# back a copy of its data (it can be added again later, e.g. by the undo).
+
+import numpy as np
+
+
+class BlobStore(object):
+
+    def __init__(self):
+
+        self.count = 0              # number of rows used (detached rows included)
+        self.free = 0               # number of detached rows
+        self.blobs = []             # the blob of each row (None if detached)
+
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.class_indices = np.zeros(0, dtype=np.int32)
+        self.bboxes = np.zeros((0, 4), dtype=np.int64)
+        self.centroids = np.zeros((0, 2), dtype=np.float64)
+        self.areas = np.zeros(0, dtype=np.float64)
+        self.perimeters = np.zeros(0, dtype=np.float64)
+
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.points = np.zeros((0, 2), dtype=np.float64)
+
+        # names of the classes, the class of a row is an index in this list
+        self.classes = []
+        self.class_index = {}
+
+    def __len__(self):
+        return self.count - self.free
+
+    def classIndex(self, class_name):
+
+        index = self.class_index.get(class_name)
+        if index is None:
+            index = len(self.classes)
+            self.classes.append(class_name)
+            self.class_index[class_name] = index
+        return index
+
+    def contour(self, row):
+        return self.points[self.offsets[row]:self.offsets[row + 1]]
+
+    def reserve(self, rows, points):
+        """
+        Grow the arrays (at least doubling them) to store the given number of rows and points.
+        """
+
+        capacity = len(self.ids)
+        if rows > capacity:
+            capacity = max(rows, 2 * capacity, 64)
+            self.ids = self.resized(self.ids, capacity)
+            self.class_indices = self.resized(self.class_indices, capacity)
+            self.bboxes = self.resized(self.bboxes, capacity)
+            self.centroids = self.resized(self.centroids, capacity)
+            self.areas = self.resized(self.areas, capacity)
+            self.perimeters = self.resized(self.perimeters, capacity)
+            self.offsets = self.resized(self.offsets, capacity + 1)
+
+        if points > len(self.points):
+            self.points = self.resized(self.points, max(points, 2 * len(self.points), 1024))
+
+    def resized(self, array, size):
+
+        resized = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+        resized[:len(array)] = array
+        return resized
+
+    def extend(self, blobs):
+        """
+        Attach the given blobs to new rows of the store.
+        """
+
+        for blob in blobs:
+            if blob._store is not None:
+                blob._store.detach(blob)
+
+        n = len(blobs)
+        if n == 0:
+            return
+
+        contours = [np.asarray(blob._contour, dtype=np.float64).reshape(-1, 2) for blob in blobs]
+        lengths = np.array([len(contour) for contour in contours], dtype=np.int64)
+
+        first = self.count
+        used = self.offsets[first]
+        self.reserve(first + n, used + lengths.sum())
+
+        rows = slice(first, first + n)
+        self.ids[rows] = [blob._id for blob in blobs]
+        self.class_indices[rows] = [self.classIndex(blob._class_name) for blob in blobs]
+        self.bboxes[rows] = np.array([np.asarray(blob._bbox).reshape(4) for blob in blobs])
+        self.centroids[rows] = np.array([np.asarray(blob._centroid).reshape(2) for blob in blobs])
+        self.areas[rows] = [blob._area for blob in blobs]
+        self.perimeters[rows] = [blob._perimeter for blob in blobs]
+
+        self.offsets[first + 1:first + n + 1] = used + np.cumsum(lengths)
+        self.points[used:self.offsets[first + n]] = np.concatenate(contours)
+
+        for i, blob in enumerate(blobs):
+            blob._store = self
+            blob._row = first + i
+            blob._id = blob._class_name = blob._bbox = blob._centroid = None
+            blob._area = blob._perimeter = blob._contour = None
+
+        self.blobs.extend(blobs)
+        self.count += n
+
+    def attach(self, blob):
+        self.extend([blob])
+
+    def detach(self, blob):
+        """
+        The blob takes back a copy of its data and the row is freed.
+        """
+
+        if blob._store is not self:
+            return
+
+        row = blob._row
+        blob._id = int(self.ids[row])
+        blob._class_name = self.classes[self.class_indices[row]]
+        blob._bbox = self.bboxes[row].copy()
+        blob._centroid = self.centroids[row].copy()
+        blob._area = float(self.areas[row])
+        blob._perimeter = float(self.perimeters[row])
+        if blob._contour is None:
+            blob._contour = self.contour(row).copy()
+
+        blob._store = None
+        blob._row = -1
+
+        self.blobs[row] = None
+        self.free += 1
+
+        if self.free > 1024 and 2 * self.free > self.count:
+            self.compact()
+
+    def clear(self):
+
+        for blob in self.blobs:
+            if blob is not None:
+                self.detach(blob)
+        self.__init__()
+
+    def compact(self):
+        """
+        Remove the detached rows, the contours replaced after the blob was attached are moved in the buffer.
+        """
+
+        live = [blob for blob in self.blobs if blob is not None]
+        rows = np.array([blob._row for blob in live], dtype=np.int64)
+
+        contours = []
+        for blob in live:
+            if blob._contour is not None:
+                contours.append(np.asarray(blob._contour, dtype=np.float64).reshape(-1, 2))
+            else:
+                contours.append(self.contour(blob._row))
+
+        self.ids = self.ids[rows]
+        self.class_indices = self.class_indices[rows]
+        self.bboxes = self.bboxes[rows]
+        self.centroids = self.centroids[rows]
+        self.areas = self.areas[rows]
+        self.perimeters = self.perimeters[rows]
+
+        self.offsets = np.zeros(len(live) + 1, dtype=np.int64)
+        if len(live) > 0:
+            self.offsets[1:] = np.cumsum([len(contour) for contour in contours])
+            self.points = np.concatenate(contours)
+        else:
+            self.points = np.zeros((0, 2), dtype=np.float64)
+
+        for i, blob in enumerate(live):
+            blob._row = i
+            blob._contour = None
+
+        self.blobs = live
+        self.count = len(live)
+        self.free = 0
@@ -18,7 +18,6 @@
 # for more details.
 
 from PyQt5.QtGui import QImage
-import rasterio as rio
 from source import utils
 import numpy as np
 
@@ -42,6 +41,7 @@ class Channel(object):
 
         # typically the depth map is stored in a 32-bit Tiff
         if self.type == "DEM":
+            import rasterio as rio
             dem = rio.open(self.filename)
             self.float_map = dem.read(1).astype(np.float32)
             self.nodata = dem.nodata
@@ -2,6 +2,8 @@ from source.Blob import Blob
 import numpy as np
 from source.Blob import Blob
 from source.Mask import intersectMask
+from source import BlobMatching
+from collections import Counter
 import pandas as pd
 
 
@@ -17,6 +19,30 @@ class Correspondences(object):
         self.threshold = 1.05
         self.data = pd.DataFrame(data = correspondences, columns=['Blob1', 'Blob2', 'Area1', 'Area2', 'Class', 'Action', 'Split\Fuse'])
 
+        # incremented at each modification of the table (see Annotation.version)
+        self.version = 0
+        self.saved_chunks = {}
+
+        # rows of each source and target blob id (see adjacency()), rebuilt after a modification
+        self.index = None
+
+    def markDirty(self):
+        self.version += 1
+        self.index = None
+
+    def setSaved(self, container, chunk_name, version):
+        self.saved_chunks[container] = (chunk_name, version)
+
+    def savedChunk(self, container):
+        """
+        It returns the name of the chunk of the container storing the current table, None if the table
+        has been modified after it was saved.
+        """
+        saved = self.saved_chunks.get(container)
+        if saved is None or saved[1] != self.version:
+            return None
+        return saved[0]
+
     def area_in_sq_cm(self, area, is_source):
 
         if is_source:
@@ -26,49 +52,43 @@ class Correspondences(object):
 
         return area_sq_cm
 
+    def areasById(self, is_source, use_surface_area=False):
+        """
+        It returns the areas (in sq. cm) of the blobs of the source or target image, as a Series indexed by the blob id.
+        """
+
+        summary = (self.source if is_source else self.target).annotations.summary()
+        column = "surface area" if use_surface_area else "area"
+        areas = pd.Series(summary[column].to_numpy(dtype=np.float64), index=summary["id"].to_numpy())
+        return self.area_in_sq_cm(areas, is_source)
+
+    def mapAreas(self, use_surface_area=False):
+        """
+        Replace the areas of the table with the current ones of the blobs (the rows of the missing blobs are kept).
+        """
+
+        areas1 = self.data['Blob1'].map(self.areasById(True, use_surface_area))
+        areas2 = self.data['Blob2'].map(self.areasById(False, use_surface_area))
+        self.data['Area1'] = areas1.fillna(self.data['Area1']).astype(np.float64)
+        self.data['Area2'] = areas2.fillna(self.data['Area2']).astype(np.float64)
+        self.markDirty()
+
     def updateAreas(self, use_surface_area=False):
 
-        for index, row in self.data.iterrows():
-            id1 = int(row['Blob1'])
-            id2 = int(row['Blob2'])
-            action = row['Action']
-            blob1 = self.source.annotations.blobById(id1)
-            blob2 = self.target.annotations.blobById(id2)
-
-            if blob1 is not None:
-                area_pixel = blob1.area
-                if use_surface_area:
-                    area_pixel = blob1.surface_area
-                area1 = self.area_in_sq_cm(area_pixel, True)
-                self.data.loc[index, 'Area1'] = area1
-
-            if blob2 is not None:
-                area_pixel = blob2.area
-                if use_surface_area:
-                    area_pixel = blob2.surface_area
-                area2 = self.area_in_sq_cm(area_pixel, False)
-                self.data.loc[index, 'Area2'] = area2
-
-            # update grow/shrink information
-            if action == "grow" or action == "shrink" or action == "same":
-                if area2 > area1*self.threshold:
-                    self.data.loc[index, 'Action'] = "grow"
-                elif area2 < area1 / self.threshold:
-                    self.data.loc[index, 'Action'] = "shrink"
-                else:
-                    self.data.loc[index, 'Action'] = "same"
+        self.mapAreas(use_surface_area)
+
+        # update grow/shrink information
+        area1 = self.data['Area1'].to_numpy()
+        area2 = self.data['Area2'].to_numpy()
+        action = self.data['Action'].to_numpy()
+        changed = np.isin(action, ["grow", "shrink", "same"])
+        self.data['Action'] = np.where(changed, np.select([area2 > area1 * self.threshold, area2 < area1 / self.threshold],
+                                                          ["grow", "shrink"], "same"), action)
+        self.markDirty()
 
     def setSurfaceAreaValues(self):
 
-        for index, row in self.data.iterrows():
-            id1 = int(row['Blob1'])
-            id2 = int(row['Blob2'])
-            blob1 = self.source.annotations.blobById(id1)
-            blob2 = self.target.annotations.blobById(id2)
-            if blob1 is not None:
-                self.data.loc[index, 'Area1'] = self.area_in_sq_cm(blob1.area, True)
-            if blob2 is not None:
-                self.data.loc[index, 'Area2'] = self.area_in_sq_cm(blob2.area, False)
+        self.mapAreas(use_surface_area=False)
 
     def save(self):
         return { "source": self.source.id, "target": self.target.id, "correspondences": self.data.values.tolist() }
@@ -76,6 +96,54 @@ class Correspondences(object):
     def sort_data(self):
 
         self.data.sort_values(by=['Action', 'Blob1', 'Blob2'], inplace=True, ignore_index=True)
+        self.markDirty()
+
+    def adjacency(self):
+        """
+        It returns the index of the table: the ids of the source and target blobs of each row and the
+        dictionaries source id -> rows and target id -> rows (the rows are positions in the table).
+        """
+
+        if self.index is None:
+            blob1 = self.data['Blob1'].to_numpy(dtype=np.int64)
+            blob2 = self.data['Blob2'].to_numpy(dtype=np.int64)
+            source_rows = {}
+            target_rows = {}
+            for row, (id1, id2) in enumerate(zip(blob1.tolist(), blob2.tolist())):
+                if id1 >= 0:
+                    source_rows.setdefault(id1, []).append(row)
+                if id2 >= 0:
+                    target_rows.setdefault(id2, []).append(row)
+            self.index = (blob1, blob2, source_rows, target_rows)
+        return self.index
+
+    def setValue(self, row, column, value):
+        """
+        Set a cell of the table (e.g. the action edited in the compare panel).
+        """
+
+        self.data.iloc[row, column] = value
+        self.markDirty()
+
+    def updateBlobArea(self, blob, is_source):
+        """
+        Update the area of the rows of the given (source or target) blob.
+        """
+
+        if is_source:
+            self.data.loc[self.data['Blob1'] == blob.id, 'Area1'] = self.area_in_sq_cm(blob.area, True)
+        else:
+            self.data.loc[self.data['Blob2'] == blob.id, 'Area2'] = self.area_in_sq_cm(blob.area, False)
+        self.markDirty()
+
+    def appendRows(self, rows):
+        """
+        Append a list of rows to the table, with a single concatenation.
+        """
+
+        if len(rows) > 0:
+            df = pd.DataFrame(rows, columns=self.data.columns)
+            self.data = pd.concat([self.data, df], ignore_index=True)
 
     def fillTable(self, lst):
         """
@@ -100,21 +168,25 @@ class Correspondences(object):
         else:
             self.set([], [blob])
             self.data = self.data[self.data['Blob2'] != blob.id]
-        pass
+        self.data.reset_index(drop=True, inplace=True)
+        self.markDirty()
 
     def updateBlob(self, image, old_blob, new_blob):
         if old_blob.class_name != new_blob.class_name:
             if self.source == image:
-                set(self, [new_blob], [])
+                self.set([new_blob], [])
             else:
-                set(self, [], [new_blob])
+                self.set([], [new_blob])
             return
         if self.source == image:
-            self.data.loc[self.data["Blob1"] == old_blob.id, "Blob1"] = new_blob.id
-            self.data.loc[self.data["Blob1"] == old_blob.id, "Area1"] = self.area_in_sq_cm(new_blob.area, False)
+            rows = self.data["Blob1"] == old_blob.id
+            self.data.loc[rows, "Blob1"] = new_blob.id
+            self.data.loc[rows, "Area1"] = self.area_in_sq_cm(new_blob.area, True)
         else:
-            self.data.loc[self.data["Blob2"] == old_blob.id, "Blob2"] = new_blob.id
-            self.data.loc[self.data["Blob2"] == old_blob.id, "Area2"] = self.area_in_sq_cm(new_blob.area, False)
+            rows = self.data["Blob2"] == old_blob.id
+            self.data.loc[rows, "Blob2"] = new_blob.id
+            self.data.loc[rows, "Area2"] = self.area_in_sq_cm(new_blob.area, False)
+        self.markDirty()
 
     def setBlobClass(self, image, blob, class_name):
         #break the correspondences
@@ -158,33 +230,29 @@ class Correspondences(object):
         self.data = self.data[self.data['Blob1'].isin([b.id for b in sourceblobs]) == False]
         self.data = self.data[self.data['Blob2'].isin([b.id for b in targetblobs]) == False]
 
+        rows = []
+
+        targets = self.target.annotations.blobsById(targetorphaned)
         for id in targetorphaned:
             if id < 0: # born and dead result in orphaned
                 continue
-            target = self.target.annotations.blobById(id)
-            row = [-1, target.id, 0.0, self.area_in_sq_cm(target.area, False), target.class_name, "born", type]
-            df = pd.DataFrame([row], columns=self.data.columns)
-            self.data = self.data.append(df)
+            target = targets[id]
+            rows.append([-1, target.id, 0.0, self.area_in_sq_cm(target.area, False), target.class_name, "born", type])
 
+        sources = self.source.annotations.blobsById(sourceorphaned)
         for id in sourceorphaned:
             if id < 0:
                 continue
-            source = self.source.annotations.blobById(id)
-            row = [ source.id, -1, self.area_in_sq_cm(source.area, True), 0.0, source.class_name, "dead", type]
-            df = pd.DataFrame([row], columns=self.data.columns)
-            self.data = self.data.append(df)
+            source = sources[id]
+            rows.append([source.id, -1, self.area_in_sq_cm(source.area, True), 0.0, source.class_name, "dead", type])
 
         if len(sourceblobs) == 0:
             target = targetblobs[0]
-            row = [-1, target.id, 0.0, self.area_in_sq_cm(target.area, False), target.class_name, action, type]
-            df = pd.DataFrame([row], columns=self.data.columns)
-            self.data = self.data.append(df)
+            rows.append([-1, target.id, 0.0, self.area_in_sq_cm(target.area, False), target.class_name, action, type])
 
         elif len(targetblobs) == 0:
             source = sourceblobs[0]
-            row = [source.id, -1, self.area_in_sq_cm(source.area, True), 0, source.class_name, action, type]
-            df = pd.DataFrame([row], columns=self.data.columns)
-            self.data = self.data.append(df)
+            rows.append([source.id, -1, self.area_in_sq_cm(source.area, True), 0, source.class_name, action, type])
 
         else:
 
@@ -199,48 +267,38 @@ class Correspondences(object):
                         target_area = self.area_in_sq_cm(target.area, False)
 
                     class_name = source.class_name if source.id >= 0 else target.class_name
-                    row = [source.id, target.id, source_area, target_area, class_name, action, type]
-                    df = pd.DataFrame([row], columns=self.data.columns)
-                    self.data = self.data.append(df)
+                    rows.append([source.id, target.id, source_area, target_area, class_name, action, type])
 
+        self.appendRows(rows)
         self.sort_data()
 
 
     # starting for a blob id will find the cluster both in source and target
     def findCluster(self, blobid, is_source):
-        # so we want source to be blob and target to be the other viewerplus
-        source = "Blob1"
-        target = "Blob2"
+        # so we want source to be blob and target to be the other viewerplus (the index is swapped)
+        blob1, blob2, source_rows, target_rows = self.adjacency()
         if not is_source:
-            source, target = target, source
-
-        sourcecluster = [blobid] # source ids
-        targetcluster = []       # target ids
-        rows = []                # involved rows
+            blob1, blob2, source_rows, target_rows = blob2, blob1, target_rows, source_rows
 
         # find all blobs in the target connected to the blob
-        linked = self.data[self.data[source] == blobid]
-        for index, row in linked.iterrows():
-            targetid = row[target]
-            if targetid >= 0:
-                targetcluster.append(targetid)
-            rows.append(index)
+        rows = source_rows.get(blobid, [])
+        targetcluster = set([id for id in blob2[rows].tolist() if id >= 0])
 
         # find all the connected in the source connected to the selected targets
-        linked = self.data.loc[self.data[target].isin(targetcluster)]
-        for index, row in linked.iterrows():
-            sourceid = row[source]
-            if sourceid >= 0:
-                sourcecluster.append(sourceid)
-            rows.append(index)
+        rows = set(rows)
+        for targetid in targetcluster:
+            rows.update(target_rows[targetid])
+        rows = sorted(rows)
+
+        sourcecluster = set([id for id in blob1[rows].tolist() if id >= 0])
+        sourcecluster.add(blobid)
+
+        sourcecluster = list(sourcecluster)
+        targetcluster = list(targetcluster)
 
         if not is_source:
             sourcecluster, targetcluster = targetcluster, sourcecluster
 
-        sourcecluster = list(set(sourcecluster))
-        targetcluster = list(set(targetcluster))
-        rows = list(set(rows))
-
         return sourcecluster, targetcluster, rows
 
 
@@ -255,94 +313,69 @@ class Correspondences(object):
             if row["Blob2"] >= 0:
                 born.append(row["Blob2"])
 
+        self.markDirty()
+
         # delete rows from the dataframe
         self.data.drop(indexes, inplace=True)
 
         # reindexing
         self.data.reset_index(drop=True, inplace=True)
 
-        count = len(self.data.index)
+        rows = []
 
+        sources = self.source.annotations.blobsById(set(dead))
         for i in set(dead):
-            blob = self.source.annotations.blobById(i)
-            row = [blob.id, -1, self.area_in_sq_cm(blob.area, True), 0.0, blob.class_name, "dead", "none"]
-            df = pd.DataFrame([row], columns=self.data.columns)
-            self.data = self.data.append(df)
+            blob = sources[i]
+            rows.append([blob.id, -1, self.area_in_sq_cm(blob.area, True), 0.0, blob.class_name, "dead", "none"])
 
+        targets = self.target.annotations.blobsById(set(born))
         for i in set(born):
-            blob = self.target.annotations.blobById(i)
-            row = [-1, blob.id, 0.0, self.area_in_sq_cm(blob.area, False), blob.class_name, "dead", "none"]
-            df = pd.DataFrame([row], columns=self.data.columns)
-            self.data = self.data.append(df)
+            blob = targets[i]
+            rows.append([-1, blob.id, 0.0, self.area_in_sq_cm(blob.area, False), blob.class_name, "born", "none"])
 
+        self.appendRows(rows)
         self.sort_data()
 
 
     def autoMatch(self, blobs1, blobs2):
+        self.matchSurveys(BlobMatching.Survey(blobs1), BlobMatching.Survey(blobs2))
+
+    def matchSurveys(self, survey1, survey2):
+        """
+        Compute the correspondences between two surveys (see BlobMatching.Survey), the R-tree and the
+        masks of the surveys are kept, so a survey can be matched again with another one.
+        """
+
         self.correspondences.clear()
-        for blob1 in blobs1:
-            for blob2 in blobs2:
-                # use bb to quickly calculate intersection
-                x1 = max(blob1.bbox[0], blob2.bbox[0])
-                y1 = max(blob1.bbox[1], blob2.bbox[1])
-                x2 = min(blob1.bbox[0] + blob1.bbox[3], blob2.bbox[0] + blob2.bbox[3])
-                y2 = min(blob1.bbox[1] + blob1.bbox[2], blob2.bbox[1] + blob2.bbox[2])
-                # compute the area of intersection rectangle
-                interArea = abs(max((x2 - x1, 0)) * max((y2 - y1), 0))
-
-                if interArea != 0 and blob2.class_name == blob1.class_name and blob1.class_name != 'Empty':
-                    # this is the get mask function for the outer contours, I put it here using two different if conditions so getMask just runs just on intersections
-                    mask1 = Blob.getMask(blob1)
-                    sizeblob1 = np.count_nonzero(mask1)
-                    mask2 = Blob.getMask(blob2)
-                    sizeblob2 = np.count_nonzero(mask2)
-                    minblob = min(sizeblob1, sizeblob2)
-                    mask, bbox = intersectMask(mask1, blob1.bbox, mask2, blob2.bbox)
-                    intersectionArea = np.count_nonzero(mask)
-
-                    if (intersectionArea < (0.6 * minblob)):
-                        continue
-                    if (sizeblob2 > sizeblob1 * self.threshold):
-                        self.correspondences.append([blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, 'grow', 'none'])
-
-                    elif (sizeblob2 < sizeblob1 / self.threshold):
-                        self.correspondences.append([blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, 'shrink', 'none'])
-
-                    else:
-                        self.correspondences.append([blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, 'same', 'none'])
 
+        # candidate pairs from an R-tree of the bounding boxes, each blob is rasterized at most once
+        self.correspondences.extend(BlobMatching.matchSurveys(survey1, survey2, self.threshold))
 
         # operates on the correspondences found and update them
         self.assignSplit()
         self.assignFuse()
 
         # fill self.born and self.dead blob lists
-        self.assignDead(blobs1)
-        self.assignBorn(blobs2)
+        self.assignDead(survey1.blobs)
+        self.assignBorn(survey2.blobs)
 
 
     def assignSplit(self):
 
-        mylist = []
-        for i in range(0, len(self.correspondences)):
-            mylist.append(int(self.correspondences[i][0]))
-        splitted = sorted(set([i for i in mylist if mylist.count(i) > 1]))
+        counts = Counter([int(corr[0]) for corr in self.correspondences])
 
-        for i in range(0, len(self.correspondences)):
-            if int(self.correspondences[i][0]) in splitted:
-                self.correspondences[i][6] = 'split'
+        for corr in self.correspondences:
+            if counts[int(corr[0])] > 1:
+                corr[6] = 'split'
 
 
     def assignFuse(self):
 
-        mylist = []
-        for i in range(0, len(self.correspondences)):
-            mylist.append(int(self.correspondences[i][1]))
-        fused = sorted(set([i for i in mylist if mylist.count(i) > 1]))
+        counts = Counter([int(corr[1]) for corr in self.correspondences])
 
-        for i in range(0, len(self.correspondences)):
-            if int(self.correspondences[i][1]) in fused:
-                self.correspondences[i][6] = 'fuse'
+        for corr in self.correspondences:
+            if counts[int(corr[1])] > 1:
+                corr[6] = 'fuse'
 
 
     def assignDead(self, blobs1):
@@ -350,22 +383,12 @@ class Correspondences(object):
         # """
         # Deads are all the blobs that are in project 1 but don't match with any blobs of project 2
         # """
-        all_blobs = []
-        existing = []
-        missing = []
-
-        for i in range(0, len(blobs1)):
-            all_blobs.append(int(blobs1[i].id))
+        existing = set([int(corr[0]) for corr in self.correspondences])
 
-        for j in range(0, len(self.correspondences)):
-            existing.append(int(self.correspondences[j][0]))
-
-        missing = [i for i in all_blobs if i not in existing]
-
-        for id in missing:
-            index = all_blobs.index(id)
-            if blobs1[index].class_name != 'Empty':
-                self.dead.append([id, -1,  blobs1[index].area, 0.0, blobs1[index].class_name, 'dead', 'none'])
+        for blob in blobs1:
+            id = int(blob.id)
+            if id not in existing and blob.class_name != 'Empty':
+                self.dead.append([id, -1, blob.area, 0.0, blob.class_name, 'dead', 'none'])
 
 
     def assignBorn(self, blobs2):
@@ -374,21 +397,10 @@ class Correspondences(object):
         # Borns are all the blobs that are in project 2 but don't match with any blobs of project 1
         # MAYBE NOW MOVED MIGHT BE EXCHANGED FOR NEW BORN
         # """
+        existing = set([int(corr[1]) for corr in self.correspondences])
 
-        all_blobs = []
-        existing = []
-        missing = []
-
-        for i in range(0, len(blobs2)):
-            all_blobs.append(int(blobs2[i].id))
-
-        for j in range(0, len(self.correspondences)):
-            existing.append(int(self.correspondences[j][1]))
-
-        missing = [i for i in all_blobs if i not in existing]
-
-        for id in missing:
-            index = all_blobs.index(id)
-            if blobs2[index].class_name != 'Empty':
-                self.born.append([-1, id, 0.0, blobs2[index].area, blobs2[index].class_name, 'born', 'none'])
+        for blob in blobs2:
+            id = int(blob.id)
+            if id not in existing and blob.class_name != 'Empty':
+                self.born.append([-1, id, 0.0, blob.area, blob.class_name, 'born', 'none'])
 
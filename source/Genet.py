@@ -1,37 +1,204 @@
 from source.Blob import Blob
 
-#convenience class to update genet changes, no need to save anything, genet is stored in the Blobs.
-#we store a set of used genets (for creating new ones, and keep track of removed) map genet -> number of blobs
-#operations:
+# A genet is a colony followed across the surveys: the blobs connected by the correspondences of all the
+# image pairs of the project (see Project.correspondences) belong to the same genet.
+#
+# The connected components are computed with a union-find over the nodes (image id, blob id), rebuilt
+# only when a table of correspondences changes. A component keeps the genet id it had before the change
+# (the id of its first node that had one), so the genets are stable while the correspondences are edited.
+# The assignment is saved with the project (see save()), the blobs receive it in Blob.genet. The project
+# updates it when the blobs or the correspondences are edited and when the blobs of an image are loaded.
 
 
-#Could be the case to define plugins that attach to properties of the Blobs.
-#How it works:
-#blob properties -> plugin attach to a specific set of properties.
-#must be able to deal when properties are present.
+class UnionFind(object):
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def add(self, node):
+        if node not in self.parent:
+            self.parent[node] = node
+            self.size[node] = 1
+
+    def find(self, node):
+
+        parent = self.parent
+        while parent[node] != node:
+            # path halving
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, a, b):
+
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
 
 
 class Genet:
 
-    def __init__(self, images, correspondences):
-        pass
+    def __init__(self, project, genets=None):
+        """
+        :param genets: the assignment saved with the project (see save())
+        """
+
+        self.project = project
+        self.genets = {}            # (image id, blob id) -> genet id
+        self.next = 1               # first genet id never used
+        self.components = {}        # genet id -> list of nodes connected by the correspondences
+        self.versions = None        # versions of the tables of correspondences used by the last update()
+
+        if genets is not None:
+            self.next = genets.get("next", 1)
+            for image_id, pairs in genets.get("images", {}).items():
+                for blob_id, genet in pairs:
+                    self.genets[(image_id, int(blob_id))] = int(genet)
+
+    def tableVersions(self):
+        images = [(image.id, image.annotations.version) for image in self.project.images]
+        return images, [(key, id(corr), corr.version) for key, corr in self.tables().items()]
+
+    def tables(self):
+        if self.project.correspondences is None:
+            return {}
+        return self.project.correspondences
+
+    def newGenet(self):
+        genet = self.next
+        self.next += 1
+        return genet
+
+    def update(self):
+        """
+        Recompute the genets if the correspondences changed after the last update.
+        """
+
+        versions = self.tableVersions()
+        if versions == self.versions:
+            return
+        self.versions = versions
+
+        uf = UnionFind()
+        for corr in self.tables().values():
+            source_id = corr.source.id
+            target_id = corr.target.id
+            for id1, id2 in zip(corr.data["Blob1"].tolist(), corr.data["Blob2"].tolist()):
+                a = (source_id, int(id1))
+                b = (target_id, int(id2))
+                if id1 >= 0:
+                    uf.add(a)
+                if id2 >= 0:
+                    uf.add(b)
+                if id1 >= 0 and id2 >= 0:
+                    uf.union(a, b)
+
+        # the nodes of each component, in the order of acquisition of the images
+        order = {image.id: i for i, image in enumerate(self.project.images)}
+        groups = {}
+        for node in sorted(uf.parent.keys(), key=lambda node: (order.get(node[0], len(order)), node[1])):
+            groups.setdefault(uf.find(node), []).append(node)
 
-    # update blob with a new genet first empty genet (starting from 1)
-    def addBlob(self, blob):
-        return 1
-    #a blob was removed update genet
+        genets = {}
+        used = set()
+
+        self.components = {}
+        for nodes in groups.values():
+            genet = None
+            for node in nodes:
+                previous = self.genets.get(node)
+                if previous is not None and previous not in used:
+                    genet = previous
+                    break
+            if genet is None:
+                genet = self.newGenet()
+            used.add(genet)
+            self.components[genet] = nodes
+            for node in nodes:
+                genets[node] = genet
+
+        # the blobs without correspondences keep their genet if it is not used by a component,
+        # the blobs of the removed images lose it
+        for node, genet in self.genets.items():
+            if node[0] in order and node not in uf.parent:
+                if genet in used:
+                    genet = self.newGenet()
+                used.add(genet)
+                genets[node] = genet
+
+        self.genets = genets
+
+        for image in self.project.images:
+            if image.annotations.isLoaded():
+                self.updateBlobs(image)
+
+    def imageLoaded(self, image):
+        """
+        The blobs of the given image have been loaded (see Annotation.seg_blobs): they receive their genets.
+        """
+
+        if self.tableVersions() != self.versions:
+            self.update()
+        else:
+            self.updateBlobs(image)
+
+    def updateBlobs(self, image):
+        """
+        Assign the genets to the blobs of the given image (the blobs without correspondences get a new one).
+        """
+
+        for blob in image.annotations.seg_blobs:
+            blob.genet = self.addBlob(image.id, blob)
+
+    # return the genet of the blob, a blob never seen receives a new genet
+    def addBlob(self, image_id, blob):
+
+        node = (image_id, blob.id)
+        genet = self.genets.get(node)
+        if genet is None:
+            genet = self.newGenet()
+            self.genets[node] = genet
+        return genet
+
+    # a blob was removed: its genet is freed (the components are recomputed by update())
     def removeBlob(self, image_id, blob):
-        #if not genet, retunr
-        #if genet count = 1 free genet
-        #look for correspondences, we might need to split a graph in 2 or more.
-        pass
+        self.genets.pop((image_id, blob.id), None)
 
-    def updateBlobs(self, blobs):
-        #check connectivity for all the blobs and update the genets.
-        pass
+    # the id of a blob changed: it keeps its genet
+    def updateBlob(self, image_id, old_blob, new_blob):
+        genet = self.genets.pop((image_id, old_blob.id), None)
+        if genet is not None:
+            self.genets[(image_id, new_blob.id)] = genet
+            new_blob.genet = genet
 
-    def save(self):
-        return {}
+    def genetOf(self, image_id, blob_id):
+        """
+        It returns the genet of the given blob (None if it has no genet).
+        """
 
+        self.update()
+        return self.genets.get((image_id, blob_id))
 
+    def lineage(self, image_id, blob_id):
+        """
+        It returns the blobs, as (image id, blob id), of the genet of the given blob.
+        """
+
+        genet = self.genetOf(image_id, blob_id)
+        if genet is None:
+            return []
+        return list(self.components.get(genet, [(image_id, blob_id)]))
+
+    def save(self):
 
+        self.update()
+        images = {}
+        for (image_id, blob_id), genet in sorted(self.genets.items()):
+            images.setdefault(image_id, []).append([blob_id, genet])
+        return { "next": self.next, "images": images }
@@ -1,7 +1,6 @@
 from source.Channel import Channel
 from source.Blob import Blob
 from source.Annotation import Annotation
-import rasterio as rio
 
 class Image(object):
     def __init__(self, rect = [0.0, 0.0, 0.0, 0.0],
@@ -21,10 +20,12 @@ class Image(object):
         self.height = height                        #in pixels!
 
         self.annotations = Annotation()
+        blobs = []
         for data in annotations:
             blob = Blob(None, 0, 0, 0)
             blob.fromDict(data)
-            self.annotations.addBlob(blob)
+            blobs.append(blob)
+        self.annotations.addBlobs(blobs)
 
         self.channels = list(map(lambda c: Channel(**c), channels))
 
@@ -48,6 +49,8 @@ class Image(object):
         """
         Update the georeferencing information.
         """
+        import rasterio as rio
+
         img = rio.open(filename)
         if img.crs is not None:
             # this image contains georeference information
@@ -61,6 +64,8 @@ class Image(object):
         The image data is loaded when the image channel is used for the first time.
         """
 
+        import rasterio as rio
+
         img = rio.open(filename)
 
         # check image size consistency (all the channels must have the same size)
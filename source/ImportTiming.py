@@ -0,0 +1,107 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE STARTUP TIMING REPORT (python TagLab.py --startup-report).
+#
+# The time spent importing each module is measured by wrapping the import statement, as done by
+# python -X importtime: the self time of a module excludes the time of the modules it imports, the
+# cumulative time includes them.
+
+import sys
+import time
+import builtins
+
+
+class ImportTimer(object):
+
+    def __init__(self):
+
+        self.start = time.perf_counter()
+        self.records = []           # (module, depth, self time, cumulative time), in order of completion
+        self.stack = []             # time spent in the nested imports of the imports in progress
+        self.original_import = None
+        self.steps = []             # (name, time since start) of the startup steps (see mark())
+
+    def install(self):
+
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timedImport
+
+    def uninstall(self):
+
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def timedImport(self, name, globals=None, locals=None, fromlist=(), level=0):
+
+        module = self.newModule(name, fromlist, level)
+        if module is None:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        start = time.perf_counter()
+        self.stack.append(0.0)
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.stack.pop()
+            if len(self.stack) > 0:
+                self.stack[-1] += elapsed
+            self.records.append((module, len(self.stack), elapsed - nested, elapsed))
+
+    def newModule(self, name, fromlist, level):
+        """
+        It returns the name of the module loaded by the import statement (None if it is already loaded).
+        """
+
+        if level != 0:
+            return None
+        if name not in sys.modules:
+            return name
+        for item in fromlist or ():
+            if item != "*" and name + "." + item not in sys.modules and not hasattr(sys.modules[name], item):
+                return name + "." + item
+        return None
+
+    def mark(self, step):
+        """
+        Record the end of a startup step.
+        """
+
+        self.steps.append((step, time.perf_counter() - self.start))
+
+    def report(self, file=None, count=25):
+        """
+        Print the slowest top-level imports (with their slowest nested imports) and the startup steps.
+        """
+
+        if file is None:
+            file = sys.stderr
+
+        total = sum([record[3] for record in self.records if record[1] == 0])
+
+        print("import time: self [ms] | cumulative [ms] | imported module", file=file)
+        for module, depth, self_time, cumulative in sorted(self.records, key=lambda record: -record[3])[:count]:
+            print("import time: {:9.1f} | {:15.1f} | {:s}{:s}".format(1000.0 * self_time, 1000.0 * cumulative,
+                                                                     "  " * depth, module), file=file)
+        print("import time: total of the imports {:.1f} ms".format(1000.0 * total), file=file)
+
+        for step, seconds in self.steps:
+            print("startup: {:s} after {:.1f} ms".format(step, 1000.0 * seconds), file=file)
@@ -0,0 +1,222 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE INCREMENTAL READING OF THE JSON PROJECTS.
+#
+# The file is read in chunks and the values are decoded one by one with json.JSONDecoder.raw_decode().
+# The structure of the document is followed by readObject() and readArray(), so the elements of a large
+# array (e.g. the blobs of an image) can be converted while they are read and the json document is never
+# entirely in memory.
+
+import re
+import json
+import codecs
+
+# the characters delimiting the strings, the arrays and the objects
+DELIMITERS = re.compile(r'["\[\]{}]')
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+
+# the characters that can continue a number
+NUMBER = "0123456789.eE+-"
+
+
+class JsonStreamReader(object):
+
+    def __init__(self, f, size=None, progress=None, chunk_size=1 << 20):
+        """
+        :param f: file opened in binary mode
+        :param size: size of the file in bytes (used for the progress)
+        :param progress: function called as progress(bytes_read, size) after each chunk read
+        """
+
+        self.file = f
+        self.size = size
+        self.progress = progress
+        self.chunk_size = chunk_size
+
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+        self.buffer = ""
+        self.pos = 0            # position of the next character to read in the buffer
+        self.offset = 0         # position of the first character of the buffer in the document
+        self.bytes_read = 0
+        self.eof = False
+
+    def fill(self, min_size):
+        """
+        Drop the characters already read and append (at least) min_size new characters to the buffer.
+        """
+
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+
+        data = self.file.read(max(self.chunk_size, min_size))
+        self.bytes_read += len(data)
+        self.eof = len(data) == 0
+        self.buffer += self.text_decoder.decode(data, final=self.eof)
+
+        if self.progress is not None:
+            self.progress(self.bytes_read, self.size)
+
+    def error(self, message, pos=None):
+
+        if pos is None:
+            pos = self.pos
+        return ValueError(message + " (char {:d})".format(self.offset + pos))
+
+    def peek(self):
+        """
+        It returns the next non-whitespace character (empty at the end of the document).
+        """
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.fill(0)
+
+    def expect(self, ch):
+
+        if self.peek() != ch:
+            raise self.error("Expecting '" + ch + "'")
+        self.pos += 1
+
+    def readValue(self):
+        """
+        It reads and decodes the next value of the document.
+        """
+
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number cut by the end of the buffer (e.g. "1." or "2e") may continue in the next chunk
+                number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self.eof or not number or (end < len(self.buffer) and self.buffer[end] not in NUMBER):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise self.error(e.msg, e.pos)
+
+            # the value continues after the end of the buffer, the available data is doubled
+            self.fill(len(self.buffer) - self.pos)
+
+    def readRaw(self):
+        """
+        It returns the text of the next value (an array or an object) without decoding it.
+        """
+
+        if self.peek() not in ["[", "{"]:
+            raise self.error("Expecting an array or an object")
+
+        start = self.pos
+        pos = self.pos
+        depth = 0
+
+        while True:
+
+            m = DELIMITERS.search(self.buffer, pos)
+            if m is not None:
+                ch = m.group()
+                if ch == '"':
+                    string = STRING.match(self.buffer, m.start())
+                    if string is not None:
+                        pos = string.end()
+                        continue
+                    pos = m.start()
+                elif ch == "[" or ch == "{":
+                    depth += 1
+                    pos = m.end()
+                    continue
+                else:
+                    depth -= 1
+                    pos = m.end()
+                    if depth == 0:
+                        self.pos = pos
+                        return self.buffer[start:pos]
+                    continue
+            else:
+                pos = len(self.buffer)
+
+            # the value continues after the end of the buffer
+            if self.eof:
+                raise self.error("Unterminated value", start)
+
+            self.pos = start
+            self.fill(len(self.buffer) - start)
+            pos -= start
+            start = 0
+
+    def readObject(self, handlers={}):
+        """
+        It reads an object. The value of the keys in handlers is read by calling the corresponding handler,
+        a function without arguments that reads the value from this stream.
+        """
+
+        self.expect("{")
+        data = {}
+
+        if self.peek() == "}":
+            self.pos += 1
+            return data
+
+        while True:
+
+            key = self.readValue()
+            if not isinstance(key, str):
+                raise self.error("Expecting property name")
+            self.expect(":")
+
+            handler = handlers.get(key)
+            data[key] = handler() if handler is not None else self.readValue()
+
+            ch = self.peek()
+            self.pos += 1
+            if ch == "}":
+                return data
+            if ch != ",":
+                raise self.error("Expecting ',' delimiter", self.pos - 1)
+
+    def readArray(self, item):
+        """
+        It reads an array, each element is read by item() (e.g. readValue, or a function converting it).
+        """
+
+        self.expect("[")
+        elements = []
+
+        if self.peek() == "]":
+            self.pos += 1
+            return elements
+
+        while True:
+
+            elements.append(item())
+
+            ch = self.peek()
+            self.pos += 1
+            if ch == "]":
+                return elements
+            if ch != ",":
+                raise self.error("Expecting ',' delimiter", self.pos - 1)
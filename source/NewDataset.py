@@ -24,11 +24,101 @@ from PyQt5.QtGui import QPainter, QImage, QPen, QBrush, QColor, qRgb
 from PyQt5.QtCore import Qt
 import random as rnd
 from source import utils
+from models.dataset_shard import ShardWriter
 from skimage.filters import gaussian
 from skimage.segmentation import find_boundaries
 from skimage import measure
 import glob
 import sys
+import cv2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class SampleGrid(object):
+	"""
+	Spatial hash grid of the accepted samples. The Poisson disk condition of a candidate is checked only
+	against the samples in the cells around it, instead of against all the samples.
+	"""
+
+	def __init__(self, samples, cell_size):
+
+		self.cell_size = max(float(cell_size), 1.0)
+		self.cells = {}
+
+		for sample in samples:
+			self.insert(sample)
+
+	def insert(self, sample):
+
+		key = (int(sample[0] // self.cell_size), int(sample[1] // self.cell_size))
+		cell = self.cells.get(key)
+		if cell is None:
+			self.cells[key] = [sample]
+		else:
+			cell.append(sample)
+
+	def neighbours(self, px, py, reach):
+		"""
+		It returns the samples that can be closer than reach to the point (px, py).
+		"""
+
+		cx = int(px // self.cell_size)
+		cy = int(py // self.cell_size)
+		n = int(math.ceil(reach / self.cell_size))
+
+		samples = []
+		for y in range(cy - n, cy + n + 1):
+			for x in range(cx - n, cx + n + 1):
+				cell = self.cells.get((x, y))
+				if cell is not None:
+					samples.extend(cell)
+
+		return samples
+
+
+class TileIndex(object):
+	"""
+	Grid index of square tiles of the same size (the tiles are stored as (cx, cy)). Two tiles can overlap only
+	if their centers are closer than the tile size along both the axes, so each query checks the 3 x 3 cells
+	around the tile instead of all the tiles.
+	"""
+
+	def __init__(self, tiles, tile_size):
+
+		self.tile_size = float(tile_size)
+		self.cells = {}
+
+		for tile in tiles:
+			self.insert(tile)
+
+	def insert(self, tile):
+
+		key = (int(tile[0] // self.tile_size), int(tile[1] // self.tile_size))
+		cell = self.cells.get(key)
+		if cell is None:
+			self.cells[key] = [tile]
+		else:
+			cell.append(tile)
+
+	def overlaps(self, tile, min_area=10.0):
+		"""
+		It returns True if the given tile intersects one of the tiles of the index for more than min_area pixels.
+		"""
+
+		cx = int(tile[0] // self.tile_size)
+		cy = int(tile[1] // self.tile_size)
+
+		for y in range(cy - 1, cy + 2):
+			for x in range(cx - 1, cx + 2):
+				cell = self.cells.get((x, y))
+				if cell is not None:
+					for other in cell:
+						w = self.tile_size - abs(other[0] - tile[0])
+						h = self.tile_size - abs(other[1] - tile[1])
+						if w > 0 and h > 0 and w * h > min_area:
+							return True
+
+		return False
 
 
 class NewDataset(object):
@@ -55,12 +145,15 @@ class NewDataset(object):
 
 		self.label_image = None
 		self.labels = None
+		self.label_colors = None
+		self.target_classes = []
 
 		self.crop_size = 513
 
 		self.frequencies = None
 
 		self.radius_map = None
+		self.radius_max = 0.0
 
 		# normalization factors
 		self.sn_min = 0.0
@@ -79,14 +172,21 @@ class NewDataset(object):
 		height = working_area[3]
 
 		crop_ortho_image = self.ortho_image.copy(x, y, width, height)
-		crop_label_image = self.label_image.copy(x, y, width, height)
+		crop_labels = utils.cropNumpyArray(self.labels, int(y), int(x), int(width), int(height))
 
 		scale = target_scale/current_scale
 		w = crop_ortho_image.width()*scale
 		h = crop_ortho_image.height()*scale
 
 		self.ortho_image = crop_ortho_image.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
-		self.label_image = crop_label_image.scaled(w, h, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+
+		# nearest neighbor, the labels are class indices
+		size = (self.ortho_image.width(), self.ortho_image.height())
+		if size != (crop_labels.shape[1], crop_labels.shape[0]):
+			crop_labels = cv2.resize(crop_labels, size, interpolation=cv2.INTER_NEAREST)
+
+		self.labels = crop_labels
+		self.label_image = None
 
 
 	def isFullyInsideBBox(self, bbox1, bbox2):
@@ -279,6 +379,149 @@ class NewDataset(object):
 		return number, coverage, PSCV
 
 
+	def calculateMetricsBatch(self, areas, target_classes):
+		"""
+		Vectorized version of calculateMetrics() for many areas at once. The areas are given as an array K x 4
+		of (top, left, width, height). It returns three arrays K x C (number, coverage and PSCV per class).
+
+		The coverage is computed with a summed-area table of each class, built by strips of rows: only its values
+		at the corners of the areas are kept. The blobs are sorted by the x coordinate of the center of their
+		bounding box. A blob inside an area for more than 3/4 has the center of its bounding box inside the area,
+		so only the (area, blob) pairs found by np.searchsorted on the sorted centers are checked.
+		"""
+
+		areas = np.asarray(areas, dtype=np.int64)
+		K = areas.shape[0]
+		C = len(target_classes)
+
+		top = areas[:, 0]
+		left = areas[:, 1]
+		right = left + areas[:, 2]
+		bottom = top + areas[:, 3]
+
+		##### COVERAGE
+
+		H = self.labels.shape[0]
+		W = self.labels.shape[1]
+		t = np.clip(top, 0, H)
+		b = np.clip(bottom, 0, H)
+		l = np.clip(left, 0, W)
+		r = np.clip(right, 0, W)
+		A = (areas[:, 2] * areas[:, 3]).astype(float)
+
+		# corners of the areas, grouped by the strip of rows of the summed-area table they fall in
+		# (the row 0 of the table is zero)
+		ys = np.concatenate([t, t, b, b])
+		xs = np.concatenate([l, r, l, r])
+		strip_rows = max(1, (1 << 22) // (W + 1))
+		strips = (H + strip_rows - 1) // strip_rows
+		corner_strip = np.where(ys > 0, (ys - 1) // strip_rows, -1)
+		corner_order = np.argsort(corner_strip, kind='stable')
+		corner_bounds = np.searchsorted(corner_strip[corner_order], np.arange(strips + 1))
+
+		coverage = np.zeros((K, C))
+		for i in range(C):
+			values = np.zeros(len(ys), dtype=np.int64)
+			previous = np.zeros(W + 1, dtype=np.int64)
+			for s in range(strips):
+				y0 = s * strip_rows
+				y1 = min(y0 + strip_rows, H)
+				sat = np.zeros((y1 - y0, W + 1), dtype=np.int64)
+				np.cumsum(self.labels[y0:y1] == i + 1, axis=1, out=sat[:, 1:])
+				np.cumsum(sat, axis=0, out=sat)
+				sat += previous
+				corners = corner_order[corner_bounds[s]:corner_bounds[s + 1]]
+				values[corners] = sat[ys[corners] - 1 - y0, xs[corners]]
+				previous = sat[-1].copy()
+			tl, tr, bl, br = np.split(values, 4)
+			coverage[:, i] = (br - tr - bl + tl) / A
+
+		##### NUMBER OF BLOBS AND PSCV
+
+		class_index = {}
+		for i, class_name in enumerate(target_classes):
+			if self.frequencies[i] > 0.0:
+				class_index[class_name] = i
+
+		blobs = [blob for blob in self.blobs if blob.class_name in class_index and blob.bbox[2] * blob.bbox[3] > 0]
+
+		number = np.zeros((K, C), dtype=np.int64)
+		PSCV = np.zeros((K, C))
+
+		if len(blobs) > 0:
+			bboxes = np.array([blob.bbox for blob in blobs], dtype=float)
+			blob_top = bboxes[:, 0]
+			blob_left = bboxes[:, 1]
+			blob_right = blob_left + bboxes[:, 2]
+			blob_bottom = blob_top + bboxes[:, 3]
+			blob_size = bboxes[:, 2] * bboxes[:, 3]
+			blob_area = np.array([blob.area for blob in blobs], dtype=float)
+			blob_class = np.array([class_index[blob.class_name] for blob in blobs], dtype=np.int64)
+
+			center_x = blob_left + bboxes[:, 2] / 2.0
+			order = np.argsort(center_x)
+			center_x = center_x[order]
+
+			first = np.searchsorted(center_x, left, side='left')
+			last = np.searchsorted(center_x, right, side='right')
+			counts = last - first
+			offsets = np.concatenate([[0], np.cumsum(counts)])
+
+			# the (area, blob) pairs are processed in batches of consecutive areas of at most MAX_PAIRS pairs
+			MAX_PAIRS = 1 << 22
+			k0 = 0
+			while k0 < K:
+				k1 = int(np.searchsorted(offsets, offsets[k0] + MAX_PAIRS, side='right')) - 1
+				k1 = min(max(k1, k0 + 1), K)
+
+				pair_count = counts[k0:k1]
+				pair_area = np.repeat(np.arange(k0, k1), pair_count)
+				pair_start = first[k0:k1] - (offsets[k0:k1] - offsets[k0])
+				pair_pos = np.arange(offsets[k1] - offsets[k0]) + np.repeat(pair_start, pair_count)
+				idx = order[pair_pos]
+
+				ix = np.minimum(blob_right[idx], right[pair_area]) - np.maximum(blob_left[idx], left[pair_area])
+				iy = np.minimum(blob_bottom[idx], bottom[pair_area]) - np.maximum(blob_top[idx], top[pair_area])
+				inside = (ix >= 0) & (iy >= 0) & (ix * iy > 0.75 * blob_size[idx])
+
+				key = (pair_area[inside] - k0) * C + blob_class[idx[inside]]
+				size = (k1 - k0) * C
+				n = np.bincount(key, minlength=size).reshape(k1 - k0, C)
+				a1 = np.bincount(key, weights=blob_area[idx[inside]], minlength=size).reshape(k1 - k0, C)
+				a2 = np.bincount(key, weights=blob_area[idx[inside]] ** 2, minlength=size).reshape(k1 - k0, C)
+
+				present = n > 0
+				mean_areas = a1[present] / n[present]
+				std_areas = np.sqrt(np.maximum(a2[present] / n[present] - mean_areas * mean_areas, 0.0))
+
+				number[k0:k1] = n
+				PSCV[k0:k1][present] = (100.0 * std_areas) / mean_areas
+
+				k0 = k1
+
+		return number, coverage, PSCV
+
+
+	def rangeScoreBatch(self, area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV):
+		"""
+		Vectorized version of rangeScore(), the area metrics are arrays K x C.
+		"""
+
+		landscape_number = np.asarray(landscape_number, dtype=float)
+		valid = landscape_number > 0
+		safe_number = np.where(valid, landscape_number, 1.0)
+
+		s1 = np.abs((area_number / safe_number) * 100.0 - 15.0)
+		s2 = np.abs((area_coverage - np.asarray(landscape_coverage)) * 100.0)
+		s3 = np.abs(area_PSCV - np.asarray(landscape_PSCV))
+
+		s1[:, ~valid] = 0.0
+		s2[:, ~valid] = 0.0
+		s3[:, ~valid] = 0.0
+
+		return s1, s2, s3
+
+
 	def rangeScore(self, area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV):
 
 		s1 = []
@@ -365,65 +608,44 @@ class NewDataset(object):
 
 		landscape_number, landscape_coverage, landscape_PSCV = self.calculateMetrics([0, 0, map_w, map_h], target_classes)
 
-		# calculate normalization factor
-		numbers = []
-		coverages = []
-		PSCVs = []
-		sn = []
-		sc = []
-		sP = []
-		for i in range(5000):
-
-			aspect_ratio_factor = factor = rnd.uniform(0.4, 2.5)
-			w = int(area_w / aspect_ratio_factor)
-			h = int(area_h * aspect_ratio_factor)
-			px = rnd.randint(0, map_w - w - 1)
-			py = rnd.randint(0, map_h - h - 1)
-
-			area_bbox = [py, px, w, h]
-			area_number, area_coverage, area_PSCV = self.calculateMetrics(area_bbox, target_classes)
-			s1, s2, s3 = self.rangeScore(area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV)
-
-			numbers.append(area_number)
-			coverages.append(area_coverage)
-			PSCVs.append(area_PSCV)
-
-			sn.append(s1)
-			sc.append(s2)
-			sP.append(s3)
-
-		sn = np.array(sn)
-		sc = np.array(sc)
-		sP = np.array(sP)
-		self.sn_min = np.min(sn, axis=0)
-		self.sn_max = np.max(sn, axis=0)
-		self.sc_min = np.min(sc, axis=0)
-		self.sc_max = np.max(sc, axis=0)
-		self.sP_min = np.min(sP, axis=0)
-		self.sP_max = np.max(sP, axis=0)
-
-		for i in range(10000):
-
-			aspect_ratio_factor = factor = rnd.uniform(0.4, 2.5)
-			w = int(area_w / aspect_ratio_factor)
-			h = int(area_h * aspect_ratio_factor)
-
-			px = rnd.randint(0, map_w - w - 1)
-			py = rnd.randint(0, map_h - h - 1)
+		# random candidate areas: the first 5000 are used to calculate the normalization factors,
+		# the other 10000 are the candidates for the validation and the test area
+		N_NORMALIZATION = 5000
+		N_CANDIDATES = 10000
+		N = N_NORMALIZATION + N_CANDIDATES
 
-			area_bbox = [py, px, w, h]
+		aspect_ratio_factor = np.random.uniform(0.4, 2.5, size=N)
+		w = (area_w / aspect_ratio_factor).astype(np.int64)
+		h = (area_h * aspect_ratio_factor).astype(np.int64)
+		px = (np.random.uniform(size=N) * (map_w - w)).astype(np.int64)
+		py = (np.random.uniform(size=N) * (map_h - h)).astype(np.int64)
+		areas = np.stack([py, px, w, h], axis=1)
 
-			area_number, area_coverage, area_PSCV = self.calculateMetrics(area_bbox, target_classes)
-			scores = self.calculateNormalizedScore(area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV)
-
-			for i, score in enumerate(scores):
-				if math.isnan(score):
-					scores[i] = 0.0
-
-			aggregated_score = sum(scores) / len(scores)
-
-			area_info.append((area_bbox, scores, aggregated_score))
+		numbers, coverages, PSCVs = self.calculateMetricsBatch(areas, target_classes)
+		sn, sc, sP = self.rangeScoreBatch(numbers, coverages, PSCVs, landscape_number, landscape_coverage, landscape_PSCV)
 
+		# calculate normalization factor
+		self.sn_min = np.min(sn[:N_NORMALIZATION], axis=0)
+		self.sn_max = np.max(sn[:N_NORMALIZATION], axis=0)
+		self.sc_min = np.min(sc[:N_NORMALIZATION], axis=0)
+		self.sc_max = np.max(sc[:N_NORMALIZATION], axis=0)
+		self.sP_min = np.min(sP[:N_NORMALIZATION], axis=0)
+		self.sP_max = np.max(sP[:N_NORMALIZATION], axis=0)
+
+		# normalized scores of the candidates (same as calculateNormalizedScore())
+		with np.errstate(divide='ignore', invalid='ignore'):
+			snorm = (sn[N_NORMALIZATION:] - self.sn_min) / (self.sn_max - self.sn_min)
+			scnorm = (sc[N_NORMALIZATION:] - self.sc_min) / (self.sc_max - self.sc_min)
+			sPnorm = (sP[N_NORMALIZATION:] - self.sP_min) / (self.sP_max - self.sP_min)
+			scores = (snorm + scnorm + sPnorm) / 3.0
+
+		scores[:, np.asarray(landscape_number) == 0] = 0.0
+		scores[np.isnan(scores)] = 0.0
+		aggregated_scores = np.mean(scores, axis=1)
+
+		for k in range(N_CANDIDATES):
+			area_bbox = [int(value) for value in areas[N_NORMALIZATION + k]]
+			area_info.append((area_bbox, list(scores[k]), aggregated_scores[k]))
 
 		area_info.sort(key=lambda x:x[2])
 		val_area = area_info[0][0]
@@ -476,64 +698,73 @@ class NewDataset(object):
 
 
 
-	def createLabelImage(self, labels_info):
+	def createLabels(self, target_classes, labels_info):
 		"""
-		It converts the blobs in the label image.
+		It rasterizes the visible blobs directly in the map of the class indices (self.labels, uint8).
+		A pixel of the i-th target class has value i + 1, the pixels of the other classes have value 0.
+		The pixels not covered by any blob and the "Empty" blobs belong to the Background class (if it is a
+		target class). The colors of the classes are stored in self.label_colors (indexed by the label values).
 		"""
 
-		# create a black canvas of the same size of your map
 		w = self.ortho_image.width()
 		h = self.ortho_image.height()
 
-		labelimg = QImage(w, h, QImage.Format_RGB32)
-		labelimg.fill(qRgb(0, 0, 0))
+		if len(target_classes) > 254:
+			raise Exception("Too many classes for a dataset.")
 
-		painter = QPainter(labelimg)
+		self.target_classes = list(target_classes)
 
-		# CREATE LABEL IMAGE
-		for i, blob in enumerate(self.blobs):
+		self.label_colors = np.zeros((256, 3), dtype=np.uint8)
+		class_values = {}
+		for i, cl in enumerate(target_classes):
+			class_values[cl] = i + 1
+			class_colors = labels_info.get(cl)
+			if class_colors is None:
+				if cl == "Background":
+					class_colors = [0, 0, 0]
+				else:
+					class_colors = [255, 255, 255]
+			self.label_colors[i + 1] = class_colors
 
-			if blob.qpath_gitem.isVisible():
+		background = class_values.get("Background", 0)
 
-				if blob.qpath_gitem.isVisible():
+		self.labels = np.zeros((h, w), dtype=np.uint8)
+		self.labels[:] = background
 
-					if blob.class_name == "Empty":
-						rgb = qRgb(0, 0, 0)
-					else:
-						class_color = labels_info[blob.class_name]
-						rgb = qRgb(class_color[0], class_color[1], class_color[2])
+		for blob in self.blobs:
 
-					painter.setBrush(QBrush(QColor(rgb)))
-					painter.drawPath(blob.qpath_gitem.path())
+			# the blobs are painted in order, the holes keep the pixels below
+			if blob.qpath_gitem is not None and not blob.qpath_gitem.isVisible():
+				continue
 
-		painter.end()
+			if blob.class_name == "Empty":
+				value = background
+			else:
+				value = class_values.get(blob.class_name, 0)
 
-		self.label_image = labelimg
+			top = int(blob.bbox[0])
+			left = int(blob.bbox[1])
+			mask = blob.getMask()
 
+			y1 = max(top, 0)
+			x1 = max(left, 0)
+			y2 = min(top + mask.shape[0], h)
+			x2 = min(left + mask.shape[1], w)
+			if y2 <= y1 or x2 <= x1:
+				continue
 
-	def convert_colors_to_labels(self, target_classes, labels_colors):
-		"""
-		Convert the label image to a numpy array with the labels' values.
-		"""
+			region = self.labels[y1:y2, x1:x2]
+			region[mask[y1 - top:y2 - top, x1 - left:x2 - left] == 1] = value
 
-		label_w = self.label_image.width()
-		label_h = self.label_image.height()
+		self.label_image = None
 
-		imglbl = utils.qimageToNumpyArray(self.label_image)
 
-		num_classes = len(target_classes)
+	def createLabelImage(self):
+		"""
+		It creates a color preview of the labels (used only for visualization, see save_samples()).
+		"""
 
-		# class 0 --> background
-		self.labels = np.zeros((label_h, label_w), dtype='int64')
-		for i, cl in enumerate(target_classes):
-			class_colors = labels_colors.get(cl)
-			if class_colors is None:
-				if cl == "Background":
-					class_colors = [0, 0, 0]
-				else:
-					class_colors = [255, 255, 255]
-			idx = np.where((imglbl[:, :, 0] == class_colors[0]) & (imglbl[:, :, 1] == class_colors[1]) & (imglbl[:, :, 2] == class_colors[2]))
-			self.labels[idx] = i + 1
+		self.label_image = utils.rgbToQImage(self.label_colors[self.labels])
 
 
 	def setupAreas(self, mode, target_classes=None):
@@ -645,49 +876,12 @@ class NewDataset(object):
 		If a training tile intersect a validation or a test tile it is removed.
 		"""
 
-		cleaned_tiles = []
-		bbox1 = [0, 0, 0, 0]
-		bbox2 = [0, 0, 0, 0]
 		size = self.crop_size + 4
 		half_size = int(size / 2)
 
-		for tile in training_tiles:
-
-			bbox1[0] = tile[1] - half_size
-			bbox1[1] = tile[0] - half_size
-			bbox1[2] = half_size * 2
-			bbox1[3] = half_size * 2
-
-			flag = True
-			for vtile in self.validation_tiles:
-
-				bbox2[0] = vtile[1] - half_size
-				bbox2[1] = vtile[0] - half_size
-				bbox2[2] = half_size * 2
-				bbox2[3] = half_size * 2
-
-				area = self.bbox_intersection(bbox1, bbox2)
-				if area > 10.0:
-					flag = False
-					break
-
-			if flag is True:
-				for ttile in self.test_tiles:
-
-					bbox2[0] = ttile[1] - half_size
-					bbox2[1] = ttile[0] - half_size
-					bbox2[2] = half_size * 2
-					bbox2[3] = half_size * 2
-
-					area = self.bbox_intersection(bbox1, bbox2)
-					if area > 10.0:
-						flag = False
-						break
+		index = TileIndex(self.validation_tiles + self.test_tiles, half_size * 2)
 
-			if flag is True:
-				cleaned_tiles.append(tile)
-
-		return cleaned_tiles
+		return [tile for tile in training_tiles if not index.overlaps(tile, 10.0)]
 
 
 	def cleaningValidationTiles(self, validation_tiles):
@@ -695,47 +889,12 @@ class NewDataset(object):
 		It can be required by the oversampling.
 		"""
 
-		cleaned_tiles = []
-		bbox1 = [0, 0, 0, 0]
-		bbox2 = [0, 0, 0, 0]
 		size = self.crop_size + 4
 		half_size = size / 2
 
-		for vtile in validation_tiles:
-
-			bbox1[0] = vtile[1] - half_size
-			bbox1[1] = vtile[0] - half_size
-			bbox1[2] = half_size * 2
-			bbox1[3] = half_size * 2
+		index = TileIndex(self.training_tiles + self.test_tiles, half_size * 2)
 
-			flag = True
-			for ttile in self.training_tiles:
-
-				bbox2[0] = ttile[1] - half_size
-				bbox2[1] = ttile[0] - half_size
-				bbox2[2] = half_size * 2
-				bbox2[3] = half_size * 2
-
-				area = self.bbox_intersection(bbox1, bbox2)
-				if area > 10.0:
-					flag = False
-
-			if flag is True:
-				for tile in self.test_tiles:
-
-					bbox2[0] = tile[1] - half_size
-					bbox2[1] = tile[0] - half_size
-					bbox2[2] = half_size * 2
-					bbox2[3] = half_size * 2
-
-					area = self.bbox_intersection(bbox1, bbox2)
-					if area > 10.0:
-						flag = False
-
-			if flag is True:
-				cleaned_tiles.append(vtile)
-
-		return cleaned_tiles
+		return [vtile for vtile in validation_tiles if not index.overlaps(vtile, 10.0)]
 
 
 	def computeRadiusMap(self, radius_min, radius_max):
@@ -760,44 +919,30 @@ class NewDataset(object):
 			self.radius_map[self.labels == i] = r
 
 		self.radius_map = gaussian(self.radius_map, sigma=60.0, mode='reflect')
+		self.radius_max = float(np.max(self.radius_map))
 
 
-	def sampleBlobWimportanceSampling(self, blob, current_samples):
+	def sampleBlobWimportanceSampling(self, blob, current_samples, grid):
 
 		offset_x = blob.bbox[1]
 		offset_y = blob.bbox[0]
 		w = blob.bbox[2]
 		h = blob.bbox[3]
 
+		if w < 2 or h < 2:
+			return current_samples
+
 		# NOTE: MASK HAS HOLES (!) DO WE WANT TO SAMPLE INSIDE THEM ??
 		mask = blob.getMask()
 
-		for i in range(30):
-			px = rnd.randint(1, w - 1)
-			py = rnd.randint(1, h - 1)
-
-			if mask[py, px] == 1:
-
-				px = px + offset_x
-				py = py + offset_y
+		px = np.random.randint(1, w, size=30)
+		py = np.random.randint(1, h, size=30)
+		inside = mask[py, px] == 1
 
-				r1 = self.radius_map[py, px]
+		return self.acceptWImportanceSampling(px[inside] + offset_x, py[inside] + offset_y, current_samples, grid)
 
-				flag = True
-				for sample in current_samples:
-					r2 = self.radius_map[sample[1], sample[0]]
-					d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-					if d < (r1 + r2) / 2.0:
-						flag = False
-						break
 
-				if flag is True:
-					current_samples.append((px, py))
-
-		return current_samples
-
-
-	def sampleSubAreaWImportanceSampling(self, area, current_samples):
+	def sampleSubAreaWImportanceSampling(self, area, current_samples, grid):
 		"""
 		Sample the given area using the Poisson Disk sampling according to the given radius map.
 		The area is stored as (top, left, width, height).
@@ -808,27 +953,65 @@ class NewDataset(object):
 		w = area[2]
 		h = area[3]
 
-		for i in range(30):
-			px = rnd.randint(left, left + w - 1)
-			py = rnd.randint(top, top + h - 1)
+		px = np.random.randint(left, left + w, size=30)
+		py = np.random.randint(top, top + h, size=30)
+
+		return self.acceptWImportanceSampling(px, py, current_samples, grid)
+
+
+	def acceptWImportanceSampling(self, candidates_x, candidates_y, current_samples, grid):
+		"""
+		Add the candidates to the current samples in order, discarding the ones closer than (r1 + r2) / 2
+		to an accepted sample, where r1 and r2 are the values of the radius map at the two points.
+		The grid holds the current samples, the accepted candidates are inserted in it.
+		"""
+
+		radii = self.radius_map[candidates_y, candidates_x]
 
-			r1 = self.radius_map[py, px]
+		for px, py, r1 in zip(candidates_x.tolist(), candidates_y.tolist(), radii.tolist()):
 
 			flag = True
-			for sample in current_samples:
+			for sample in grid.neighbours(px, py, (r1 + self.radius_max) / 2.0):
 				r2 = self.radius_map[sample[1], sample[0]]
-				d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-				if d < (r1+r2)/2.0:
+				dx = sample[0] - px
+				dy = sample[1] - py
+				if dx * dx + dy * dy < ((r1 + r2) / 2.0) ** 2:
 					flag = False
 					break
 
 			if flag is True:
 				current_samples.append((px, py))
+				grid.insert((px, py))
 
 		return current_samples
 
 
-	def sampleBlobWPoissonDisk(self, blob, current_samples, r):
+	def acceptWPoissonDisk(self, candidates_x, candidates_y, current_samples, grid, r):
+		"""
+		Add the candidates to the current samples in order, discarding the ones closer than 2r to an accepted sample.
+		The grid holds the current samples, the accepted candidates are inserted in it.
+		"""
+
+		d2 = (2.0 * r) ** 2
+
+		for px, py in zip(candidates_x.tolist(), candidates_y.tolist()):
+
+			flag = True
+			for sample in grid.neighbours(px, py, 2.0 * r):
+				dx = sample[0] - px
+				dy = sample[1] - py
+				if dx * dx + dy * dy < d2:
+					flag = False
+					break
+
+			if flag is True:
+				current_samples.append((px, py))
+				grid.insert((px, py))
+
+		return current_samples
+
+
+	def sampleBlobWPoissonDisk(self, blob, current_samples, grid, r):
 
 		map_w = self.ortho_image.width()
 		map_h = self.ortho_image.height()
@@ -838,60 +1021,38 @@ class NewDataset(object):
 		w = blob.bbox[2]
 		h = blob.bbox[3]
 
+		if w < 2 or h < 2:
+			return current_samples
+
 		# NOTE: MASK HAS HOLES (!) DO WE WANT TO SAMPLE INSIDE THEM ??
 		mask = blob.getMask()
 
-		for i in range(500):
-			px = rnd.randint(1, w - 1)
-			py = rnd.randint(1, h - 1)
+		px = np.random.randint(1, w, size=500)
+		py = np.random.randint(1, h, size=500)
+		valid = mask[py, px] == 1
 
-			if mask[py, px] == 1:
+		px = px + offset_x
+		py = py + offset_y
+		valid &= (px > self.crop_size) & (px < map_w - self.crop_size) & (py > self.crop_size) & (py < map_h - self.crop_size)
 
-				px = px + offset_x
-				py = py + offset_y
-
-				if px > self.crop_size and px < map_w - self.crop_size and py > self.crop_size and py < map_h - self.crop_size:
-
-					flag = True
-					for sample in current_samples:
-						d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-						if d < 2.0*r:
-							flag = False
-							break
-
-					if flag is True:
-						current_samples.append((px, py))
-
-		return current_samples
+		return self.acceptWPoissonDisk(px[valid], py[valid], current_samples, grid, r)
 
 
-	def sampleBackgroundWPoissonDisk(self, area, current_samples, r):
+	def sampleBackgroundWPoissonDisk(self, area, current_samples, grid, r):
 
 		offset_x = int(area[1])
 		offset_y = int(area[0])
 		w = int(area[2])
 		h = int(area[3])
 
-		for i in range(10000):
-			px = rnd.randint(1, w - 1)
-			py = rnd.randint(1, h - 1)
+		if w < 2 or h < 2:
+			return current_samples
 
-			if self.labels[py, px] == 0:
+		px = np.random.randint(1, w, size=10000)
+		py = np.random.randint(1, h, size=10000)
+		valid = self.labels[py, px] == 0
 
-				px = px + offset_x
-				py = py + offset_y
-
-				flag = True
-				for sample in current_samples:
-					d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-					if d < 2.0*r:
-						flag = False
-						break
-
-				if flag is True:
-					current_samples.append((px, py))
-
-		return current_samples
+		return self.acceptWPoissonDisk(px[valid] + offset_x, py[valid] + offset_y, current_samples, grid, r)
 
 
 	def oversamplingBlobsWPoissonDisk(self, area, classes_to_sample, radii):
@@ -901,17 +1062,22 @@ class NewDataset(object):
 		The functions returns a list of (x,y) coordinates.
 		"""
 
+		background_radius = 280.0
+
+		# a single grid of the samples is used for all the radii, its cells are as large as the largest disk
+		grid = SampleGrid([], 2.0 * max([background_radius] + list(radii)))
+
 		# minority classes are sampled before majority classes
 		samples = []
 		for i, class_name in enumerate(classes_to_sample):
 			radius = radii[i]
 			for blob in self.blobs:
 				if blob.class_name == class_name:
-					samples = self.sampleBlobWPoissonDisk(blob, samples, radius)
+					samples = self.sampleBlobWPoissonDisk(blob, samples, grid, radius)
 					txt = str(len(samples)) + "\r"
 					sys.stdout.write(txt)
 
-		samples = self.sampleBackgroundWPoissonDisk(area=area, current_samples=samples, r=280.0)
+		samples = self.sampleBackgroundWPoissonDisk(area=area, current_samples=samples, grid=grid, r=background_radius)
 
 		return samples
 
@@ -923,12 +1089,14 @@ class NewDataset(object):
 		The functions returns a list of (x,y) coordinates.
 		"""
 
+		grid = SampleGrid([], self.radius_max)
+
 		# minority classes are sampled before majority classes
 		samples = []
 		for class_name in classes_to_sample:
 			for blob in self.blobs:
 				if blob.class_name == class_name:
-					samples = self.sampleBlobWimportanceSampling(blob, samples)
+					samples = self.sampleBlobWimportanceSampling(blob, samples, grid)
 					txt = str(len(samples)) + "\r"
 					sys.stdout.write(txt)
 
@@ -952,7 +1120,7 @@ class NewDataset(object):
 
 				sub_area = [top, left, tile_size, tile_size]
 
-				samples = self.sampleSubAreaWImportanceSampling(sub_area, samples)
+				samples = self.sampleSubAreaWImportanceSampling(sub_area, samples, grid)
 
 		return samples
 
@@ -1008,103 +1176,109 @@ class NewDataset(object):
 			self.validation_tiles = self.cleaningValidationTiles(self.validation_tiles)
 
 
-	def export_tiles(self, basename, tilename, labels_info):
+	def export_tiles(self, basename, tilename, labels_info, progress=None, workers=None):
 		"""
 		Exports the tiles INSIDE the given areas (val_area and test_area are stored as (top, left, width, height))
 		The training tiles are the ones of the entire map minus the ones inside the test validation and test area.
+
+		The tiles are cropped from a numpy view of the ortho image and from the labels, the PNG compression is
+		done by a pool of threads (cv2.imwrite releases the GIL). The progress callback, if given, is called
+		(on the calling thread) as progress(split_name, tiles_done, tiles_total).
 		"""
 
-		##### VALIDATION AREA
+		self.export_split(basename, "validation", self.validation_tiles, tilename, progress, workers)
+		self.export_split(basename, "test", self.test_tiles, tilename, progress, workers)
+		self.export_split(basename, "training", self.training_tiles, tilename, progress, workers)
 
-		basenameVim = os.path.join(basename, os.path.join("validation", "images"))
-		try:
-			os.makedirs(basenameVim)
-		except:
-			pass
+	def export_split(self, basename, split_name, tiles, tilename, progress=None, workers=None):
+		"""
+		Export the given tiles as PNG files in the <split_name>/images and <split_name>/labels folders.
+		The i-th tile is named <tilename>_<i>.png (four digits, zero-padded).
+		"""
 
-		basenameVlab = os.path.join(basename, os.path.join("validation", "labels"))
-		try:
-			os.makedirs(basenameVlab)
-		except:
-			pass
+		basenameIm = os.path.join(basename, os.path.join(split_name, "images"))
+		basenameLab = os.path.join(basename, os.path.join(split_name, "labels"))
+		os.makedirs(basenameIm, exist_ok=True)
+		os.makedirs(basenameLab, exist_ok=True)
 
-		half_tile_size = self.tile_size / 2
+		ortho_image = self.ortho_image
+		if ortho_image.format() != QImage.Format_RGB32 and ortho_image.format() != QImage.Format_ARGB32:
+			ortho_image = ortho_image.convertToFormat(QImage.Format_RGB32)
 
-		for i, sample in enumerate(self.validation_tiles):
+		# the view is valid until the image is alive (see the end of this function)
+		ortho_view = utils.qimageToNumpyView(ortho_image)
 
-			cx = sample[0]
-			cy = sample[1]
-			top = cy - half_tile_size
-			left = cx - half_tile_size
-			cropimg = utils.cropQImage(self.ortho_image, [top, left, self.tile_size, self.tile_size])
-			croplabel = utils.cropQImage(self.label_image, [top, left, self.tile_size, self.tile_size])
+		# RGB -> BGR, cv2 writes the channels in the RGB order
+		label_colors = np.ascontiguousarray(self.label_colors[:, ::-1])
 
-			filenameRGB = os.path.join(basenameVim, tilename + str.format("_{0:04d}", (i)) + ".png")
-			filenameLabel = os.path.join(basenameVlab, tilename + str.format("_{0:04d}", (i)) + ".png")
+		half_tile_size = int(self.tile_size / 2)
 
-			cropimg.save(filenameRGB)
-			croplabel.save(filenameLabel)
+		def writeTile(i, sample):
 
+			top = int(sample[1]) - half_tile_size
+			left = int(sample[0]) - half_tile_size
 
-		##### TEST AREA
+			name = tilename + str.format("_{0:04d}", (i)) + ".png"
 
-		basenameTestIm = os.path.join(basename, os.path.join("test", "images"))
-		try:
-			os.makedirs(basenameTestIm)
-		except:
-			pass
+			# BGRA -> BGR, cv2 writes the channels in the RGB order
+			crop = utils.cropNumpyArray(ortho_view, top, left, self.tile_size, self.tile_size)
+			cv2.imwrite(os.path.join(basenameIm, name), np.ascontiguousarray(crop[:, :, :3]))
 
-		basenameTestLab = os.path.join(basename, os.path.join("test", "labels"))
-		try:
-			os.makedirs(basenameTestLab)
-		except:
-			pass
+			crop = utils.cropNumpyArray(self.labels, top, left, self.tile_size, self.tile_size)
+			cv2.imwrite(os.path.join(basenameLab, name), label_colors[crop])
 
-		for i, sample in enumerate(self.test_tiles):
+		total = len(tiles)
+		if progress is not None:
+			progress(split_name, 0, total)
 
-			cx = sample[0]
-			cy = sample[1]
-			top = cy - half_tile_size
-			left = cx - half_tile_size
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [executor.submit(writeTile, i, sample) for i, sample in enumerate(tiles)]
+			for done, future in enumerate(as_completed(futures)):
+				future.result()
+				if progress is not None:
+					progress(split_name, done + 1, total)
 
-			cropimg = utils.cropQImage(self.ortho_image, [top, left, self.tile_size, self.tile_size])
-			croplabel = utils.cropQImage(self.label_image, [top, left, self.tile_size, self.tile_size])
+		del ortho_view
+
+	def export_shards(self, basename, tilename, labels_info):
+		"""
+		Exports the training and the validation tiles as packed shards (see models/dataset_shard.py) instead of
+		PNG files. The test tiles are still exported as PNG since they are browsed in the training results.
+		"""
 
-			filenameRGB = os.path.join(basenameTestIm, tilename + str.format("_{0:04d}", (i)) + ".png")
-			filenameLabel = os.path.join(basenameTestLab, tilename + str.format("_{0:04d}", (i)) + ".png")
+		# the values of the labels are stored as they are (0 is not a target class, see createLabels())
+		classes = ["Background"] + self.target_classes
+		colors = self.label_colors[:len(classes)].tolist()
 
-			cropimg.save(filenameRGB)
-			croplabel.save(filenameLabel)
+		self.export_shard(os.path.join(basename, "validation"), self.validation_tiles, tilename, classes, colors)
+		self.export_shard(os.path.join(basename, "training"), self.training_tiles, tilename, classes, colors)
 
-		##### TRAINING AREA = ENTIRE MAP / (VALIDATION AREA U TEST_AREA)
+		self.export_split(basename, "test", self.test_tiles, tilename)
 
-		basenameTrainIm = os.path.join(basename, os.path.join("training", "images"))
-		try:
-			os.makedirs(basenameTrainIm)
-		except:
-			pass
+	def export_shard(self, folder, tiles, tilename, classes, colors):
+		"""
+		Write the given tiles in a packed shard.
+		"""
 
-		basenameTrainLab = os.path.join(basename, os.path.join("training", "labels"))
-		try:
-			os.makedirs(basenameTrainLab)
-		except:
-			pass
+		half_tile_size = int(self.tile_size / 2)
+		writer = ShardWriter(folder, len(tiles), self.tile_size, classes, colors)
 
-		for i, sample in enumerate(self.training_tiles):
+		for i, sample in enumerate(tiles):
 
-			cx = sample[0]
-			cy = sample[1]
-			top = cy - half_tile_size
-			left = cx - half_tile_size
+			top = int(sample[1]) - half_tile_size
+			left = int(sample[0]) - half_tile_size
 
 			cropimg = utils.cropQImage(self.ortho_image, [top, left, self.tile_size, self.tile_size])
-			croplabel = utils.cropQImage(self.label_image, [top, left, self.tile_size, self.tile_size])
 
-			filenameRGB = os.path.join(basenameTrainIm, tilename + str.format("_{0:04d}", (i)) + ".png")
-			filenameLabel = os.path.join(basenameTrainLab, tilename + str.format("_{0:04d}", (i)) + ".png")
+			if cropimg.format() != QImage.Format_RGB32:
+				cropimg = cropimg.convertToFormat(QImage.Format_RGB32)
+
+			image = utils.qimageToNumpyArray(cropimg)
+			labels = utils.cropNumpyArray(self.labels, top, left, self.tile_size, self.tile_size)
 
-			cropimg.save(filenameRGB)
-			croplabel.save(filenameLabel)
+			writer.write(i, tilename + str.format("_{0:04d}", (i)), image, labels)
+
+		writer.close()
 
 
 	##### SERVICE FUNCTIONS
@@ -1169,6 +1343,9 @@ class NewDataset(object):
         Save a figure to show the samples in the different areas.
         """
 
+		if self.label_image is None:
+			self.createLabelImage()
+
 		labelimg = self.label_image.copy()
 
 		painter = QPainter(labelimg)
@@ -0,0 +1,251 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+# THIS FILE CONTAINS THE PACKING OF THE BLOBS IN FLAT NUMPY ARRAYS, USED BY THE BINARY PROJECT FORMAT.
+#
+# All the contours of an image are stored in a single float64 array of points, the i-th contour is
+# contour_points[contour_offsets[i]:contour_offsets[i+1]]. The inner contours are stored in the same way
+# (the rings of the i-th blob are ring_offsets[inner_offsets[i]:inner_offsets[i+1]+1]).
+# The strings of the blobs can be None: each field is stored as a json encoded list (see packStrings()).
+
+import io
+import json
+import zipfile
+import threading
+import numpy as np
+
+from source.Blob import Blob
+
+# held while a container is modified (the project can be saved by a background thread, see Project.saveBinary())
+container_lock = threading.RLock()
+
+
+def packContours(contours, dtype=np.float64):
+    """
+    It packs a list of contours (N x 2 arrays or lists of points) and returns (offsets, points).
+    """
+
+    offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+    if len(contours) > 0:
+        offsets[1:] = np.cumsum([len(contour) for contour in contours])
+        points = np.concatenate([np.asarray(contour, dtype=dtype).reshape(-1, 2) for contour in contours])
+    else:
+        points = np.zeros((0, 2), dtype=dtype)
+
+    return offsets, points
+
+
+def packBlobs(blobs):
+    """
+    It packs the given blobs into a dictionary of numpy arrays.
+    """
+
+    N = len(blobs)
+
+    arrays = {}
+    arrays["id"] = np.array([blob.id for blob in blobs], dtype=np.int32)
+    arrays["bbox"] = np.array([blob.bbox for blob in blobs], dtype=np.int32).reshape(N, 4)
+    arrays["centroid"] = np.array([blob.centroid for blob in blobs], dtype=np.float64).reshape(N, 2)
+    arrays["area"] = np.array([blob.area for blob in blobs], dtype=np.float64)
+    arrays["perimeter"] = np.array([blob.perimeter for blob in blobs], dtype=np.float64)
+    arrays["class_color"] = np.array([blob.class_color for blob in blobs], dtype=np.int32).reshape(N, 3)
+
+    arrays["contour_offsets"], arrays["contour_points"] = packContours([blob.contour for blob in blobs])
+
+    rings = []
+    inner_offsets = np.zeros(N + 1, dtype=np.int64)
+    for i, blob in enumerate(blobs):
+        rings.extend(blob.inner_contours)
+        inner_offsets[i + 1] = len(rings)
+    arrays["inner_offsets"] = inner_offsets
+    arrays["ring_offsets"], arrays["inner_points"] = packContours(rings)
+
+    arrays["dep_offsets"], arrays["dep_points"] = packContours([blob.deep_extreme_points for blob in blobs])
+
+    arrays["class_name"] = packStrings([blob.class_name for blob in blobs])
+    arrays["instance_name"] = packStrings([blob.instance_name for blob in blobs])
+    arrays["blob_name"] = packStrings([blob.blob_name for blob in blobs])
+    arrays["note"] = packStrings([blob.note for blob in blobs])
+
+    return arrays
+
+
+def packStrings(strings):
+    """
+    It packs a list of strings (or None) as a numpy string scalar holding the json encoded list.
+    """
+
+    return np.array(json.dumps(strings))
+
+
+def packBlobDicts(dicts):
+    """
+    It packs the blobs stored as dictionaries (see Blob.toDict()), without creating them. The points are
+    kept in double precision and the strings as lists (they can be None in the json projects).
+    """
+
+    N = len(dicts)
+
+    arrays = {}
+    arrays["id"] = np.array([int(d["id"]) for d in dicts], dtype=np.int32)
+    arrays["bbox"] = np.array([d["bbox"] for d in dicts], dtype=np.int32).reshape(N, 4)
+    arrays["centroid"] = np.array([d["centroid"] for d in dicts], dtype=np.float64).reshape(N, 2)
+    arrays["area"] = np.array([d["area"] for d in dicts], dtype=np.float64)
+    arrays["perimeter"] = np.array([d["perimeter"] for d in dicts], dtype=np.float64)
+    arrays["class_color"] = [d["class color"] for d in dicts]
+
+    arrays["contour_offsets"], arrays["contour_points"] = packContours([d["contour"] for d in dicts], np.float64)
+
+    rings = []
+    inner_offsets = np.zeros(N + 1, dtype=np.int64)
+    for i, d in enumerate(dicts):
+        rings.extend(d["inner contours"])
+        inner_offsets[i + 1] = len(rings)
+    arrays["inner_offsets"] = inner_offsets
+    arrays["ring_offsets"], arrays["inner_points"] = packContours(rings, np.float64)
+
+    arrays["dep_offsets"], arrays["dep_points"] = packContours([d["deep_extreme_points"] for d in dicts], np.float64)
+
+    arrays["class_name"] = [d["class name"] for d in dicts]
+    arrays["instance_name"] = [d["instance name"] for d in dicts]
+    arrays["blob_name"] = [d["blob name"] for d in dicts]
+    arrays["note"] = [d["note"] for d in dicts]
+
+    return arrays
+
+
+def packBlobsFromJson(text):
+    """
+    It decodes the json array of the blobs of an image and returns them packed. It is executed by the worker
+    processes loading a project (see Project.readProjectFile()).
+    """
+
+    return packBlobDicts(json.loads(text))
+
+
+def asList(values):
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+    return list(values)
+
+
+def unpackStrings(values):
+    """
+    It returns the list of strings packed by packStrings() (the files saved before store a numpy array of strings).
+    """
+
+    if isinstance(values, np.ndarray) and values.ndim == 0:
+        return json.loads(str(values))
+    return asList(values)
+
+
+def unpackBlobs(arrays):
+    """
+    It creates the blobs from the packed arrays (see packBlobs() and packBlobDicts()).
+    """
+
+    ids = asList(arrays["id"])
+    bboxes = arrays["bbox"].astype(int)
+    centroids = arrays["centroid"]
+    areas = asList(arrays["area"])
+    perimeters = asList(arrays["perimeter"])
+    class_colors = asList(arrays["class_color"])
+
+    contour_offsets = arrays["contour_offsets"]
+    contour_points = arrays["contour_points"].astype(np.float64)
+    inner_offsets = arrays["inner_offsets"]
+    ring_offsets = arrays["ring_offsets"]
+    inner_points = arrays["inner_points"].astype(np.float64)
+    dep_offsets = arrays["dep_offsets"]
+    dep_points = arrays["dep_points"].astype(np.float64)
+
+    class_names = unpackStrings(arrays["class_name"])
+    instance_names = unpackStrings(arrays["instance_name"])
+    blob_names = unpackStrings(arrays["blob_name"])
+    notes = unpackStrings(arrays["note"])
+
+    blobs = []
+    for i in range(len(ids)):
+
+        blob = Blob(None, 0, 0, 0)
+
+        blob.bbox = bboxes[i].copy()
+        blob.centroid = centroids[i].copy()
+        blob.area = areas[i]
+        blob.perimeter = perimeters[i]
+
+        blob.contour = contour_points[contour_offsets[i]:contour_offsets[i + 1]]
+        blob.inner_contours = []
+        for j in range(inner_offsets[i], inner_offsets[i + 1]):
+            blob.inner_contours.append(inner_points[ring_offsets[j]:ring_offsets[j + 1]])
+
+        blob.deep_extreme_points = dep_points[dep_offsets[i]:dep_offsets[i + 1]]
+
+        blob.class_name = class_names[i]
+        blob.class_color = class_colors[i]
+        blob.instance_name = instance_names[i]
+        blob.blob_name = blob_names[i]
+        blob.id = ids[i]
+        blob.note = notes[i]
+
+        blobs.append(blob)
+
+    return blobs
+
+
+def blobsToBytes(blobs):
+    """
+    It serializes the blobs as a (uncompressed) .npz file in memory.
+    """
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **packBlobs(blobs))
+    return buffer.getvalue()
+
+
+def blobsFromBytes(data):
+
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        return unpackBlobs(arrays)
+
+
+class ChunkReference(object):
+    """
+    Reference to the chunk of the blobs of an image stored inside a binary project. The blobs are
+    read only when they are needed (see Annotation.seg_blobs).
+    """
+
+    def __init__(self, filename, chunk_name, count):
+
+        self.filename = filename
+        self.chunk_name = chunk_name
+        self.count = count
+
+    def read(self):
+        """
+        It returns the raw bytes of the chunk.
+        """
+
+        with container_lock:
+            with zipfile.ZipFile(self.filename, "r") as container:
+                return container.read(self.chunk_name)
+
+    def load(self):
+
+        return blobsFromBytes(self.read())
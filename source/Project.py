@@ -2,6 +2,9 @@ import os
 import pandas as pd
 import datetime
 import json
+import zipfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 from PyQt5.QtCore import QDir
 from PyQt5.QtGui import QBrush, QColor
@@ -14,23 +17,52 @@ from source.Label import Label
 from source.Correspondences import Correspondences
 from source.Genet import Genet
 from source import utils
-
-def loadProject(taglab_working_dir, filename, labels_dict):
+from source import PackedBlobs
+from source import BlobMatching
+from source import BatchMatching
+from source.JsonStream import JsonStreamReader
+
+# BINARY PROJECT: a zip container with the project description (manifest.json, same content of the json
+# project except the annotations and the correspondences), the blobs of each image packed in a separate chunk
+# (annotations/NNNN.npz) and each table of correspondences in a separate chunk (correspondences/NNNN.json).
+#
+# When the project is saved again in the same container only the modified chunks are appended to it, together
+# with a new manifest (journal/GGGGGG.json, the last one is the current description of the project).
+# Every BINARY_PROJECT_MAX_JOURNAL saves the container is compacted, i.e. written from scratch.
+BINARY_PROJECT_EXTENSION = ".tlb"
+BINARY_PROJECT_FORMAT = "TagLab binary project"
+BINARY_PROJECT_VERSION = 2
+BINARY_PROJECT_MANIFEST = "manifest.json"
+BINARY_PROJECT_JOURNAL = "journal/"
+BINARY_PROJECT_MAX_JOURNAL = 16
+
+# the blobs of the json projects smaller than this are decoded without the worker processes
+PARALLEL_LOADING_MIN_SIZE = 32 * 1024 * 1024
+
+def isBinaryProject(filename):
+    return zipfile.is_zipfile(filename)
+
+def loadProject(taglab_working_dir, filename, labels_dict, progress=None, workers=None):
+    """
+    Load a project. The progress of the reading of a json project is reported by progress(bytes_read, size),
+    the blobs of the images of a large json project are decoded by the given number of worker processes.
+    """
 
     dir = QDir(taglab_working_dir)
     filename = dir.relativeFilePath(filename)
-    f = open(filename, "r")
-    try:
-        data = json.load(f)
-    except json.JSONDecodeError as e:
-        raise Exception(str(e))
 
-    if "Map File" in data:
-        project = loadOldProject(taglab_working_dir, data, labels_dict)
+    if isBinaryProject(filename):
+        project = loadBinaryProject(filename)
     else:
-        project = Project(**data)
+        try:
+            data = readProjectFile(filename, progress, workers)
+        except ValueError as e:
+            raise Exception(str(e))
 
-    f.close()
+        if "Map File" in data:
+            project = loadOldProject(taglab_working_dir, data, labels_dict)
+        else:
+            project = Project(**data)
 
     project.filename = filename
 
@@ -66,8 +98,62 @@ def loadProject(taglab_working_dir, filename, labels_dict):
 
     return project
 
+def readProjectFile(filename, progress=None, workers=None):
+    """
+    Read a json project (also in the old format). The images and the blobs are created while the file
+    is read, so the json document is never entirely in memory.
+    If workers is greater than 1 (and the file is large), the blobs of each image are decoded and packed
+    by a pool of worker processes (see PackedBlobs.packBlobsFromJson()), the blobs are then created here.
+    """
+
+    size = os.path.getsize(filename)
+    if workers is not None and workers > 1 and size >= PARALLEL_LOADING_MIN_SIZE:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = None
+
+    f = open(filename, "rb")
+    reader = JsonStreamReader(f, size, progress)
+
+    # images waiting for the blobs decoded by the pool
+    pending = []
+
+    def readBlob():
+        blob = Blob(None, 0, 0, 0)
+        blob.fromDict(reader.readValue())
+        return blob
+
+    def readImage():
+        if pool is None:
+            data = reader.readObject({"annotations": lambda: reader.readArray(readBlob)})
+        else:
+            data = reader.readObject({"annotations": lambda: pool.submit(PackedBlobs.packBlobsFromJson, reader.readRaw())})
+        annotations = data.pop("annotations", [])
+        image = Image(**data)
+        if isinstance(annotations, list):
+            image.annotations.addBlobs(annotations)
+        else:
+            pending.append((image, annotations))
+        return image
+
+    try:
+        data = reader.readObject({"images": lambda: reader.readArray(readImage),
+                                  "Segmentation Data": lambda: reader.readArray(readBlob)})
+
+        for image, future in pending:
+            image.annotations.addBlobs(PackedBlobs.unpackBlobs(future.result()))
+    finally:
+        f.close()
+        if pool is not None:
+            pool.shutdown()
+
+    return data
+
 # NOTE: old project NEEDS a pre-defined label dictionary
 def loadOldProject(taglab_working_dir, data, labels_dict):
+    """
+    Create the project from an old project, the "Segmentation Data" are the blobs read by readProjectFile().
+    """
 
     project = Project()
     project.importLabelsFromConfiguration(labels_dict)
@@ -84,15 +170,68 @@ def loadOldProject(taglab_working_dir, data, labels_dict):
     channel = Channel(filename=map_filename, type="RGB")
     image.channels.append(channel)
 
-    for blob_data in data["Segmentation Data"]:
-        blob = Blob(None, 0, 0, 0)
-        blob.fromDict(blob_data)
+    blobs = data["Segmentation Data"]
+    for blob in blobs:
         blob.setId(int(blob.id))  # id should be set again to update related info
-        image.annotations.addBlob(blob)
+    image.annotations.addBlobs(blobs)
 
     project.images.append(image)
     return project
 
+def loadBinaryProject(filename):
+    """
+    Load a binary project. The blobs of each image are loaded only when they are used for the first time.
+    """
+
+    with PackedBlobs.container_lock:
+        with zipfile.ZipFile(filename, "r") as container:
+
+            journal = sorted([name for name in container.namelist() if name.startswith(BINARY_PROJECT_JOURNAL)])
+            manifest = journal[-1] if len(journal) > 0 else BINARY_PROJECT_MANIFEST
+            data = json.loads(container.read(manifest).decode("utf-8"))
+
+            if data.pop("format", None) != BINARY_PROJECT_FORMAT:
+                raise Exception("The file " + filename + " is not a valid TagLab project.")
+            data.pop("version", None)
+            generation = data.pop("generation", 0)
+
+            # the tables of correspondences are small, they are read immediately
+            tables = {}
+            if data.get("correspondences") is not None:
+                for key, table in data["correspondences"].items():
+                    if "chunk" in table:
+                        tables[key] = table.pop("chunk")
+                        table["correspondences"] = json.loads(container.read(tables[key]).decode("utf-8"))
+
+    chunks = []
+    for image_data in data["images"]:
+        chunks.append(image_data["annotations"])
+        image_data["annotations"] = []
+
+    project = Project(**data)
+
+    container = os.path.abspath(filename)
+    for image, chunk in zip(project.images, chunks):
+        image.annotations.setLoader(PackedBlobs.ChunkReference(filename, chunk["chunk"], chunk["count"]))
+        image.annotations.setSaved(container, chunk["chunk"], chunk["count"], image.annotations.version)
+
+    for key, chunk_name in tables.items():
+        corr = project.correspondences[key]
+        corr.setSaved(container, chunk_name, corr.version)
+
+    project.containers[container] = (generation, len(journal))
+
+    return project
+
+def convertProject(taglab_working_dir, input_filename, output_filename, labels_dict):
+    """
+    Convert a project from the json format to the binary one, or vice versa (the output format
+    depends on the extension of the output file).
+    """
+
+    project = loadProject(taglab_working_dir, input_filename, labels_dict)
+    project.save(output_filename)
+
 class ProjectEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Image):
@@ -112,17 +251,96 @@ class ProjectEncoder(json.JSONEncoder):
 
         return json.JSONEncoder.default(self, obj)
 
+class BinaryProjectWriter(object):
+    """
+    It writes a binary project. All the data is collected by Project.prepareBinarySave(), so run() can be
+    executed by a background thread while the project is modified.
+    """
+
+    def __init__(self, filename, incremental, generation, journal):
+
+        self.filename = filename
+        self.incremental = incremental      # append the chunks to the existing container
+        self.generation = generation
+        self.journal = journal              # number of manifests appended after the last compaction
+
+        self.chunks = []                    # (chunk name, bytes or ChunkReference, compression)
+        self.saved = []                     # (annotations or correspondences, arguments of setSaved())
+        self.loaders = []                   # (annotations not loaded, chunk name, count)
+        self.manifest = None
+
+        self.error = None
+        self.thread = None
+
+    def addChunk(self, chunk_name, data, compress_type):
+        self.chunks.append((chunk_name, data, compress_type))
+
+    def manifestName(self):
+        if self.incremental:
+            return BINARY_PROJECT_JOURNAL + "{:06d}.json".format(self.generation)
+        return BINARY_PROJECT_MANIFEST
+
+    def replacesLoaders(self):
+        """
+        It returns True if the container is rewritten while some blobs are still to be loaded from it.
+        """
+        if self.incremental:
+            return False
+
+        container = os.path.abspath(self.filename)
+        for annotations, chunk_name, count in self.loaders:
+            if os.path.abspath(annotations.loader.filename) == container:
+                return True
+        return False
+
+    def run(self):
+
+        try:
+            self.write()
+        except Exception as e:
+            self.error = e
+
+    def write(self):
+
+        # the blobs never loaded are read before the container is modified
+        chunks = []
+        for chunk_name, data, compress_type in self.chunks:
+            if isinstance(data, PackedBlobs.ChunkReference):
+                data = data.read()
+            chunks.append((chunk_name, data, compress_type))
+
+        if self.incremental:
+            with PackedBlobs.container_lock:
+                with zipfile.ZipFile(self.filename, "a") as container:
+                    for chunk_name, data, compress_type in chunks:
+                        container.writestr(chunk_name, data, compress_type=compress_type)
+                    container.writestr(self.manifestName(), self.manifest, compress_type=zipfile.ZIP_DEFLATED)
+        else:
+            temp_filename = self.filename + ".tmp"
+            with zipfile.ZipFile(temp_filename, "w") as container:
+                for chunk_name, data, compress_type in chunks:
+                    container.writestr(chunk_name, data, compress_type=compress_type)
+                container.writestr(self.manifestName(), self.manifest, compress_type=zipfile.ZIP_DEFLATED)
+
+            with PackedBlobs.container_lock:
+                os.replace(temp_filename, self.filename)
+
+        container = os.path.abspath(self.filename)
+        for owner, args in self.saved:
+            owner.setSaved(container, *args)
+
 class Project(object):
 
     def __init__(self, filename=None, labels={}, images=[], correspondences=None,
-                 spatial_reference_system=None, metadata={}, image_metadata_template={}):
+                 spatial_reference_system=None, metadata={}, image_metadata_template={}, genet=None):
 
         self.filename = None                                             #filename with path of the project json
         self.labels = { key: Label(**value) for key, value in labels.items() }
         if not 'Empty' in self.labels:
             self.labels['Empty'] = Label(id='Empty', name='Empty', description=None, fill=[127, 127, 127], border=[200, 200, 200], visible=True)
 
-        self.images = list(map(lambda img: Image(**img), images))       #list of annotated images
+        #list of annotated images (already created by the json stream reader, see readProjectFile())
+        self.images = [img if isinstance(img, Image) else Image(**img) for img in images]
 
                                                                          # dict of tables (DataFrame) of correspondences betweeen a source and a target image
         self.correspondences = {}
@@ -133,11 +351,19 @@ class Project(object):
                 self.correspondences[key] = Correspondences(self.getImageFromId(source), self.getImageFromId(target))
                 self.correspondences[key].fillTable(correspondences[key]['correspondences'])
 
+        # genets of the blobs, computed from all the correspondences (the saved assignment is restored)
+        self.genet = Genet(self, genet)
+        for image in self.images:
+            self.watchAnnotations(image)
+
         self.spatial_reference_system = spatial_reference_system        #if None we assume coordinates in pixels (but Y is up or down?!)
         self.metadata = metadata                                        # project metadata => keyword -> value
         self.image_metadata_template = image_metadata_template          # description of metadata keywords expected in images
                                                                          # name: { type: (integer, date, string), mandatory: (true|false), default: ... }
 
+        self.containers = {}        # binary containers written or read: filename -> (generation, journal length)
+        self.writer = None          # BinaryProjectWriter running in background
+
 
 
     def importLabelsFromConfiguration(self, dictionary):
@@ -153,18 +379,139 @@ class Project(object):
 
 
     def save(self, filename = None):
-        #try:
-        data = self.__dict__
-        str = json.dumps(data, cls=ProjectEncoder, indent=1)
 
         if filename is None:
             filename = self.filename
+
+        if filename.lower().endswith(BINARY_PROJECT_EXTENSION):
+            self.saveBinary(filename)
+            return
+
+        #try:
+        data = self.persistentData()
+        str = json.dumps(data, cls=ProjectEncoder, indent=1)
+
         f = open(filename, "w")
         f.write(str)
         f.close()
         #except Exception as a:
         #    print(str(a))
 
+    def persistentData(self):
+        """
+        It returns the attributes of the project that are saved.
+        """
+        return {key: value for key, value in self.__dict__.items() if key not in ["containers", "writer"]}
+
+    def saveBinary(self, filename, background=False):
+        """
+        Save the project in the binary format. If background is True the container is written by a separate
+        thread (see waitSave()), except when a container with blobs still to be loaded must be rewritten.
+        """
+
+        self.waitSave()
+
+        writer = self.prepareBinarySave(filename)
+
+        if background and not writer.replacesLoaders():
+            writer.thread = threading.Thread(target=writer.run, daemon=True)
+            self.writer = writer
+            writer.thread.start()
+            return
+
+        writer.run()
+        if writer.error is not None:
+            raise writer.error
+
+        self.containers[os.path.abspath(filename)] = (writer.generation, writer.journal)
+
+        # the blobs not loaded are now in the new container
+        if not writer.incremental:
+            for annotations, chunk_name, count in writer.loaders:
+                if not annotations.isLoaded():
+                    annotations.setLoader(PackedBlobs.ChunkReference(filename, chunk_name, count))
+
+    def waitSave(self):
+        """
+        Wait the end of the background save, if any. It returns the exception raised by the save (or None).
+        """
+
+        writer = self.writer
+        if writer is None:
+            return None
+
+        writer.thread.join()
+        self.writer = None
+
+        if writer.error is None:
+            self.containers[os.path.abspath(writer.filename)] = (writer.generation, writer.journal)
+        return writer.error
+
+    def prepareBinarySave(self, filename):
+        """
+        It collects the data to save in a BinaryProjectWriter. If the file is a container of this project
+        only the annotations and the correspondences modified after the last save are serialized.
+        """
+
+        container = os.path.abspath(filename)
+        generation, journal = self.containers.get(container, (0, 0))
+
+        incremental = container in self.containers and os.path.exists(filename) and journal < BINARY_PROJECT_MAX_JOURNAL
+        if incremental:
+            writer = BinaryProjectWriter(filename, True, generation + 1, journal + 1)
+            suffix = "-{:06d}".format(writer.generation)
+        else:
+            writer = BinaryProjectWriter(filename, False, 0, 0)
+            suffix = ""
+
+        images = []
+        for i, image in enumerate(self.images):
+
+            annotations = image.annotations
+            saved = annotations.savedChunk(container) if incremental else None
+
+            if saved is not None:
+                chunk_name, count = saved
+            else:
+                chunk_name = "annotations/{:04d}{:s}.npz".format(i, suffix)
+                if annotations.isLoaded():
+                    count = len(annotations.seg_blobs)
+                    writer.addChunk(chunk_name, PackedBlobs.blobsToBytes(annotations.seg_blobs), zipfile.ZIP_STORED)
+                else:
+                    count = annotations.loader.count
+                    writer.addChunk(chunk_name, annotations.loader, zipfile.ZIP_STORED)
+                    writer.loaders.append((annotations, chunk_name, count))
+
+            writer.saved.append((annotations, (chunk_name, count, annotations.version)))
+
+            image_data = image.save()
+            image_data["annotations"] = {"chunk": chunk_name, "count": count}
+            images.append(image_data)
+
+        correspondences = {}
+        if self.correspondences is not None:
+            for i, (key, corr) in enumerate(self.correspondences.items()):
+
+                chunk_name = corr.savedChunk(container) if incremental else None
+                if chunk_name is None:
+                    chunk_name = "correspondences/{:04d}{:s}.json".format(i, suffix)
+                    table = json.dumps(corr.data.values.tolist(), cls=ProjectEncoder)
+                    writer.addChunk(chunk_name, table, zipfile.ZIP_DEFLATED)
+
+                writer.saved.append((corr, (chunk_name, corr.version)))
+                correspondences[key] = {"source": corr.source.id, "target": corr.target.id, "chunk": chunk_name}
+
+        data = self.persistentData()
+        data["images"] = images
+        data["correspondences"] = correspondences
+        data["format"] = BINARY_PROJECT_FORMAT
+        data["version"] = BINARY_PROJECT_VERSION
+        data["generation"] = writer.generation
+
+        writer.manifest = json.dumps(data, cls=ProjectEncoder, indent=1)
+
+        return writer
+
 
     def classBrushFromName(self, blob):
         brush = QBrush()
@@ -202,8 +549,15 @@ class Project(object):
         Annotated images in the image list are sorted by date.
         """
         self.images.append(image)
+        self.watchAnnotations(image)
         self.orderImagesByAcquisitionDate()
 
+    def watchAnnotations(self, image):
+        """
+        The blobs of the image loaded later (binary projects) receive their genets when they are loaded.
+        """
+        image.annotations.blobsLoaded.connect(lambda image=image: self.genet.imageLoaded(image))
+
     def deleteImage(self, image):
         self.images = [i for i in self.images if i != image]
         self.correspondences = {key: corr for key, corr in self.correspondences.items() if corr.source != image and corr.target != image}
@@ -222,33 +576,45 @@ class Project(object):
         # update correspondences
         for corr in self.findCorrespondences(image):
             corr.addBlob(image, blob)
+            corr.markDirty()
+
+        # a new blob has no correspondences, it gets a new genet
+        blob.genet = self.genet.addBlob(image.id, blob)
 
     def removeBlob(self, image, blob):
 
         # updata image annotations
         image.annotations.removeBlob(blob)
+        self.genet.removeBlob(image.id, blob)
 
         # update correspondences
         for corr in self.findCorrespondences(image):
             corr.removeBlob(image, blob)
+            corr.markDirty()
 
     def updateBlob(self, image, old_blob, new_blob):
 
         # update image annotations
         image.annotations.updateBlob(old_blob, new_blob)
+        self.genet.updateBlob(image.id, old_blob, new_blob)
 
         # update correspondences
         for corr in self.findCorrespondences(image):
             corr.updateBlob(image, old_blob, new_blob)
+            corr.markDirty()
 
     def setBlobClass(self, image, blob, class_name):
         blob.class_name = class_name
         # THIS should be removed: the color comes from the labels!
         blob.class_color = self.labels[blob.class_name].fill
-
+        image.annotations.markDirty()
 
         for corr in self.findCorrespondences(image):
             corr.setBlobClass(image, blob, class_name)
+            corr.markDirty()
+
+        # the correspondences of the blob are broken
+        self.genet.update()
 
 
     def getImageFromId(self, id):
@@ -283,47 +649,65 @@ class Project(object):
 
         corr = self.getImagePairCorrespondences(img_source_idx, img_target_idx)
         corr.set(blobs1, blobs2)
+        corr.markDirty()
+        self.genet.update()
 
     def updatePixelSizeInCorrespondences(self, image, flag_surface_area):
 
         correspondences= self.findCorrespondences(image)
         for corr in correspondences:
             corr.updateAreas(use_surface_area=flag_surface_area)
+            corr.markDirty()
     
     def computeCorrespondences(self, img_source_idx, img_target_idx):
         """
         Compute the correspondences between an image pair.
         """
 
-        conversion1 = self.images[img_source_idx].pixelSize()
-        conversion2 = self.images[img_target_idx].pixelSize()
+        source = self.images[img_source_idx]
+        target = self.images[img_target_idx]
 
         # switch form px to mm just for calculation (except areas that are in cm)
-
-        blobs1 = []
-        for blob in self.images[img_source_idx].annotations.seg_blobs:
-            blob_c = blob.copy()
-            blob_c.bbox = (blob_c.bbox*conversion1).round().astype(int)
-            blob_c.contour = blob_c.contour*conversion1
-            blob_c.area = blob_c.area*conversion1*conversion1 / 100
-            blobs1.append(blob_c)
-
-        blobs2 = []
-        for blob in self.images[img_target_idx].annotations.seg_blobs:
-            blob_c = blob.copy()
-            blob_c.bbox = (blob_c.bbox * conversion2).round().astype(int)
-            blob_c.contour = blob_c.contour * conversion2
-            blob_c.area = blob_c.area * conversion2 * conversion2 / 100
-            blobs2.append(blob_c)
+        blobs1 = BlobMatching.scaleBlobs(source.annotations.seg_blobs, source.pixelSize())
+        blobs2 = BlobMatching.scaleBlobs(target.annotations.seg_blobs, target.pixelSize())
 
         corr = self.getImagePairCorrespondences(img_source_idx, img_target_idx)
         corr.autoMatch(blobs1, blobs2)
 
-        lines = corr.correspondences + corr.dead + corr.born
+        self.setCorrespondences(corr, corr.correspondences + corr.dead + corr.born)
+        corr.correspondences = []
+        corr.dead = []
+        corr.born = []
+
+    def setCorrespondences(self, corr, lines):
+        """
+        Replace the table of correspondences with the given rows.
+        """
+
         corr.data = pd.DataFrame(lines, columns=corr.data.columns)
         corr.sort_data()
-        corr.correspondence = []
-        corr.dead = []
-        corr.born =[]
+        corr.markDirty()
+        self.genet.update()
+
+    def computeAllCorrespondences(self, workers=None, progress=None):
+        """
+        Compute the correspondences between all the consecutive surveys (the images ordered by acquisition
+        date), using the given number of worker processes (see BatchMatching.matchAllSurveys()).
+        It returns the report of the matching of each pair: (key, seconds, number of correspondences).
+        """
+
+        self.orderImagesByAcquisitionDate()
+
+        report = []
+        for source, target, lines, seconds in BatchMatching.matchAllSurveys(self.images, workers, progress):
+            corr = self.getImagePairCorrespondences(source, target)
+            corr.data = pd.DataFrame(lines, columns=corr.data.columns)
+            corr.sort_data()
+            report.append((self.images[source].id + "-" + self.images[target].id, seconds, len(lines)))
+
+        # the genets are recomputed once, after all the tables are replaced
+        self.genet.update()
+
+        return report
 
 
@@ -29,11 +29,25 @@ imdir =imdir.replace('source', '')
 
 class TableModel(QAbstractTableModel):
 
-    def __init__(self, data):
+    def __init__(self, correspondences):
         super(TableModel, self).__init__()
-        self._data = data
+        self.setTableData(correspondences)
         self.surface_area_mode_enabled = False
 
+    def setTableData(self, correspondences):
+        """
+        The cells are read from the columns of the table converted to numpy arrays (see refresh()),
+        the edits are written through the correspondences.
+        """
+
+        self.correspondences = correspondences
+        self._data = correspondences.data
+        self.refresh()
+
+    def refresh(self):
+
+        self._columns = [self._data[column].to_numpy() for column in self._data.columns]
+
     def enableSurfaceAreaMode(self):
 
         self.surface_area_mode_enabled = True
@@ -45,7 +59,7 @@ class TableModel(QAbstractTableModel):
     def data(self, index, role):
 
         if role == Qt.DisplayRole:
-            value = self._data.iloc[index.row(), index.column()]
+            value = self._columns[index.column()][index.row()]
             # if index.column() == 0 or index.column() == 1:
             #     return "" if math.isnan(value) else str(value)
 
@@ -72,7 +86,9 @@ class TableModel(QAbstractTableModel):
 
         if index.isValid() and role == Qt.EditRole:
 
-            self._data.iloc[index.row(), index.column()] = value
+            self.correspondences.setValue(index.row(), index.column(), value)
+            self._data = self.correspondences.data
+            self._columns[index.column()] = self._data.iloc[:, index.column()].to_numpy()
         else:
             return False
 
@@ -109,8 +125,6 @@ class TableModel(QAbstractTableModel):
 
     def flags(self, index):
 
-        value = self._data.iloc[index.row(), index.column()]
-
         if index.column() == 5 or index.column() == 6:
             return QAbstractTableModel.flags(self, index) | Qt.ItemIsEditable
         else:
@@ -237,7 +251,7 @@ class QtComparePanel(QWidget):
 
         self.data = self.correspondences.data
 
-        self.model = TableModel(self.data)
+        self.model = TableModel(self.correspondences)
         self.sortfilter = QSortFilterProxyModel(self)
         self.sortfilter.setSourceModel(self.model)
         self.data_table.setModel(self.sortfilter)
@@ -256,14 +270,12 @@ class QtComparePanel(QWidget):
         self.data_table.setStyleSheet("QHeaderView::section { background-color: rgb(40,40,40) }")
 
     def sourceBlobUpdated(self, blob):
-        for i, row in self.data.iterrows():
-            if row[0] == blob.id:
-                self.data.loc[i, 'Area1'] = self.correspondences.area_in_sq_cm(blob.area, True)
+        self.correspondences.updateBlobArea(blob, True)
+        self.updateData()
 
     def targetBlobUpdated(self, blob):
-        for i, row in self.data.iterrows():
-            if row[1] == blob.id:
-                self.data.loc[i, 'Area2'] =  self.correspondences.area_in_sq_cm(blob.area, False)
+        self.correspondences.updateBlobArea(blob, False)
+        self.updateData()
 
     def clear(self):
 
@@ -275,6 +287,10 @@ class QtComparePanel(QWidget):
 
     def updateData(self):
 
+        if self.model is not None:
+            self.model.beginResetModel()
+            self.model.setTableData(self.correspondences)
+            self.model.endResetModel()
         self.data_table.update()
 
     def updateTable(self, corr):
@@ -285,7 +301,8 @@ class QtComparePanel(QWidget):
         self.correspondences = corr
         self.sortfilter.beginResetModel()
         self.model.beginResetModel()
-        self.model._data = corr.data
+        self.data = corr.data
+        self.model.setTableData(corr)
         self.sortfilter.endResetModel()
         self.model.endResetModel()
 
@@ -49,10 +49,7 @@ class QtHistogramWidget(QWidget):
         self.setMinimumHeight(600)
 
         # look for existing labels in annotations
-        labels_set = set()
-
-        for blob in self.ann.seg_blobs:
-            labels_set.add(blob.class_name)
+        labels_set = set(self.ann.summary()["class"])
 
         labels_set.discard('Empty')
         labels_layout = QVBoxLayout()
@@ -151,24 +148,14 @@ class QtHistogramWidget(QWidget):
 
     def create_histogram(self, list_selected, list_color):
 
-        class_area = []
-        for my_class in list_selected:
-            my_area = []
-            for blob in self.ann.seg_blobs:
-                if blob.class_name == my_class:
-                   blob_area = blob.area * self.scale_factor * self.scale_factor / 100
-                   blob_area = np.around(blob_area, decimals=2)
-                   my_area.append(blob_area)
-
-            class_area.append(my_area)
+        table = self.ann.summary()
+        blob_classes = table["class"].values
+        blob_areas = np.around(table["area"].values * self.scale_factor * self.scale_factor / 100, decimals=2)
 
-        max_area = np.zeros(len(list_selected))
-        sum_area = np.zeros(len(list_selected))
+        class_area = [blob_areas[blob_classes == my_class] for my_class in list_selected]
 
-        for i in range(0, len(list_selected)):
-            area_array = np.asarray(class_area[i])
-            max_area[i] = max(area_array)
-            sum_area[i] = sum(area_array)
+        max_area = np.array([area_array.max() if len(area_array) > 0 else 0.0 for area_array in class_area])
+        sum_area = np.array([area_array.sum() for area_array in class_area])
 
         # histogram plot
         total_coverage = sum(sum_area)
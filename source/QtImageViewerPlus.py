@@ -699,6 +699,7 @@ class QtImageViewerPlus(QtImageViewer):
             blob.class_name = class_name
             brush = self.project.classBrushFromName(blob)
             blob.qpath_gitem.setBrush(brush)
+            self.annotations.markDirty()
 
         self.updateVisibility()
 
@@ -726,6 +727,7 @@ class QtImageViewerPlus(QtImageViewer):
             blob.class_name = class_name
             brush = self.project.classBrushFromName(blob)
             blob.qpath_gitem.setBrush(brush)
+            self.annotations.markDirty()
 
         self.updateVisibility()
 
@@ -51,6 +51,10 @@ class QtNewDatasetWidget(QWidget):
         self.lblTargetScale.setFixedWidth(TEXT_SPACE)
         self.lblTargetScale.setAlignment(Qt.AlignRight)
 
+        self.lblTilesFormat = QLabel("Tiles format:")
+        self.lblTilesFormat.setFixedWidth(TEXT_SPACE)
+        self.lblTilesFormat.setAlignment(Qt.AlignRight)
+
 
         layoutH0a = QVBoxLayout()
         layoutH0a.setAlignment(Qt.AlignRight)
@@ -58,6 +62,7 @@ class QtNewDatasetWidget(QWidget):
         layoutH0a.addWidget(self.lblWorkingArea)
         layoutH0a.addWidget(self.lblSplitMode)
         layoutH0a.addWidget(self.lblTargetScale)
+        layoutH0a.addWidget(self.lblTilesFormat)
 
         ###########################################################
 
@@ -78,6 +83,11 @@ class QtNewDatasetWidget(QWidget):
         self.editTargetScale = QLineEdit("1.0")
         self.editTargetScale .setStyleSheet("background-color: rgb(55,55,55); border: 1px solid rgb(90,90,90)")
         self.editTargetScale .setMinimumWidth(LINEWIDTH)
+        self.comboTilesFormat = QComboBox()
+        self.comboTilesFormat.setStyleSheet("background-color: rgb(55,55,55); border: 1px solid rgb(90,90,90)")
+        self.comboTilesFormat.setFixedWidth(LINEWIDTH)
+        self.comboTilesFormat.addItem("PNG")
+        self.comboTilesFormat.addItem("Packed shards")
 
         layoutH0b = QVBoxLayout()
         layoutH0b.setAlignment(Qt.AlignLeft)
@@ -85,6 +95,7 @@ class QtNewDatasetWidget(QWidget):
         layoutH0b.addWidget(self.editWorkingArea)
         layoutH0b.addWidget(self.comboSplitMode)
         layoutH0b.addWidget(self.editTargetScale)
+        layoutH0b.addWidget(self.comboTilesFormat)
 
         ###############################################################
 
@@ -170,4 +181,8 @@ class QtNewDatasetWidget(QWidget):
 
         return float(self.editTargetScale.text())
 
+    def getTilesFormat(self):
+
+        return self.comboTilesFormat.currentText()
+
 
@@ -1,32 +1,46 @@
 
+import os
+import csv
+import math
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from shapely.geometry import Polygon
 from osgeo import gdal, osr
 import osgeo.ogr as ogr
 import rasterio as rio
 from rasterio.plot import reshape_as_raster
 from rasterio.mask import mask
+from rasterio.windows import Window, from_bounds
+from rasterio.features import geometry_mask
+from rasterio.errors import WindowError
+from rasterio.enums import Resampling
+
+
+def transformContour(contour, transform):
+    """
+    Apply the affine transform (pixels -> georeferenced coordinates) to a whole contour (N x 2 array).
+    """
+
+    points = np.asarray(contour, dtype=np.float64)
+    if transform is None:
+        return points
+
+    x = points[:, 0]
+    y = points[:, 1]
+
+    pointsgeo = np.empty((points.shape[0], 2), dtype=np.float64)
+    pointsgeo[:, 0] = transform.a * x + transform.b * y + transform.c
+    pointsgeo[:, 1] = transform.d * x + transform.e * y + transform.f
+
+    return pointsgeo
 
 
 def changeFormat(contour, transform):
     """
     convert blob coordinates for Polygon shapefiles. Coord are in pixels while pointsgeo are in mm
     """
-    coords = []
-    pointsgeo = []
-    for coord in contour:
-        coord = tuple(coord)
-        coords.append(coord)
 
-    if transform is not None:
-        for points in coords:
-            x = points[0]
-            y = points[1]
-            pointgeo = transform * (x, y)
-            pointsgeo.append(pointgeo)
-        return pointsgeo
-    else:
-        return coords
+    return [tuple(point) for point in transformContour(contour, transform).tolist()]
 
 
 def createPolygon(blob, transform):
@@ -44,58 +58,97 @@ def createPolygon(blob, transform):
 
     return newPolygon
 
+
+def polygonToWkb(blob, transform):
+    """
+    It returns the (little endian) WKB of the polygon of the blob, built directly from the contour arrays.
+    """
+
+    chunks = [np.array([1], dtype=np.uint8).tobytes(), np.array([3, 1 + len(blob.inner_contours)], dtype='<u4').tobytes()]
+
+    for contour in [blob.contour] + list(blob.inner_contours):
+
+        ring = transformContour(contour, transform)
+
+        # the rings must be closed
+        if ring.shape[0] > 0 and (ring[0, 0] != ring[-1, 0] or ring[0, 1] != ring[-1, 1]):
+            ring = np.vstack([ring, ring[:1]])
+
+        chunks.append(np.array([ring.shape[0]], dtype='<u4').tobytes())
+        chunks.append(ring.astype('<f8').tobytes())
+
+    return b"".join(chunks)
+
+
 def write_shapefile(blobs, georef_filename, out_shp):
     """
     https://gis.stackexchange.com/a/52708/8104
     """
+
+    write_vector_file(blobs, georef_filename, out_shp, 'Esri Shapefile')
+
+
+def write_geopackage(blobs, georef_filename, out_gpkg):
+
+    write_vector_file(blobs, georef_filename, out_gpkg, 'GPKG')
+
+
+def write_vector_file(blobs, georef_filename, out_filename, driver_name):
+    """
+    Export the visible blobs as polygons with the given OGR driver. The geometries are built directly as WKB
+    from the contours, and all the features are created inside a single transaction (if supported by the driver).
+    The attributes are the id, the class, the area and the perimeter (in georeferenced units) and the note.
+    """
+
     # load georeference information to use
-    img = rio.open(georef_filename)
-    geoinfo = img.crs
-    transform = img.transform
+    with rio.open(georef_filename) as img:
+        geoinfo = img.crs
+        transform = img.transform
 
-    # convert blobs in polygons
-    polygons = []
-    ids = []
-    classnames = []
-    colors = []
+    # pixel area -> georeferenced area (and the corresponding length scale)
+    pixel_area = abs(transform.a * transform.e - transform.b * transform.d)
+    pixel_size = np.sqrt(pixel_area)
 
-    for blob in blobs:
-        if blob.qpath_gitem.isVisible():
-            polygon = createPolygon(blob, transform)
-            ids.append(blob.id)
-            classnames.append(blob.class_name)
-            colors.append('#%02X%02X%02X' % tuple(blob.class_color))
-            polygons.append(polygon)
-
-    # Now convert them to a shapefile with OGR
-    outDriver = ogr.GetDriverByName('Esri Shapefile')
-    outDataSource = outDriver.CreateDataSource(out_shp)
+    outDriver = ogr.GetDriverByName(driver_name)
+    outDataSource = outDriver.CreateDataSource(out_filename)
     srs = osr.SpatialReference()
     if geoinfo is not None:
         srs.ImportFromWkt(geoinfo.wkt)
     outLayer = outDataSource.CreateLayer("polygon", srs, geom_type=ogr.wkbPolygon)
 
-    # Add id to polygon
     outLayer.CreateField(ogr.FieldDefn('id', ogr.OFTInteger))
     outLayer.CreateField(ogr.FieldDefn('class', ogr.OFTString))
+    outLayer.CreateField(ogr.FieldDefn('area', ogr.OFTReal))
+    outLayer.CreateField(ogr.FieldDefn('perimeter', ogr.OFTReal))
+    outLayer.CreateField(ogr.FieldDefn('note', ogr.OFTString))
     defn = outLayer.GetLayerDefn()
 
-    ## If there are multiple geometries, put the "for" loop here
-    for i in range(len(ids)):
-        # Create a new feature (attribute and geometry)
+    transaction = outLayer.TestCapability(ogr.OLCTransactions)
+    if transaction:
+        outLayer.StartTransaction()
+
+    for blob in blobs:
+        if blob.qpath_gitem is not None and not blob.qpath_gitem.isVisible():
+            continue
+
         feat = ogr.Feature(defn)
-        feat.SetField('id', ids[i])
-        feat.SetField('class', classnames[i])
+        feat.SetField('id', int(blob.id))
+        feat.SetField('class', blob.class_name)
+        feat.SetField('area', float(blob.area) * pixel_area)
+        feat.SetField('perimeter', float(blob.perimeter) * pixel_size)
+        feat.SetField('note', blob.note)
 
-        # Make a geometry, from Shapely object
-        geom = ogr.CreateGeometryFromWkb(polygons[i].wkb)
+        geom = ogr.CreateGeometryFromWkb(polygonToWkb(blob, transform))
         feat.SetGeometry(geom)
-        feat.SetStyleString('BRUSH(fc:' + colors[i] + ')')
+        feat.SetStyleString('BRUSH(fc:' + '#%02X%02X%02X' % tuple(blob.class_color) + ')')
         outLayer.CreateFeature(feat)
         feat = geom = None  # destroy these
 
+    if transaction:
+        outLayer.CommitTransaction()
+
     # Save and close everything
-    ds = layer = feat = geom = None
+    outDataSource = outLayer = None
 
 
 def saveClippedTiff(input, blobs, georef_filename, name):
@@ -125,6 +178,109 @@ def saveClippedTiff(input, blobs, georef_filename, name):
     with rio.open(name, "w", **out_meta) as dest:
         dest.write(out_image)
 
+def clipRasterByBlobs(input, blobs_info, georef_transform, output_folder):
+    """
+    Save one clipped raster for each of the given blobs. A blob is given as (id, class name, contour, inner
+    contours), the contours are in pixels of the georeferenced map. Only the window of the input raster
+    containing the blob is read. It returns the rows of the manifest.
+    An invalid polygon is repaired with buffer(0), the blobs that cannot be clipped (degenerate contours,
+    outside the raster) are skipped; both cases are reported in the status column of the manifest.
+    """
+
+    rows = []
+
+    with rio.open(input) as dataset:
+
+        nodata = dataset.nodata if dataset.nodata is not None else 0
+
+        for blob_id, class_name, contour, inner_contours in blobs_info:
+
+            status = "ok"
+            try:
+                exterior = transformContour(contour, georef_transform)
+                inners = [transformContour(inner, georef_transform) for inner in inner_contours]
+                polygon = Polygon(exterior, inners)
+                if not polygon.is_valid:
+                    polygon = polygon.buffer(0)
+                    status = "repaired"
+            except ValueError:
+                polygon = None
+
+            if polygon is None or polygon.is_empty:
+                rows.append([blob_id, class_name, "", 0, 0, "", "", "skipped (invalid contour)"])
+                continue
+
+            try:
+                window = from_bounds(*polygon.bounds, transform=dataset.transform)
+                window = window.round_offsets(op='floor').round_lengths(op='ceil')
+                window = window.intersection(Window(0, 0, dataset.width, dataset.height))
+            except (ValueError, WindowError):
+                rows.append([blob_id, class_name, "", 0, 0, "", "", "skipped (outside the raster)"])
+                continue
+
+            data = dataset.read(window=window)
+            transform = dataset.window_transform(window)
+
+            outside = geometry_mask([polygon], out_shape=(data.shape[1], data.shape[2]), transform=transform)
+            data[:, outside] = nodata
+
+            meta = dataset.meta.copy()
+            meta.update({"driver": "GTiff",
+                         "height": data.shape[1],
+                         "width": data.shape[2],
+                         "transform": transform,
+                         "nodata": nodata})
+
+            filename = "blob_{:d}.tif".format(blob_id)
+            with rio.open(os.path.join(output_folder, filename), "w", **meta) as dest:
+                dest.write(data)
+
+            left, top = transform * (0, 0)
+            rows.append([blob_id, class_name, filename, data.shape[2], data.shape[1], left, top, status])
+
+    return rows
+
+
+def saveClippedTiffPerBlob(input, blobs, georef_filename, output_folder, workers=None):
+    """
+    Export a clipped raster (e.g. the DEM) for each visible blob in the output folder, together with a
+    manifest (manifest.csv) listing the blob id, its class and the corresponding file (empty if the blob
+    has been skipped, see clipRasterByBlobs()).
+    The blobs are processed in chunks by a pool of processes, each one reads only the windows it needs.
+    """
+
+    with rio.open(georef_filename) as img:
+        georef_transform = img.transform
+
+    blobs_info = []
+    for blob in blobs:
+        if blob.qpath_gitem is None or blob.qpath_gitem.isVisible():
+            blobs_info.append((int(blob.id), blob.class_name, np.asarray(blob.contour),
+                               [np.asarray(inner) for inner in blob.inner_contours]))
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+
+    chunk_size = max(1, int(math.ceil(len(blobs_info) / float(workers * 4))))
+    chunks = [blobs_info[i:i + chunk_size] for i in range(0, len(blobs_info), chunk_size)]
+
+    rows = []
+    if len(chunks) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(clipRasterByBlobs, [input] * len(chunks), chunks,
+                                   [georef_transform] * len(chunks), [output_folder] * len(chunks))
+            for chunk_rows in results:
+                rows.extend(chunk_rows)
+
+    with open(os.path.join(output_folder, "manifest.csv"), "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "class", "filename", "width", "height", "left", "top", "status"])
+        writer.writerows(rows)
+
+
 def saveGeorefLabelMap(label_map, georef_filename, out_name):
 
     # load georeference information to use
@@ -141,6 +297,50 @@ def saveGeorefLabelMap(label_map, georef_filename, out_name):
     with rio.open(out_name + ".tif", "w", **myLabel_meta) as dest:
         dest.write(myLabel)
 
+def saveTiledGeorefLabelMap(label_strips, palette, georef_filename, out_name, build_overviews=False, block_size=256):
+    """
+    Save a label map as a tiled, deflate-compressed, single-band uint8 GeoTIFF with a color table.
+    The label map is given as a sequence of horizontal strips of palette indices, (top, strip), which are
+    written with windowed writes, so the whole label map is never stored in memory.
+    Optionally, the internal overviews are built (nearest neighbor, the values are indices).
+    """
+
+    # load georeference information to use
+    with rio.open(georef_filename) as img:
+        meta = img.meta.copy()
+
+    meta.update({"driver": "GTiff",
+                 "dtype": rio.uint8,
+                 "count": 1,
+                 "nodata": None,
+                 "tiled": True,
+                 "blockxsize": block_size,
+                 "blockysize": block_size,
+                 "compress": "deflate"})
+
+    filename = out_name + ".tif"
+    with rio.open(filename, "w", **meta) as dest:
+        for top, strip in label_strips:
+            window = Window(0, top, strip.shape[1], strip.shape[0])
+            dest.write(strip, 1, window=window)
+
+        colormap = {}
+        for i in range(palette.shape[0]):
+            colormap[i] = (int(palette[i, 0]), int(palette[i, 1]), int(palette[i, 2]), 255)
+        dest.write_colormap(1, colormap)
+
+    if build_overviews:
+        factors = []
+        factor = 2
+        while max(meta["width"], meta["height"]) / factor >= block_size:
+            factors.append(factor)
+            factor *= 2
+
+        if len(factors) > 0:
+            with rio.open(filename, "r+") as dest:
+                dest.build_overviews(factors, Resampling.nearest)
+                dest.update_tags(ns="rio_overview", resampling="nearest")
+
 def exportSlope(raster, filename):
 
     # process slope raster and save it
@@ -151,20 +351,101 @@ def exportSlope(raster, filename):
          slope = dataset.read(1).astype(np.float32)
     return slope
 
-def calculateAreaUsingSlope(depth_filename, blobs):
-    """'Outputs areas as number of pixels"""
+def hornSlope(dem, xres, yres):
+    """
+    Slope (in degrees) of the DEM with the Horn's method (the same used by gdal.DEMProcessing).
+    The slope is computed for the interior of the window, i.e. the first/last row and column are the halo.
+    """
 
-    slope = exportSlope(depth_filename, 'slope.tif')
+    a = dem[:-2, :-2]
+    b = dem[:-2, 1:-1]
+    c = dem[:-2, 2:]
+    d = dem[1:-1, :-2]
+    f = dem[1:-1, 2:]
+    g = dem[2:, :-2]
+    h = dem[2:, 1:-1]
+    i = dem[2:, 2:]
 
-    # filter out null values and jumps
-    slope[slope > 87] = 0
+    dzdx = ((c + 2.0 * f + i) - (a + 2.0 * d + g)) / (8.0 * xres)
+    dzdy = ((g + 2.0 * h + i) - (a + 2.0 * b + c)) / (8.0 * yres)
 
-    for blob in blobs:
-        non_null = blob.getMask()
-        top = blob.bbox[0]
-        left = blob.bbox[1]
-        right = left + blob.bbox[2]
-        bottom = top + blob.bbox[3]
-        slope_crop = slope[top:bottom, left:right]
-        surface_area = (non_null / abs(np.cos(np.radians(slope_crop)))).sum()
-        blob.surface_area = surface_area
+    return np.degrees(np.arctan(np.sqrt(dzdx * dzdx + dzdy * dzdy)))
+
+
+def readDEMWindow(dataset, top, left, width, height):
+    """
+    Read a window of the DEM plus a 1-pixel halo. Outside the raster the values of the border are replicated.
+    The nodata values are returned as NaN, as the whole window if it does not intersect the raster.
+    """
+
+    r0 = max(top - 1, 0)
+    c0 = max(left - 1, 0)
+    r1 = min(top + height + 1, dataset.height)
+    c1 = min(left + width + 1, dataset.width)
+
+    if r1 <= r0 or c1 <= c0:
+        return np.full((height + 2, width + 2), np.nan)
+
+    dem = dataset.read(1, window=Window(c0, r0, c1 - c0, r1 - r0)).astype(np.float64)
+    if dataset.nodata is not None:
+        dem[dem == dataset.nodata] = np.nan
+
+    pad = ((r0 - (top - 1), (top + height + 1) - r1), (c0 - (left - 1), (left + width + 1) - c1))
+    return np.pad(dem, pad, mode='edge')
+
+
+def surfaceAreasOfBlobs(depth_filename, blobs):
+    """
+    Compute the surface areas of the given blobs reading from the DEM only their bounding boxes.
+    """
+
+    surface_areas = []
+
+    with rio.open(depth_filename) as dataset:
+
+        xres = abs(dataset.transform.a)
+        yres = abs(dataset.transform.e)
+
+        for blob in blobs:
+            top = int(blob.bbox[0])
+            left = int(blob.bbox[1])
+            width = int(blob.bbox[2])
+            height = int(blob.bbox[3])
+
+            dem = readDEMWindow(dataset, top, left, width, height)
+            slope = hornSlope(dem, xres, yres)
+
+            # filter out null values and jumps: the pixels near nodata (or outside the DEM) count as flat
+            slope[np.isnan(slope)] = 0
+            slope[slope > 87] = 0
+
+            non_null = blob.getMask()
+            surface_area = (non_null / abs(np.cos(np.radians(slope)))).sum()
+            surface_areas.append(surface_area)
+
+    return surface_areas
+
+
+def calculateAreaUsingSlope(depth_filename, blobs, workers=None):
+    """
+    Outputs areas as number of pixels.
+
+    The slope is computed only inside the bounding boxes of the blobs (plus a 1-pixel halo), reading the
+    DEM by windows. The blobs are processed in chunks by a pool of threads, each one with its own dataset.
+    """
+
+    if len(blobs) == 0:
+        return
+
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+
+    chunk_size = max(1, int(math.ceil(len(blobs) / float(workers * 4))))
+    chunks = [blobs[i:i + chunk_size] for i in range(0, len(blobs), chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(surfaceAreasOfBlobs, [depth_filename] * len(chunks), chunks)
+
+        for chunk, surface_areas in zip(chunks, results):
+            for blob, surface_area in zip(chunk, surface_areas):
+                blob.surface_area = surface_area
@@ -7,17 +7,10 @@ from source import utils
 import os
 import numpy as np
 
-try:
-    import torch
-    from torch.nn.functional import upsample
-except Exception as e:
-    print("Incompatible version between pytorch, cuda and python.\n" +
-          "Knowing working version combinations are\n: Cuda 10.0, pytorch 1.0.0, python 3.6.8" + str(e))
-
-import models.deeplab_resnet as resnet
-from models.dataloaders import helpers as helpers
 from collections import OrderedDict
 
+# torch and the network (models.deeplab_resnet) are imported when the tool is used for the first time
+
 
 class DeepExtreme(Tool):
     def __init__(self, viewerplus, pick_points):
@@ -51,6 +44,10 @@ class DeepExtreme(Tool):
 
         self.loadNetwork()
 
+        import torch
+        from torch.nn.functional import upsample
+        from models.dataloaders import helpers as helpers
+
         pad = 50
         thres = 0.8
         gpu_id = 0
@@ -131,6 +128,9 @@ class DeepExtreme(Tool):
         self.resetNetwork()
         self.infoMessage.emit("Loading deepextreme network..")
 
+        import torch
+        import models.deeplab_resnet as resnet
+
         # Initialization
         modelName = 'dextr_corals'
 
@@ -158,8 +158,11 @@ class DeepExtreme(Tool):
             print("CUDA NOT AVAILABLE!")
 
     def resetNetwork(self):
-        torch.cuda.empty_cache()
 
         if self.deepextreme_net is not None:
             del self.deepextreme_net
-            self.deepextreme_net = None
\ No newline at end of file
+            self.deepextreme_net = None
+
+            # torch is already loaded (by loadNetwork())
+            import torch
+            torch.cuda.empty_cache()
\ No newline at end of file
@@ -20,6 +20,8 @@
 # THIS FILE CONTAINS UTILITY FUNCTIONS, E.G. CONVERSION BETWEEN DATA TYPES, BASIC OPERATIONS, ETC.
 
 import io
+import zlib
+import struct
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QImage, QPixmap, qRgb, qRgba
 import numpy as np
@@ -254,6 +256,95 @@ def qimageToNumpyArray(qimg):
 
     return arr
 
+def qimageToNumpyView(qimg):
+    """
+    It returns a (h, w, 4) numpy view (BGRA order) of the pixels of a 32-bit QImage without copying them.
+    The view is read-only and it is valid only while the QImage exists.
+    """
+
+    fmt = qimg.format()
+    assert (fmt == QImage.Format_RGB32 or fmt == QImage.Format_ARGB32)
+
+    w = qimg.width()
+    h = qimg.height()
+    bytes_per_line = qimg.bytesPerLine()
+
+    bits = qimg.constBits()
+    bits.setsize(int(h * bytes_per_line))
+    arr = np.frombuffer(bits, np.uint8).reshape(h, bytes_per_line)
+
+    return arr[:, :w * 4].reshape(h, w, 4)
+
+def cropNumpyArray(arr, top, left, w, h):
+    """
+    Crop the given image, the pixels outside the image are set to zero (as QImage.copy()).
+    """
+
+    H = arr.shape[0]
+    W = arr.shape[1]
+
+    crop = np.zeros((h, w) + arr.shape[2:], dtype=arr.dtype)
+
+    y1 = max(top, 0)
+    x1 = max(left, 0)
+    y2 = min(top + h, H)
+    x2 = min(left + w, W)
+
+    if y2 > y1 and x2 > x1:
+        crop[y1 - top:y2 - top, x1 - left:x2 - left] = arr[y1:y2, x1:x2]
+
+    return crop
+
+class PalettePNGWriter(object):
+    """
+    It writes an 8-bit paletted PNG a group of rows at a time, so the whole image is never stored in memory.
+    """
+
+    def __init__(self, filename, width, height, palette, compression_level=6):
+
+        self.width = width
+        self.height = height
+        self.rows = 0
+
+        self.file = open(filename, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.writeChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+        self.writeChunk(b"PLTE", np.asarray(palette, dtype=np.uint8).tobytes())
+
+        self.compressor = zlib.compressobj(compression_level)
+
+    def writeChunk(self, tag, data):
+
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(tag)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def writeRows(self, rows):
+        """
+        Write the next rows of the image (uint8 array n x width of palette indices).
+        """
+
+        n = rows.shape[0]
+
+        # each row starts with the filter type (0 = none)
+        data = np.zeros((n, self.width + 1), dtype=np.uint8)
+        data[:, 1:] = rows
+
+        compressed = self.compressor.compress(data.tobytes())
+        if len(compressed) > 0:
+            self.writeChunk(b"IDAT", compressed)
+
+        self.rows += n
+
+    def close(self):
+
+        assert (self.rows == self.height)
+
+        self.writeChunk(b"IDAT", self.compressor.flush())
+        self.writeChunk(b"IEND", b"")
+        self.file.close()
+
 def prepareLabelForDeepExtreme(qimage_map, four_points, pad_max):
     """
     Crop the image map (QImage) and return a NUMPY array containing it.
@@ -0,0 +1,30 @@
+import io
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from source.JsonStream import JsonStreamReader
+
+
+def read(text, chunk_size):
+    reader = JsonStreamReader(io.BytesIO(text.encode("utf-8")), chunk_size=chunk_size)
+    return reader.readObject({"images": lambda: reader.readArray(reader.readValue)})
+
+
+def test_numbers_split_at_every_chunk_size():
+
+    text = '{"map_px_to_mm_factor": 1.5, "width": 12345, "x": -2.0e3}'
+    for chunk_size in range(1, len(text) + 1):
+        assert read(text, chunk_size) == json.loads(text), chunk_size
+
+
+def test_project_at_every_chunk_size():
+
+    text = json.dumps({"filename": "coral è – survey", "flag": True, "none": None,
+                       "images": [{"id": "a", "width": 1e-3, "height": -7, "blobs": [[1.25, 2E+2], []]},
+                                  {"id": "b", "width": 0.5, "height": 100, "blobs": []}],
+                       "version": 12})
+    for chunk_size in range(1, len(text) + 1):
+        assert read(text, chunk_size) == json.loads(text), chunk_size